@@ -2,62 +2,1002 @@
 #
 # Basic DRA818 Programming
 # Currently only supporting basic TX support, with no tone.
+# The DRA818 class also supports the volume, filter, tail and RSSI commands.
 # Refer command set in: http://www.dorji.com/docs/data/DRA818V.pdf
 #
 # Mark Jessop <vk5qi@rfhead.net>
 #
 import argparse
+import os
+import random
 import serial
+import sys
 import time
+from threading import Thread, Event, Lock, Timer
 
 try:
     import RPi.GPIO as GPIO
-except RuntimeError:
-    print("ERROR: Could not load RPi GPIO Libraries.")
+except (RuntimeError, ImportError) as e:
+    print("ERROR: Could not load RPi GPIO Libraries - %s" % str(e))
+    GPIO = None
+    GPIO_ERROR = str(e)
 
 # DRA818 GPIO Connections
 DRA818_PTT = 17
-DRA818_SQ = 18 # Currently we ignore this. Pin 18 also appears to conflict with the PWM outputs used for audio.
+DRA818_SQ = 18 # Used by ChannelMonitor. Pin 18 also appears to conflict with the PWM outputs used for audio.
 DRA818_HL = 27 # Currently un-used. Leave HL pin floating for 1W output power.
-DRA818_PD = 22 # Currently un-used
+DRA818_PD = 22 # Power down (active low). Used by DRA818PowerManager.
 
 # Default Transmitter / Squelch Settings
 MODE = 1 # 1 = FM (supposedly 5kHz deviation), 0 = NFM (2.5 kHz Deviation)
 SQUELCH = 5 # Squelch Value, 0-8
 CTCSS = b'0000'
 
-def dra818_program(port='/dev/ttyAMA0',
-                frequency=146.500):
-    ''' Program a DRA818U/V radio to operate on a particular frequency. '''
 
+class DRA818Error(Exception):
+    ''' DRA818 error class '''
+    def __init__(self, msg):
+        Exception.__init__(self, msg)
+        self.message = msg
+
+
+class DRA818(object):
+    ''' DRA818U/V UART command driver.
+
+    Keeps the serial port open, and waits for (and checks) the module's response to each command,
+    rather than relying on fixed delays. Commands which fail or time out are retried.
+    '''
+
+    def __init__(self,
+                port='/dev/ttyAMA0',
+                baudrate=9600,
+                timeout=0.5,
+                retries=3,
+                debug_ptr=None):
+        ''' Open a connection to a DRA818 module.
+
+        Keyword Arguments:
+        port: Serial port connected to the module, or an already-open serial.Serial-like object.
+        baudrate: Serial port baud rate. The DRA818 only supports 9600 baud.
+        timeout: Time (seconds) to wait for a response to each command.
+        retries: Number of times to attempt each command before giving up.
+        debug_ptr: Reference to a function which can handle debug messages.
+        '''
+        self.timeout = timeout
+        self.retries = retries
+        self.debug_ptr = debug_ptr
+        self.connected = False
+
+        # Channel plan - precomputed DMOSETGROUP commands, indexed by channel name.
+        self.channels = {}
+        self.current_channel = None
+        # Channel of the last background retune.
+        self.retune_target = None
+        self.retune_thread = None
+        self.retune_error = None
+        # Duration (seconds) of each retune operation.
+        self.retune_times = []
+
+        if isinstance(port, str):
+            self.serial = serial.Serial(
+                    port=port,
+                    baudrate=baudrate,
+                    parity=serial.PARITY_NONE,
+                    stopbits=serial.STOPBITS_ONE,
+                    bytesize=serial.EIGHTBITS,
+                    timeout=timeout)
+        else:
+            self.serial = port
+
+    def debug_message(self, message):
+        ''' Write a debug message, either to the debug_ptr function, or to stdout. '''
+        message = "DRA818 Debug: " + message
+        if self.debug_ptr != None:
+            self.debug_ptr(message)
+        else:
+            print(message)
+
+    def read_response(self, prefix, timeout):
+        ''' Read lines from the module until one starts with prefix, or the timeout expires.
+        Returns the remainder of the line after the prefix, or None on timeout. '''
+        _deadline = time.monotonic() + timeout
+        while time.monotonic() < _deadline:
+            _line = self.serial.readline().strip()
+            if _line.startswith(prefix):
+                return _line[len(prefix):]
+            elif len(_line) > 0:
+                self.debug_message("Unexpected response: %s" % str(_line))
+        return None
+
+    def command(self, command, prefix, expected=b'0', timeout=None, retries=None):
+        ''' Send a command to the module, and wait for a response line starting with prefix.
+        If expected is not None, the remainder of the response must match it for the command to succeed.
+        Returns the remainder of the response line, or raises a DRA818Error if all attempts fail. '''
+        if timeout is None:
+            timeout = self.timeout
+        if retries is None:
+            retries = self.retries
+
+        # Don't let a single readline block for longer than the command timeout.
+        if self.serial.timeout != timeout:
+            self.serial.timeout = timeout
+
+        for _attempt in range(retries):
+            # Discard any stale data from a previous (timed out) command.
+            self.serial.reset_input_buffer()
+            self.serial.write(command + b"\r\n")
+
+            _response = self.read_response(prefix, timeout)
+
+            if _response is None:
+                self.debug_message("No response to %s (attempt %d of %d)" % (str(command), _attempt+1, retries))
+            elif (expected != None) and (_response != expected):
+                self.debug_message("%s failed with response %s (attempt %d of %d)" % (str(command), str(_response), _attempt+1, retries))
+            else:
+                return _response
+
+        raise DRA818Error("Command %s failed after %d attempts." % (str(command), retries))
+
+    def connect(self):
+        ''' Handshake with the module. This is required before other commands will be accepted. '''
+        self.command(b"AT+DMOCONNECT", b"+DMOCONNECT:")
+        self.connected = True
+
+    def ensure_connected(self):
+        if not self.connected:
+            self.connect()
+
+    def group_command(self, frequency, rx_frequency=None, mode=MODE, squelch=SQUELCH, tx_ctcss=CTCSS, rx_ctcss=CTCSS):
+        ''' Build a DMOSETGROUP command '''
+        if rx_frequency is None:
+            rx_frequency = frequency
+        return b"AT+DMOSETGROUP=%d,%3.4f,%3.4f,%s,%d,%s" % (
+            mode, frequency, rx_frequency, tx_ctcss, squelch, rx_ctcss)
+
+    def set_group(self, frequency, rx_frequency=None, mode=MODE, squelch=SQUELCH, tx_ctcss=CTCSS, rx_ctcss=CTCSS):
+        ''' Set the transmit/receive frequencies (MHz), bandwidth mode, squelch level and CTCSS codes. '''
+        self.ensure_connected()
+        self.command(self.group_command(frequency, rx_frequency, mode, squelch, tx_ctcss, rx_ctcss), b"+DMOSETGROUP:")
+        self.current_channel = None
+
+    def add_channel(self, name, frequency, **kwargs):
+        ''' Add a channel to the channel plan. Additional keyword arguments are as for set_group. '''
+        self.channels[name] = self.group_command(frequency, **kwargs)
+
+    def retune(self, name):
+        ''' Switch to a channel from the channel plan, and verify the module accepted it. '''
+        if name == self.current_channel:
+            return
+
+        _start = time.monotonic()
+        # Until the module accepts the new channel, we don't know which channel it is on.
+        self.current_channel = None
+        self.ensure_connected()
+        self.command(self.channels[name], b"+DMOSETGROUP:")
+        self.current_channel = name
+        self.retune_times.append(time.monotonic() - _start)
+
+    def retune_async(self, name):
+        ''' Start switching to a channel in the background.
+        Use wait_retune() to wait for completion before transmitting. '''
+        self.wait_retune()
+
+        def _retune():
+            try:
+                self.retune(name)
+            except DRA818Error as e:
+                self.retune_error = e
+
+        self.retune_error = None
+        self.retune_target = name
+        self.retune_thread = Thread(target=_retune)
+        self.retune_thread.start()
+
+    def wait_retune(self, timeout=None):
+        ''' Wait for any background retune to finish. Returns True if the retune succeeded (or none was running). '''
+        if self.retune_thread != None:
+            self.retune_thread.join(timeout)
+            if self.retune_thread.is_alive():
+                return False
+            self.retune_thread = None
+
+        if self.retune_error != None:
+            self.debug_message("Retune failed: %s" % self.retune_error.message)
+            return False
+
+        return True
+
+    def set_volume(self, volume):
+        ''' Set the receive audio volume (1-8) '''
+        if volume < 1 or volume > 8:
+            raise DRA818Error("Volume must be between 1 and 8.")
+        self.ensure_connected()
+        self.command(b"AT+DMOSETVOLUME=%d" % volume, b"+DMOSETVOLUME:")
+
+    def set_filter(self, emphasis=True, highpass=True, lowpass=True):
+        ''' Enable or bypass the pre/de-emphasis, high-pass and low-pass audio filters. '''
+        # For each filter, 0 = enabled, 1 = bypassed.
+        self.ensure_connected()
+        self.command(b"AT+SETFILTER=%d,%d,%d" % (not emphasis, not highpass, not lowpass), b"+DMOSETFILTER:")
+
+    def set_tail(self, enabled):
+        ''' Enable or disable the squelch tail elimination tone. '''
+        self.ensure_connected()
+        self.command(b"AT+SETTAIL=%d" % enabled, b"+DMOSETTAIL:")
+
+    def read_rssi(self):
+        ''' Read the receive signal strength (0-255) '''
+        self.ensure_connected()
+        return int(self.command(b"RSSI?", b"RSSI=", expected=None))
+
+    def read_version(self):
+        ''' Read the module firmware version string '''
+        self.ensure_connected()
+        return self.command(b"AT+VERSION", b"+VERSION:", expected=None).decode('ascii', 'replace')
+
+    def close(self):
+        self.serial.close()
+
+
+class SimulatedDRA818Serial(object):
+    ''' Stand-in for the serial port connected to a DRA818, for testing and benchmarking off-Pi.
+
+    Responds to DRA818 commands with realistic timing: the command and response take 10 bits per byte
+    to transfer at 9600 baud, and the module takes processing_delay seconds to act on each command.
+    If a GPIO backend is supplied, the module does not respond while its power-down pin is low,
+    or until wake_delay seconds after the pin is set high.
+    '''
+
+    RESPONSES = {
+        b"AT+DMOCONNECT": b"+DMOCONNECT:0",
+        b"AT+DMOSETGROUP": b"+DMOSETGROUP:0",
+        b"AT+DMOSETVOLUME": b"+DMOSETVOLUME:0",
+        b"AT+SETFILTER": b"+DMOSETFILTER:0",
+        b"AT+SETTAIL": b"+DMOSETTAIL:0",
+        b"RSSI?": b"RSSI=050",
+        b"AT+VERSION": b"+VERSION:SIMULATED"
+    }
+
+    def __init__(self, baudrate=9600, processing_delay=0.02, timeout=0.5, gpio=None, pd_pin=DRA818_PD, wake_delay=0.3):
+        self.byte_time = 10.0/baudrate
+        self.processing_delay = processing_delay
+        self.timeout = timeout
+        self.gpio = gpio
+        self.pd_pin = pd_pin
+        self.wake_delay = wake_delay
+        self.response = None
+        self.response_time = 0
+        self.commands = []
+
+    def powered(self):
+        ''' Check if the simulated module is powered up and ready. '''
+        if self.gpio is None:
+            return True
+        _pd = [(t, level) for (t, pin, level) in self.gpio.transitions if pin == self.pd_pin]
+        if len(_pd) == 0:
+            return False
+        (_t, _level) = _pd[-1]
+        return (_level == self.gpio.HIGH) and (time.perf_counter() - _t >= self.wake_delay)
+
+    def reset_input_buffer(self):
+        self.response = None
+
+    def write(self, data):
+        _command = data.strip()
+        self.commands.append(_command)
+        _response = self.RESPONSES.get(_command.split(b"=")[0], b"")
+        if len(_response) == 0 or not self.powered():
+            self.response = None
+            return len(data)
+        self.response = _response + b"\r\n"
+        self.response_time = time.monotonic() + (len(data) + len(self.response))*self.byte_time + self.processing_delay
+        return len(data)
+
+    def readline(self):
+        if self.response is None:
+            time.sleep(self.timeout)
+            return b""
+
+        _delay = self.response_time - time.monotonic()
+        if _delay > self.timeout:
+            time.sleep(self.timeout)
+            return b""
+        elif _delay > 0:
+            time.sleep(_delay)
+
+        _response = self.response
+        self.response = None
+        return _response
+
+    def close(self):
+        pass
+
+
+def benchmark_retune(channels=(144.500, 145.175, 146.525), num_retunes=30):
+    ''' Measure channel-plan retune latency against a SimulatedDRA818Serial stand-in. '''
+    _radio = DRA818(SimulatedDRA818Serial(), debug_ptr=lambda x: None)
+
+    _start = time.monotonic()
+    _radio.connect()
+    print("Connect: %.1f ms" % ((time.monotonic() - _start)*1000))
+
+    for _frequency in channels:
+        _radio.add_channel("%3.4f" % _frequency, _frequency)
+
+    _names = sorted(_radio.channels.keys())
+    for i in range(num_retunes):
+        _radio.retune(_names[i % len(_names)])
+
+    _times = sorted(_radio.retune_times)
+    print("%d retunes across %d channels: mean %.1f ms, min %.1f ms, max %.1f ms (dra818_program previously slept for 2000 ms)" % (
+        len(_times), len(_names), sum(_times)/len(_times)*1000, _times[0]*1000, _times[-1]*1000))
+
+
+class SimulatedGPIO(object):
+    ''' Simulated stand-in for the RPi.GPIO module, for testing off-Pi.
+
+    Implements the subset of the RPi.GPIO API used here. Input levels are driven by calling set_input(),
+    which fires any edge callbacks registered with add_event_detect().
+
+    Every pin transition is recorded in transitions as a (time.perf_counter(), pin, level) tuple,
+    and other events (e.g. the start and end of audio playback) can be recorded using mark().
+    '''
+    BCM = 11
+    BOARD = 10
+    OUT = 0
+    IN = 1
+    LOW = 0
+    HIGH = 1
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+    PUD_OFF = 20
+    PUD_DOWN = 21
+    PUD_UP = 22
+
+    def __init__(self):
+        self.mode = None
+        self.directions = {}
+        self.levels = {}
+        self.callbacks = {}
+        self.lock = Lock()
+        self.transitions = []
+        self.events = []
+
+    def record(self, pin, level):
+        ''' Record a change in a pin's level. '''
+        if self.levels.get(pin, None) != level:
+            self.transitions.append((time.perf_counter(), pin, level))
+        self.levels[pin] = level
+
+    def mark(self, label):
+        ''' Record a timestamped event. '''
+        self.events.append((time.perf_counter(), label))
+
+    def clear_history(self):
+        self.transitions = []
+        self.events = []
+
+    def setmode(self, mode):
+        self.mode = mode
+
+    def setwarnings(self, enabled):
+        pass
+
+    def setup(self, pin, direction, initial=None, pull_up_down=None):
+        self.directions[pin] = direction
+        if direction == self.OUT:
+            self.record(pin, self.LOW if initial is None else initial)
+        elif pin not in self.levels:
+            # Floating inputs read as pulled up/down, or high.
+            self.record(pin, self.LOW if pull_up_down == self.PUD_DOWN else self.HIGH)
+
+    def output(self, pin, value):
+        if self.directions.get(pin, None) != self.OUT:
+            raise RuntimeError("The GPIO channel has not been set up as an OUTPUT")
+        with self.lock:
+            self.record(pin, int(bool(value)))
+
+    def input(self, pin):
+        if pin not in self.directions:
+            raise RuntimeError("You must setup() the GPIO channel first")
+        return self.levels[pin]
+
+    def add_event_detect(self, pin, edge, callback=None, bouncetime=None):
+        # (edge, callback, debounce time (s), time of the last edge delivered). As with RPi.GPIO, edges within
+        # the debounce time of the last one delivered are dropped.
+        self.callbacks[pin] = [edge, callback, (bouncetime or 0)/1000.0, None]
+
+    def remove_event_detect(self, pin):
+        self.callbacks.pop(pin, None)
+
+    def cleanup(self):
+        self.directions = {}
+        self.callbacks = {}
+
+    def set_input(self, pin, value):
+        ''' Simulate an external device driving an input pin. '''
+        with self.lock:
+            _old = self.levels.get(pin, self.HIGH)
+            self.record(pin, int(bool(value)))
+            _new = self.levels[pin]
+
+        if (_old == _new) or (pin not in self.callbacks):
+            return
+
+        _detect = self.callbacks[pin]
+        (_edge, _callback, _bouncetime, _last) = _detect
+        _now = time.monotonic()
+        if (_last != None) and (_now - _last < _bouncetime):
+            return
+        if (_edge == self.BOTH) or (_edge == self.RISING and _new) or (_edge == self.FALLING and not _new):
+            _detect[3] = _now
+            if _callback != None:
+                _callback(pin)
+
+    def ptt_timing(self, pin=DRA818_PTT, start_event='audio_start', end_event='audio_end'):
+        ''' Analyse the recorded PTT (active low) transitions and audio events.
+
+        Returns a dictionary containing a list of 'sessions' (one per PTT on/off cycle, with the
+        PTT-on to audio start latency, the audio end to PTT-off tail time, and the PTT-on duration),
+        along with mean values and the PTT duty cycle over the recorded period.
+        '''
+        _transitions = [(t, level) for (t, p, level) in self.transitions if p == pin]
+        _starts = [t for (t, label) in self.events if label == start_event]
+        _ends = [t for (t, label) in self.events if label == end_event]
+
+        _sessions = []
+        _on_time = None
+        for (_t, _level) in _transitions:
+            if _level == self.LOW and _on_time is None:
+                _on_time = _t
+            elif _level == self.HIGH and _on_time != None:
+                _start = [x for x in _starts if _on_time <= x <= _t]
+                _end = [x for x in _ends if _on_time <= x <= _t]
+                _sessions.append({
+                    'ptt_on': _on_time,
+                    'ptt_off': _t,
+                    'duration': _t - _on_time,
+                    'ptt_to_audio': (_start[0] - _on_time) if len(_start) > 0 else None,
+                    'tail': (_t - _end[-1]) if len(_end) > 0 else None
+                })
+                _on_time = None
+
+        def _mean(values):
+            values = [x for x in values if x != None]
+            return sum(values)/len(values) if len(values) > 0 else None
+
+        _result = {'sessions': _sessions}
+        _result['ptt_to_audio'] = _mean([x['ptt_to_audio'] for x in _sessions])
+        _result['tail'] = _mean([x['tail'] for x in _sessions])
+        if len(_transitions) > 1:
+            _period = _transitions[-1][0] - _transitions[0][0]
+            _result['duty_cycle'] = sum([x['duration'] for x in _sessions])/_period if _period > 0 else None
+        else:
+            _result['duty_cycle'] = None
+
+        return _result
+
+
+class ChannelMonitor(object):
+    ''' Listen-before-talk channel access, using the DRA818 squelch line.
+
+    Squelch changes are picked up via GPIO edge callbacks, and channel-busy statistics are accumulated.
+    wait_clear() blocks until the channel has been clear for a backoff period, or until a timeout expires.
+
+    Edges are debounced, so an edge which follows another within the debounce time (e.g. the end of a
+    short squelch burst) can be dropped. So the pin level is always re-read rather than inferred from the
+    edge, again once the debounce time has passed after each edge, and every recheck seconds while waiting.
+    '''
+
+    def __init__(self,
+                gpio=None,
+                pin=DRA818_SQ,
+                backoff=(0.5, 2.0),
+                bouncetime=20,
+                recheck=0.5,
+                timeout=60.0,
+                debug_ptr=None):
+        ''' Initialise a ChannelMonitor. Call start() to begin monitoring.
 
-    _dmosetgroup = b"AT+DMOSETGROUP=%d,%3.4f,%3.4f,%s,%d,%s\r\n" % (
-        MODE, frequency, frequency, CTCSS, SQUELCH, CTCSS)
+        Keyword Arguments:
+        gpio: GPIO backend (the RPi.GPIO module, or a SimulatedGPIO object). Defaults to RPi.GPIO.
+        pin: Squelch input pin (BCM numbering). The DRA818 squelch output is active low.
+        backoff: (min, max) time in seconds the channel must be clear before we transmit.
+                 A random value in this range is used for each wait, so stations don't collide when a channel clears.
+        bouncetime: GPIO edge debounce time, in milliseconds.
+        recheck: Interval (seconds) at which the squelch pin is re-read while wait_clear() is waiting for a busy channel.
+        timeout: Default maximum time (seconds) wait_clear() waits for a clear channel, after which we transmit anyway.
+        debug_ptr: Reference to a function which can handle debug messages.
+        '''
+        self.gpio = gpio if gpio != None else GPIO
+        self.pin = pin
+        self.backoff = backoff
+        self.bouncetime = bouncetime
+        self.recheck = recheck
+        self.timeout = timeout
+        self.debug_ptr = debug_ptr
 
-    print("Sending: %s" % str(_dmosetgroup).strip())
+        # Set when the channel is clear.
+        self.clear_event = Event()
+        self.lock = Lock()
 
-    # Open serial port
-    _s = serial.Serial(
-            port=port,
-            baudrate=9600,
-            parity=serial.PARITY_NONE,
-            stopbits=serial.STOPBITS_ONE,
-            bytesize=serial.EIGHTBITS)
-    # We need to issue this command to be able to send further commands.
-    _s.write(b"AT+DMOCONNECT\r\n")
-    time.sleep(1.00)
-    _response = _s.readline()
-    print("Connect Response: %s" % str(_response))
+        self.busy = False
+        self.last_change = time.monotonic()
+        self.start_time = self.last_change
 
-    # Send the programming command..
-    _s.write(_dmosetgroup)
-    time.sleep(1.00)
+        # Statistics
+        self.busy_count = 0
+        self.busy_time = 0.0
+        self.wait_count = 0
+        self.wait_time = 0.0
+        self.wait_timeouts = 0
 
-    # Read in the response from the module.
-    _response = _s.readline()
-    _s.close()
-    
-    print("Response: %s" % str(_response).strip())
+    def debug_message(self, message):
+        ''' Write a debug message, either to the debug_ptr function, or to stdout. '''
+        message = "Channel Monitor: " + message
+        if self.debug_ptr != None:
+            self.debug_ptr(message)
+        else:
+            print(message)
+
+    def start(self):
+        ''' Configure the squelch input, and start monitoring it. '''
+        self.gpio.setup(self.pin, self.gpio.IN, pull_up_down=self.gpio.PUD_UP)
+        self.start_time = time.monotonic()
+        self.last_change = self.start_time
+        self.read_squelch()
+        self.gpio.add_event_detect(self.pin, self.gpio.BOTH, callback=self.squelch_edge, bouncetime=self.bouncetime)
+
+    def stop(self):
+        self.gpio.remove_event_detect(self.pin)
+
+    def squelch_edge(self, pin):
+        ''' GPIO edge callback '''
+        self.read_squelch()
+        if self.bouncetime > 0:
+            # Any edge within the debounce time is dropped, so look at the pin again once it has passed.
+            _timer = Timer(self.bouncetime/1000.0, self.read_squelch)
+            _timer.daemon = True
+            _timer.start()
+
+    def read_squelch(self):
+        ''' Update the channel state from the current squelch pin level. '''
+        self.update(not self.gpio.input(self.pin))
+
+    def update(self, busy):
+        ''' Update the channel state, and accumulate statistics. '''
+        with self.lock:
+            _now = time.monotonic()
+            if busy and not self.busy:
+                self.busy_count += 1
+            elif self.busy and not busy:
+                self.busy_time += _now - self.last_change
+
+            if busy != self.busy:
+                self.last_change = _now
+            self.busy = busy
+
+            if busy:
+                self.clear_event.clear()
+            else:
+                self.clear_event.set()
+
+    def wait_clear(self, timeout=None, backoff=None):
+        ''' Wait until the channel has been clear for the backoff time (at most timeout seconds, default self.timeout).
+        Returns True if the channel is clear, or False if the timeout expired first. '''
+        if timeout is None:
+            timeout = self.timeout
+        if backoff is None:
+            backoff = random.uniform(self.backoff[0], self.backoff[1])
+
+        _start = time.monotonic()
+        _deadline = _start + timeout
+        _result = False
+
+        while True:
+            _now = time.monotonic()
+            if _now >= _deadline:
+                break
+
+            if self.busy:
+                if not self.clear_event.wait(min(self.recheck, _deadline - _now)):
+                    self.read_squelch()
+                continue
+
+            _clear_for = _now - self.last_change
+            if _clear_for >= backoff:
+                _result = True
+                break
+
+            time.sleep(min(backoff - _clear_for, _deadline - _now))
+
+        _waited = time.monotonic() - _start
+        with self.lock:
+            self.wait_count += 1
+            self.wait_time += _waited
+            if not _result:
+                self.wait_timeouts += 1
+
+        if _waited > backoff + 0.1:
+            self.debug_message("Waited %.1f s for a clear channel%s." % (_waited, "" if _result else " (timed out)"))
+
+        return _result
+
+    def stats(self):
+        ''' Return channel-busy statistics. '''
+        with self.lock:
+            _now = time.monotonic()
+            _busy_time = self.busy_time + ((_now - self.last_change) if self.busy else 0.0)
+            return {
+                'busy': self.busy,
+                'busy_count': self.busy_count,
+                'busy_time': _busy_time,
+                'busy_fraction': _busy_time/max(_now - self.start_time, 1.0e-6),
+                'wait_count': self.wait_count,
+                'wait_time': self.wait_time,
+                'wait_timeouts': self.wait_timeouts
+            }
+
+
+class DRA818PowerManager(object):
+    ''' Power the DRA818 down between transmissions, and wake it up just in time for the next one.
+
+    The time taken for the module to become ready after the power-down pin is released is measured
+    on every wake (by polling it with AT+DMOCONNECT), and used to decide how early to wake it
+    ahead of a scheduled transmission. Powered and transmitting time are accumulated, to give
+    energy-relevant duty-cycle statistics.
+    '''
+
+    def __init__(self,
+                radio=None,
+                gpio=None,
+                pin=DRA818_PD,
+                wake_margin=0.2,
+                default_wake_latency=0.5,
+                max_wake_time=3.0,
+                poll_timeout=0.1,
+                debug_ptr=None):
+        ''' Initialise a DRA818PowerManager. The module is assumed to be powered up initially.
+
+        Keyword Arguments:
+        radio: A DRA818 object, used to check the module is ready after waking.
+               If not supplied, we wait for the estimated wake latency instead.
+        gpio: GPIO backend. Defaults to the backend used by the dra818_* functions.
+        pin: Power-down pin (BCM numbering). Low = powered down.
+        wake_margin: Extra time (seconds) to allow on top of the measured wake latency.
+        default_wake_latency: Wake latency (seconds) to assume before any have been measured.
+        max_wake_time: Maximum time (seconds) to wait for the module to become ready.
+        poll_timeout: Timeout (seconds) for each AT+DMOCONNECT poll while waking. This sets the
+                      resolution of the wake latency measurement, and must exceed a command round-trip (~50ms).
+        debug_ptr: Reference to a function which can handle debug messages.
+        '''
+        self.radio = radio
+        self.gpio = gpio
+        self.pin = pin
+        self.wake_margin = wake_margin
+        self.default_wake_latency = default_wake_latency
+        self.max_wake_time = max_wake_time
+        self.poll_timeout = poll_timeout
+        self.debug_ptr = debug_ptr
+
+        self.lock = Lock()
+        self.ready_event = Event()
+        self.ready_event.set()
+        self.state = 'on'
+        self.wake_timer = None
+
+        self.start_time = time.monotonic()
+        self.last_change = self.start_time
+        self.powered_time = 0.0
+        self.transmit_time = 0.0
+        self.transmit_start = None
+        self.wake_latencies = []
+        self.wake_count = 0
+        self.late_wakes = 0
+
+    def debug_message(self, message):
+        ''' Write a debug message, either to the debug_ptr function, or to stdout. '''
+        message = "DRA818 Power: " + message
+        if self.debug_ptr != None:
+            self.debug_ptr(message)
+        else:
+            print(message)
+
+    def backend(self):
+        return self.gpio if self.gpio != None else GPIO
+
+    def wake_latency(self):
+        ''' Estimated time (seconds) from releasing power-down to the module being ready. '''
+        if len(self.wake_latencies) == 0:
+            return self.default_wake_latency
+        return max(self.wake_latencies[-10:])
+
+    def power_down(self):
+        ''' Power the module down. Waits for any background retune to complete first. '''
+        with self.lock:
+            if self.wake_timer != None:
+                self.wake_timer.cancel()
+                self.wake_timer = None
+            if self.state == 'off':
+                return
+
+        if self.radio != None:
+            self.radio.wait_retune()
+
+        with self.lock:
+            self.backend().output(self.pin, self.backend().LOW)
+            self.powered_time += time.monotonic() - self.last_change
+            self.last_change = time.monotonic()
+            self.state = 'off'
+            self.ready_event.clear()
+
+    def wake(self):
+        ''' Power the module up, and wait until it is ready. Returns True if it responded. '''
+        with self.lock:
+            if self.state != 'off':
+                return self.ready_event.is_set()
+            self.state = 'waking'
+            self.backend().output(self.pin, self.backend().HIGH)
+            _start = time.monotonic()
+            self.last_change = _start
+            self.wake_count += 1
+
+        _ready = True
+        if self.radio != None:
+            # Poll the module until it responds.
+            _ready = False
+            while time.monotonic() - _start < self.max_wake_time:
+                try:
+                    self.radio.command(b"AT+DMOCONNECT", b"+DMOCONNECT:", timeout=self.poll_timeout, retries=1)
+                    self.radio.connected = True
+                    _ready = True
+                    break
+                except DRA818Error:
+                    pass
+            if _ready:
+                self.wake_latencies.append(time.monotonic() - _start)
+            else:
+                self.debug_message("Module did not respond after wake.")
+        else:
+            time.sleep(self.wake_latency())
+
+        with self.lock:
+            self.state = 'on'
+            self.ready_event.set()
+
+        return _ready
+
+    def schedule_wake(self, transmit_time):
+        ''' Schedule a wake-up so the module is ready by transmit_time (a time.monotonic() time). '''
+        _delay = transmit_time - time.monotonic() - self.wake_latency() - self.wake_margin
+
+        with self.lock:
+            if self.state != 'off':
+                return
+            if self.wake_timer != None:
+                self.wake_timer.cancel()
+            self.wake_timer = Timer(max(_delay, 0), self.wake)
+            self.wake_timer.daemon = True
+            self.wake_timer.start()
+
+    def wait_ready(self, timeout=None):
+        ''' Ensure the module is powered up and ready, waking it immediately if it is not already waking. '''
+        if timeout is None:
+            timeout = self.max_wake_time + 1.0
+
+        with self.lock:
+            _late = self.state == 'off'
+            if _late:
+                if self.wake_timer != None:
+                    self.wake_timer.cancel()
+                    self.wake_timer = None
+                self.late_wakes += 1
+
+        if _late:
+            self.debug_message("Woke module late.")
+            return self.wake()
+
+        return self.ready_event.wait(timeout)
+
+    def transmit_started(self):
+        self.transmit_start = time.monotonic()
+
+    def transmit_finished(self):
+        if self.transmit_start != None:
+            self.transmit_time += time.monotonic() - self.transmit_start
+            self.transmit_start = None
+
+    def stats(self):
+        ''' Return power and transmit duty-cycle statistics. '''
+        with self.lock:
+            _now = time.monotonic()
+            _powered = self.powered_time + ((_now - self.last_change) if self.state != 'off' else 0.0)
+            _elapsed = max(_now - self.start_time, 1.0e-6)
+            return {
+                'elapsed': _elapsed,
+                'powered_time': _powered,
+                'powered_fraction': _powered/_elapsed,
+                'transmit_time': self.transmit_time,
+                'transmit_fraction': self.transmit_time/_elapsed,
+                'wake_count': self.wake_count,
+                'late_wakes': self.late_wakes,
+                'wake_latency': self.wake_latency(),
+                'wake_latency_max': max(self.wake_latencies) if len(self.wake_latencies) > 0 else None
+            }
+
+
+class DRA818Radio(object):
+    ''' A single DRA818 transmitter, with its own UART, set of GPIO pins, and audio output device.
+
+    Multiple DRA818Radio objects can be used at once (e.g. a VHF and a UHF module), each transmitting
+    its own SSTV mode. The dra818_* functions continue to drive the default pin set.
+    '''
+
+    def __init__(self,
+                name='dra818',
+                port=None,
+                ptt_pin=DRA818_PTT,
+                sq_pin=DRA818_SQ,
+                hl_pin=DRA818_HL,
+                pd_pin=DRA818_PD,
+                audio_device=None,
+                tx_mode=None,
+                channels=None,
+                listen_before_talk=False,
+                power_save=False,
+                tx_queue=None,
+                gpio=None,
+                debug_ptr=None):
+        ''' Initialise a DRA818Radio. Call setup_io() before use.
+
+        Keyword Arguments:
+        name: Name of this radio, used in debug messages and GPIO event labels.
+        port: Serial port connected to the module (or a serial.Serial-like object).
+              If None, the module cannot be retuned, woken or checked.
+        ptt_pin, sq_pin, hl_pin, pd_pin: PTT, squelch, high/low power and power-down pins (BCM numbering).
+        audio_device: ALSA device to play this radio's audio on (e.g. 'plughw:1,0'). None = the default device.
+        tx_mode: SSTV mode to transmit on this radio. None = use the SSTVPiCam's tx_mode.
+        channels: An optional list of channel names (from the module's channel plan) to rotate through.
+        listen_before_talk: If True, wait for a clear channel (via the squelch pin) before transmitting.
+                            The wait is bounded by channel_monitor.timeout.
+        power_save: If True, power the module down between transmissions.
+        tx_queue: An optional (started) TransmitQueue, which sends this radio's audio and idents (its ptt_ptr should key this radio).
+        gpio: GPIO backend. Defaults to the backend used by the dra818_* functions.
+        debug_ptr: Reference to a function which can handle debug messages.
+        '''
+        self.name = name
+        self.ptt_pin = ptt_pin
+        self.sq_pin = sq_pin
+        self.hl_pin = hl_pin
+        self.pd_pin = pd_pin
+        self.audio_device = audio_device
+        self.tx_mode = tx_mode
+        self.channels = channels
+        self.channel_index = 0
+        self.gpio = gpio
+        self.debug_ptr = debug_ptr
+
+        self.tx_queue = tx_queue
+
+        self.dra818 = None
+        if port != None:
+            self.dra818 = DRA818(port, debug_ptr=debug_ptr)
+
+        self.channel_monitor = None
+        if listen_before_talk:
+            self.channel_monitor = ChannelMonitor(gpio=self.backend(), pin=sq_pin, debug_ptr=debug_ptr)
+
+        self.power_manager = None
+        if power_save:
+            self.power_manager = DRA818PowerManager(radio=self.dra818, gpio=self.backend(), pin=pd_pin, debug_ptr=debug_ptr)
+
+    def backend(self):
+        return self.gpio if self.gpio != None else GPIO
+
+    def setup_io(self):
+        ''' Configure this radio's IO pins, and start the channel monitor (if used). '''
+        _gpio = self.backend()
+        _gpio.setmode(_gpio.BCM)
+        _gpio.setup(self.ptt_pin, _gpio.OUT, initial=_gpio.HIGH)
+        _gpio.setup(self.hl_pin, _gpio.OUT, initial=_gpio.LOW) # WARNING - Do NOT set this pin high.
+        _gpio.setup(self.pd_pin, _gpio.OUT, initial=_gpio.HIGH)
+        if self.channel_monitor != None:
+            self.channel_monitor.start()
+
+    def high_power(self, enabled):
+        ''' Set the module to high power by floating the HL input '''
+        _gpio = self.backend()
+        if enabled:
+            _gpio.setup(self.hl_pin, _gpio.IN)
+        else:
+            _gpio.setup(self.hl_pin, _gpio.OUT, initial=_gpio.LOW)
+
+    def ptt(self, enabled):
+        ''' Set the module's PTT on or off '''
+        _gpio = self.backend()
+        _gpio.output(self.ptt_pin, _gpio.LOW if enabled else _gpio.HIGH)
+
+    def read_squelch(self):
+        ''' Read the squelch line. Return True if there is signal detected. '''
+        return not self.backend().input(self.sq_pin)
+
+    def mark(self, label):
+        ''' Record a timestamped event (labelled with the radio name), if the GPIO backend supports it. '''
+        _gpio = self.backend()
+        if hasattr(_gpio, 'mark'):
+            _gpio.mark("%s:%s" % (label, self.name))
+
+    def next_channel(self):
+        ''' Start retuning to the next channel in the rotation, in the background. Returns the channel name. '''
+        if (self.dra818 == None) or (self.channels == None) or (len(self.channels) == 0):
+            return None
+
+        _channel = self.channels[self.channel_index % len(self.channels)]
+        self.channel_index += 1
+        self.dra818.retune_async(_channel)
+        return _channel
+
+    def close(self):
+        if self.channel_monitor != None:
+            self.channel_monitor.stop()
+        if self.dra818 != None:
+            self.dra818.wait_retune()
+            self.dra818.close()
+
+
+class MissingGPIO(object):
+    ''' Stands in for RPi.GPIO when it could not be loaded, so that any attempt to drive the pins fails loudly,
+    rather than the PTT and power-down pins silently never being driven. '''
+
+    def __init__(self, error):
+        self.error = error
+
+    def __getattr__(self, name):
+        raise RuntimeError("RPi.GPIO is not available (%s). To run off-Pi, call set_gpio_backend(SimulatedGPIO()), "
+            "or set DRA818_SIMULATE_GPIO=1." % self.error)
+
+
+# Only use simulated GPIO if it has been explicitly asked for.
+if GPIO is None:
+    GPIO = SimulatedGPIO() if os.environ.get('DRA818_SIMULATE_GPIO', '') not in ('', '0') else MissingGPIO(GPIO_ERROR)
+
+
+def set_gpio_backend(backend):
+    ''' Select the GPIO backend used by the dra818_* functions (the RPi.GPIO module, or a SimulatedGPIO object). '''
+    global GPIO
+    GPIO = backend
+
+
+def gpio_mark(label):
+    ''' Record a timestamped event, if the GPIO backend supports it (i.e. it is simulated). '''
+    if hasattr(GPIO, 'mark'):
+        GPIO.mark(label)
+
+
+def dra818_program(port='/dev/ttyAMA0',
+                frequency=146.500):
+    ''' Program a DRA818U/V radio to operate on a particular frequency.
+    Returns True if the module confirmed the new settings. '''
+
+    print("Programming DRA818 to %3.4f MHz" % frequency)
+
+    _start = time.monotonic()
+    try:
+        _radio = DRA818(port)
+    except serial.SerialException as e:
+        print("Could not open serial port: %s" % str(e))
+        return False
+
+    try:
+        _radio.set_group(frequency)
+        print("Programmed OK in %d ms." % int((time.monotonic() - _start)*1000))
+        return True
+    except DRA818Error as e:
+        print("Programming failed: %s" % e.message)
+        return False
+    finally:
+        _radio.close()
 
 
 def dra818_setup_io():
@@ -86,6 +1026,14 @@ def dra818_ptt(enabled):
         GPIO.output(DRA818_PTT, GPIO.HIGH)
 
 
+def dra818_power(enabled):
+    ''' Power the DRA818 up or down, using the power-down pin '''
+    if enabled:
+        GPIO.output(DRA818_PD, GPIO.HIGH)
+    else:
+        GPIO.output(DRA818_PD, GPIO.LOW)
+
+
 def dra818_read_squelch():
     ''' Read the DRA818 Squelch line. Return True if there is signal detected. '''
     return not GPIO.input(DRA818_SQ)
@@ -96,9 +1044,15 @@ if __name__ == '__main__':
     parser.add_argument("--frequency", type=float, default=146.500, help="Transmit Frequency (MHz)")
     parser.add_argument("--port", type=str, default='/dev/ttyAMA0', help="Serial port connected to module.")
     parser.add_argument("--test", action="store_true", default=False, help="Test transmitter after programming with 1s of PTT.")
+    parser.add_argument("--benchmark", action="store_true", default=False, help="Benchmark channel retuning against a simulated module, then exit.")
     args = parser.parse_args()
 
-    dra818_program(args.port, args.frequency)
+    if args.benchmark:
+        benchmark_retune()
+        sys.exit(0)
+
+    if not dra818_program(args.port, args.frequency):
+        sys.exit(1)
 
     if args.test:
         dra818_setup_io()
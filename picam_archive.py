@@ -0,0 +1,375 @@
+#!/usr/bin/env python
+'''
+Asynchronous archive writer for captured images.
+
+Writing each full resolution JPEG and resized PNG into the archive directory (and fsync'ing it, so it
+survives a power cut) can take seconds on an SD card, and none of it needs to happen before the image
+is transmitted. ArchiveWriter does it in a background thread, fed by a bounded queue, so queueing a
+file never blocks: if the queue is full, the file is dropped from the archive rather than delaying
+the next transmission.
+
+Files are written into an .incoming directory inside the archive directory (on the same filesystem),
+and only renamed into the archive once their data has been fsync'd, so a power cut can never leave
+a partial file in the archive. The fsyncs (and the fsync of the directory) are batched. Once the
+archive exceeds its size budget, or the disk its free space reserve, the oldest files are removed.
+WAV files are not archived by default, as they can be regenerated from the images.
+
+JPEGs queued with a position are GPS tagged (see picam_exif.py) as they are archived, without re-encoding them.
+
+Released under GNU GPL version 3 or later
+'''
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+from queue import Queue, Full, Empty
+from threading import Thread
+
+from picam_exif import tag_file
+
+
+class ArchiveWriter(object):
+    ''' Moves files into an archive directory in a background thread, within a disk space budget. '''
+
+    def __init__(self,
+                directory='./tx_images',
+                max_bytes=None,
+                min_free_bytes=100*1024*1024,
+                queue_size=16,
+                batch_size=8,
+                batch_interval=2.0,
+                archive_audio=False,
+                max_fix_age=5.0,
+                debug_ptr=None):
+        ''' Initialise an ArchiveWriter. Call start() to start the writer thread.
+
+        Keyword Arguments:
+        directory: Archive directory. Created if it does not exist.
+        max_bytes: Maximum total size of the archived files. The oldest files are removed beyond this.
+                   If None, the archive is only limited by min_free_bytes.
+        min_free_bytes: Free space to leave on the disk. The oldest files are removed to keep this much free.
+                        If None, the free space is not checked.
+        queue_size: Maximum number of files waiting to be archived. Files queued beyond this are dropped.
+        batch_size: Maximum number of files to write before fsync'ing them and renaming them into the archive.
+        batch_interval: Maximum time (seconds) a written file waits for the rest of its batch.
+        archive_audio: If False, WAV files are not archived (they can be regenerated from the images).
+        max_fix_age: Files are not GPS tagged if their position is further than this (seconds) from a GPS fix,
+                     i.e. if it was extrapolated too far (see UBloxGPS.position_at()).
+        debug_ptr: Reference to a function which can handle debug messages.
+        '''
+        self.directory = directory
+        self.incoming = os.path.join(directory, '.incoming')
+        self.max_bytes = max_bytes
+        self.min_free_bytes = min_free_bytes
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.archive_audio = archive_audio
+        self.max_fix_age = max_fix_age
+        self.debug_ptr = debug_ptr
+
+        # Queue of (source filename, archive name, remove source, position) tuples. None stops the writer.
+        self.queue = Queue(maxsize=queue_size)
+        # Archived files (name -> size in bytes), oldest first.
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+
+        self.running = False
+        self.thread = None
+
+        # Statistics
+        self.archived = 0
+        self.dropped = 0
+        self.skipped = 0
+        self.pruned = 0
+        self.tagged = 0
+        self.stale = 0
+        self.failed = 0
+        self.batches = 0
+        self.max_queue_depth = 0
+
+        for _dir in (self.directory, self.incoming):
+            if not os.path.isdir(_dir):
+                os.makedirs(_dir)
+        self.load_index()
+
+    def debug_message(self, message):
+        ''' Write a debug message, either to the debug_ptr function, or to stdout. '''
+        message = "Archive: " + message
+        if self.debug_ptr != None:
+            self.debug_ptr(message)
+        else:
+            print(message)
+
+    def load_index(self):
+        ''' Rebuild the index from the archive directory, oldest first. '''
+        _files = []
+        for _name in os.listdir(self.directory):
+            _path = os.path.join(self.directory, _name)
+            if os.path.isfile(_path):
+                _stat = os.stat(_path)
+                _files.append((_stat.st_mtime, _name, _stat.st_size))
+
+        self.entries = OrderedDict([(_name, _size) for (_mtime, _name, _size) in sorted(_files)])
+        self.total_bytes = sum(self.entries.values())
+
+    def clear_incoming(self):
+        ''' Remove any files left in the incoming directory by a crash (they may be incomplete).
+        Only the writer which owns the archive should do this, before anything is captured into it. '''
+        for _name in os.listdir(self.incoming):
+            try:
+                os.remove(os.path.join(self.incoming, _name))
+            except OSError:
+                pass
+
+    def start(self):
+        ''' Clear out the incoming directory, and start the writer thread. '''
+        if self.running:
+            return
+        self.clear_incoming()
+        self.running = True
+        self.thread = Thread(target=self.write_loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        ''' Archive everything queued so far, then stop the writer thread. '''
+        if not self.running:
+            return
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+
+    def put(self, filename, name=None, remove=False, position=None):
+        ''' Queue a file to be archived as name (by default, its own name). Never blocks.
+        If remove is True, the archive writer takes ownership of the file: it is moved (rather than copied)
+        into the archive, or deleted if it cannot be archived. Files in the incoming directory are moved for free.
+        If position (a dictionary with 'latitude', 'longitude', and optionally 'altitude', 'datetime' and 'fix_age') is
+        supplied, and the file is a JPEG, the position is added to its Exif GPS tags, unless its fix_age exceeds max_fix_age.
+        Returns True if the file was queued. '''
+        if name is None:
+            name = os.path.basename(filename)
+
+        if (not self.archive_audio) and name.lower().endswith('.wav'):
+            self.skipped += 1
+            if remove:
+                self.discard(filename)
+            return False
+
+        try:
+            self.queue.put_nowait((filename, name, remove, position))
+        except Full:
+            self.dropped += 1
+            self.debug_message("Queue full, not archiving %s." % name)
+            if remove:
+                self.discard(filename)
+            return False
+
+        self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+        return True
+
+    def discard(self, filename):
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+
+    def write_loop(self):
+        # Files written to the incoming directory, waiting to be fsync'd and renamed into the archive, as (path, name).
+        _pending = []
+        _batch_start = None
+        while True:
+            try:
+                _timeout = None if len(_pending) == 0 else max(0, self.batch_interval - (time.monotonic() - _batch_start))
+                _item = self.queue.get(timeout=_timeout)
+            except Empty:
+                _item = ()
+
+            if _item is None:
+                self.commit(_pending)
+                break
+
+            if len(_item) > 0:
+                (_filename, _name, _remove, _position) = _item
+                try:
+                    _pending.append((self.stage(_filename, _name, _remove, _position), _name))
+                    if _batch_start is None:
+                        _batch_start = time.monotonic()
+                except (IOError, OSError) as e:
+                    self.failed += 1
+                    self.debug_message("Could not archive %s - %s" % (_name, str(e)))
+                    if _remove:
+                        self.discard(_filename)
+
+            if (len(_pending) >= self.batch_size) or ((len(_pending) > 0) and (time.monotonic() - _batch_start >= self.batch_interval)):
+                self.commit(_pending)
+                _pending = []
+                _batch_start = None
+
+        self.running = False
+
+    def stage(self, filename, name, remove, position=None):
+        ''' Get a file into the incoming directory (moving it if we own it, otherwise copying it), and GPS tag it
+        if a position is supplied. Returns its path in the incoming directory. '''
+        _staged = os.path.join(self.incoming, name)
+        if os.path.abspath(filename) != os.path.abspath(_staged):
+            try:
+                if not remove:
+                    raise OSError("Not ours to move.")
+                # Free, if the file is on the same filesystem.
+                os.rename(filename, _staged)
+            except OSError:
+                shutil.copyfile(filename, _staged)
+                if remove:
+                    self.discard(filename)
+
+        if (position != None) and (position.get('fix_age', 0.0) > self.max_fix_age):
+            self.stale += 1
+            self.debug_message("Not GPS tagging %s - position is %.1f s from a fix." % (name, position['fix_age']))
+        elif (position != None) and os.path.splitext(name)[1].lower() in ('.jpg', '.jpeg'):
+            try:
+                tag_file(_staged, position)
+                self.tagged += 1
+            except Exception as e:
+                self.debug_message("Could not GPS tag %s - %s" % (name, str(e)))
+        return _staged
+
+    def commit(self, pending):
+        ''' fsync a batch of staged files, rename them into the archive, then fsync the archive directory. '''
+        if len(pending) == 0:
+            return
+        _committed = []
+        for (_staged, _name) in pending:
+            try:
+                _fd = os.open(_staged, os.O_RDONLY)
+                try:
+                    os.fsync(_fd)
+                finally:
+                    os.close(_fd)
+                _path = os.path.join(self.directory, _name)
+                os.rename(_staged, _path)
+                _committed.append((_name, os.path.getsize(_path)))
+            except OSError as e:
+                self.failed += 1
+                self.debug_message("Could not archive %s - %s" % (_name, str(e)))
+                self.discard(_staged)
+
+        # Make the renames durable.
+        try:
+            _fd = os.open(self.directory, os.O_RDONLY)
+            try:
+                os.fsync(_fd)
+            finally:
+                os.close(_fd)
+        except OSError:
+            pass
+
+        for (_name, _size) in _committed:
+            if _name in self.entries:
+                self.total_bytes -= self.entries.pop(_name)
+            self.entries[_name] = _size
+            self.total_bytes += _size
+        self.archived += len(_committed)
+        self.batches += 1
+        self.prune()
+
+    def free_bytes(self):
+        ''' Free space on the archive's filesystem (bytes), or None if it cannot be read. '''
+        try:
+            _stat = os.statvfs(self.directory)
+            return _stat.f_bavail*_stat.f_frsize
+        except (AttributeError, OSError):
+            return None
+
+    def prune(self):
+        ''' Remove the oldest archived files until the archive is within max_bytes, and the disk has min_free_bytes free. '''
+        _free = self.free_bytes()
+        while len(self.entries) > 0:
+            _over_budget = (self.max_bytes != None) and (self.total_bytes > self.max_bytes)
+            _low_space = (self.min_free_bytes != None) and (_free != None) and (_free < self.min_free_bytes)
+            if not (_over_budget or _low_space):
+                break
+            (_name, _size) = self.entries.popitem(last=False)
+            self.total_bytes -= _size
+            self.pruned += 1
+            self.discard(os.path.join(self.directory, _name))
+            if _free != None:
+                _free += _size
+
+    def stats(self):
+        return {
+            'archived': self.archived,
+            'dropped': self.dropped,
+            'skipped': self.skipped,
+            'pruned': self.pruned,
+            'tagged': self.tagged,
+            'stale': self.stale,
+            'failed': self.failed,
+            'batches': self.batches,
+            'queued': self.queue.qsize(),
+            'max_queue_depth': self.max_queue_depth,
+            'entries': len(self.entries),
+            'bytes': self.total_bytes
+        }
+
+
+def benchmark_archive(files=20, size=3*1024*1024):
+    ''' Compare the time the capture loop spends archiving each file: a synchronous copy and fsync, against
+    queueing it for the ArchiveWriter. Also reports the time the writer takes to archive the files. '''
+    _dir = tempfile.mkdtemp()
+    _data = os.urandom(size)
+
+    _sync_dir = os.path.join(_dir, 'sync')
+    os.makedirs(_sync_dir)
+    _sync_times = []
+    for i in range(files):
+        _src = os.path.join(_dir, 'capture_%d.jpg' % i)
+        with open(_src, 'wb') as _f:
+            _f.write(_data)
+        _sync_start = time.monotonic()
+        _dest = os.path.join(_sync_dir, 'capture_%d.jpg' % i)
+        shutil.copyfile(_src, _dest)
+        _fd = os.open(_dest, os.O_RDONLY)
+        os.fsync(_fd)
+        os.close(_fd)
+        os.remove(_src)
+        _sync_times.append(time.monotonic() - _sync_start)
+
+    _archive = ArchiveWriter(directory=os.path.join(_dir, 'archive'), max_bytes=(files//2)*size, debug_ptr=lambda x: None)
+    _archive.start()
+    _put_times = []
+    _start = time.monotonic()
+    for i in range(files):
+        # Captures are written straight into the incoming directory, so archiving them needs no copy.
+        _src = os.path.join(_archive.incoming, 'capture_%d.jpg' % i)
+        with open(_src, 'wb') as _f:
+            _f.write(_data)
+        _put_start = time.monotonic()
+        _archive.put(_src, remove=True)
+        _put_times.append(time.monotonic() - _put_start)
+    _archive.stop()
+    _writer_time = time.monotonic() - _start
+
+    print("%d x %.1f MB files. Synchronous copy + fsync: %.1f ms per file on the capture loop (max %.1f ms)." % (
+        files, size/1048576.0, 1000*sum(_sync_times)/files, 1000*max(_sync_times)))
+    print("ArchiveWriter: %.3f ms per file on the capture loop (max %.3f ms), %.2f s to archive all files. %s" % (
+        1000*sum(_put_times)/files, 1000*max(_put_times), _writer_time, str(_archive.stats())))
+    shutil.rmtree(_dir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("directory", nargs='?', default='./tx_images', help="Archive directory.")
+    parser.add_argument("--benchmark", action="store_true", default=False, help="Compare synchronous and background archiving, then exit.")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark_archive()
+        sys.exit(0)
+
+    _archive = ArchiveWriter(directory=args.directory)
+    print("%s: %d files, %.1f MB, %.1f MB free." % (args.directory, len(_archive.entries), _archive.total_bytes/1048576.0,
+        (_archive.free_bytes() or 0)/1048576.0))
@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+'''
+GPS EXIF tagging of JPEGs, without re-encoding them.
+
+The GPS tags (latitude, longitude, altitude, and the fix date and time) are spliced into the JPEG
+byte stream at the marker level: the header segments are parsed, the Exif APP1 segment is replaced
+(or inserted), and the rest of the file (the entropy-coded image data) is copied as-is. Tagging an
+8MP image costs a few kilobytes of header work, plus one sequential copy of the file.
+
+If the camera has already written an Exif segment (as picamera does), its contents are kept: a new
+copy of IFD0 with a GPSInfo pointer, and the GPS IFD, are appended to the end of the TIFF structure,
+and the TIFF header is pointed at the new IFD0. Nothing else moves, so every existing offset stays valid.
+
+Released under GNU GPL version 3 or later
+'''
+
+import argparse
+import datetime
+import os
+import shutil
+import struct
+import sys
+import time
+
+# TIFF field types.
+TIFF_BYTE = 1
+TIFF_ASCII = 2
+TIFF_SHORT = 3
+TIFF_LONG = 4
+TIFF_RATIONAL = 5
+
+TAG_GPS_IFD = 0x8825
+EXIF_HEADER = b'Exif\x00\x00'
+
+
+def _rationals(values, endian, denominator=10000):
+    ''' Pack a list of non-negative numbers as TIFF RATIONALs. '''
+    return b''.join([struct.pack(endian + 'II', int(round(_v*denominator)), denominator) for _v in values])
+
+
+def _dms(value):
+    ''' Split decimal degrees into (degrees, minutes, seconds), rounded to 1/10000 of a second. '''
+    # Work in integer units of 1/10000 s, so rounding can't produce 60 seconds or minutes.
+    _total = int(round(abs(value)*3600*10000))
+    return (_total//36000000, (_total//600000) % 60, (_total % 600000)/10000.0)
+
+
+def gps_entries(position, endian):
+    ''' GPS IFD entries, as (tag, type, count, value bytes), for a position dictionary
+    (as returned by UBloxGPS.position_at()). The fix time is only included if 'datetime' is present. '''
+    _entries = [
+        (0x0000, TIFF_BYTE, 4, b'\x02\x03\x00\x00'),                               # GPSVersionID
+        (0x0001, TIFF_ASCII, 2, b'N\x00' if position['latitude'] >= 0 else b'S\x00'), # GPSLatitudeRef
+        (0x0002, TIFF_RATIONAL, 3, _rationals(_dms(position['latitude']), endian)),  # GPSLatitude
+        (0x0003, TIFF_ASCII, 2, b'E\x00' if position['longitude'] >= 0 else b'W\x00'), # GPSLongitudeRef
+        (0x0004, TIFF_RATIONAL, 3, _rationals(_dms(position['longitude']), endian)), # GPSLongitude
+    ]
+    if position.get('altitude') != None:
+        _entries.append((0x0005, TIFF_BYTE, 1, b'\x00' if position['altitude'] >= 0 else b'\x01'))  # GPSAltitudeRef
+        _entries.append((0x0006, TIFF_RATIONAL, 1, _rationals([abs(position['altitude'])], endian, 100)))  # GPSAltitude
+    if position.get('datetime') != None:
+        _time = position['datetime']
+        _entries.append((0x0007, TIFF_RATIONAL, 3, _rationals([_time.hour, _time.minute, _time.second + _time.microsecond/1e6], endian, 1000)))  # GPSTimeStamp
+    _entries.append((0x0012, TIFF_ASCII, 7, b'WGS-84\x00'))                          # GPSMapDatum
+    if position.get('datetime') != None:
+        _entries.append((0x001D, TIFF_ASCII, 11, position['datetime'].strftime("%Y:%m:%d").encode('ascii') + b'\x00'))  # GPSDateStamp
+    return _entries
+
+
+def pack_ifd(entries, offset, next_ifd, endian):
+    ''' Pack an IFD, to be placed at offset (from the start of the TIFF header). Entries are (tag, type, count,
+    value bytes), or (tag, raw 12-byte entry) to copy an existing entry verbatim. Values longer than 4 bytes
+    are placed after the IFD. Returns the IFD bytes. '''
+    entries = sorted(entries, key=lambda _entry: _entry[0])
+    _data_offset = offset + 2 + 12*len(entries) + 4
+    _ifd = struct.pack(endian + 'H', len(entries))
+    _data = b''
+    for _entry in entries:
+        if len(_entry) == 2:
+            _ifd += _entry[1]
+            continue
+        (_tag, _type, _count, _value) = _entry
+        if len(_value) <= 4:
+            _ifd += struct.pack(endian + 'HHI', _tag, _type, _count) + _value.ljust(4, b'\x00')
+        else:
+            _ifd += struct.pack(endian + 'HHII', _tag, _type, _count, _data_offset + len(_data))
+            _data += _value
+            if len(_data) % 2:
+                _data += b'\x00'
+    return _ifd + struct.pack(endian + 'I', next_ifd) + _data
+
+
+def exif_with_gps(exif, position):
+    ''' Add GPS tags to an Exif APP1 payload (starting with the Exif header), or create one if exif is None.
+    Any existing GPS IFD is replaced. Returns the new payload. '''
+    if exif is None:
+        _endian = '<'
+        _tiff = b'II' + struct.pack('<HI', 42, 8)
+        _ifd0_entries = []
+        _next_ifd = 0
+    else:
+        _tiff = exif[len(EXIF_HEADER):]
+        if _tiff[:2] == b'II':
+            _endian = '<'
+        elif _tiff[:2] == b'MM':
+            _endian = '>'
+        else:
+            raise ValueError("Invalid TIFF header in Exif segment.")
+        _ifd0 = struct.unpack(_endian + 'I', _tiff[4:8])[0]
+        _count = struct.unpack(_endian + 'H', _tiff[_ifd0:_ifd0 + 2])[0]
+        _ifd0_entries = []
+        for i in range(_count):
+            _raw = _tiff[_ifd0 + 2 + 12*i:_ifd0 + 14 + 12*i]
+            _tag = struct.unpack(_endian + 'H', _raw[:2])[0]
+            if _tag != TAG_GPS_IFD:
+                _ifd0_entries.append((_tag, _raw))
+        _next_ifd = struct.unpack(_endian + 'I', _tiff[_ifd0 + 2 + 12*_count:_ifd0 + 6 + 12*_count])[0]
+        if len(_tiff) % 2:
+            _tiff += b'\x00'
+
+    # New IFD0 (existing entries plus the GPSInfo pointer), then the GPS IFD, appended to the TIFF structure.
+    _new_ifd0 = len(_tiff)
+    _gps_ifd = _new_ifd0 + 2 + 12*(len(_ifd0_entries) + 1) + 4
+    _ifd0_entries.append((TAG_GPS_IFD, TIFF_LONG, 1, struct.pack(_endian + 'I', _gps_ifd)))
+    _tiff = (_tiff[:4] + struct.pack(_endian + 'I', _new_ifd0) + _tiff[8:] +
+        pack_ifd(_ifd0_entries, _new_ifd0, _next_ifd, _endian) +
+        pack_ifd(gps_entries(position, _endian), _gps_ifd, 0, _endian))
+    return EXIF_HEADER + _tiff
+
+
+def read_header(f):
+    ''' Read a JPEG's header segments (up to the first segment which is not APPn or COM).
+    Returns (list of (marker, payload), the bytes of the marker which ended the header). '''
+    if f.read(2) != b'\xff\xd8':
+        raise ValueError("Not a JPEG file.")
+    _segments = []
+    while True:
+        _marker = f.read(2)
+        if len(_marker) < 2 or _marker[0] != 0xff:
+            raise ValueError("Invalid JPEG marker.")
+        # Skip fill bytes.
+        while _marker[1] == 0xff:
+            _marker = b'\xff' + f.read(1)
+        if not ((0xe0 <= _marker[1] <= 0xef) or (_marker[1] == 0xfe)):
+            return (_segments, _marker)
+        _length = struct.unpack('>H', f.read(2))[0]
+        _segments.append((_marker, f.read(_length - 2)))
+
+
+def add_gps_exif(filename, dest_filename, position):
+    ''' Copy a JPEG, with GPS tags for position (a dictionary with 'latitude', 'longitude', and optionally 'altitude'
+    and 'datetime') added to its Exif segment. Only the header is parsed: the image data is copied unchanged.
+    Returns the number of bytes added. '''
+    with open(filename, 'rb') as _src:
+        (_segments, _end_marker) = read_header(_src)
+
+        _exif = None
+        for (_marker, _payload) in _segments:
+            if (_marker == b'\xff\xe1') and _payload.startswith(EXIF_HEADER):
+                _exif = _payload
+                break
+        _new_exif = exif_with_gps(_exif, position)
+        if len(_new_exif) + 2 > 0xffff:
+            raise ValueError("Exif segment too large.")
+        _app1 = b'\xff\xe1' + struct.pack('>H', len(_new_exif) + 2) + _new_exif
+
+        _header = b'\xff\xd8'
+        if _exif is None:
+            # The Exif segment goes straight after the SOI marker, or after a JFIF APP0 segment.
+            if (len(_segments) > 0) and (_segments[0][0] == b'\xff\xe0'):
+                _header += _segments[0][0] + struct.pack('>H', len(_segments[0][1]) + 2) + _segments[0][1]
+                _segments = _segments[1:]
+            _header += _app1
+        for (_marker, _payload) in _segments:
+            if _payload is _exif:
+                _header += _app1
+            else:
+                _header += _marker + struct.pack('>H', len(_payload) + 2) + _payload
+
+        with open(dest_filename, 'wb') as _dest:
+            _dest.write(_header + _end_marker)
+            shutil.copyfileobj(_src, _dest, 1024*1024)
+
+    return len(_new_exif) - (len(_exif) if _exif != None else -4)
+
+
+def tag_file(filename, position):
+    ''' Add GPS tags to a JPEG in place (via a temporary file). Returns the number of bytes added. '''
+    _temp = filename + ".exif"
+    try:
+        _added = add_gps_exif(filename, _temp, position)
+        os.rename(_temp, filename)
+    except:
+        if os.path.exists(_temp):
+            os.remove(_temp)
+        raise
+    return _added
+
+
+def read_gps(filename):
+    ''' Read back the GPS tags of a JPEG (using PIL). Returns a dictionary of GPS tag number -> value. '''
+    from PIL import Image
+    return dict(Image.open(filename).getexif().get_ifd(TAG_GPS_IFD))
+
+
+def benchmark_exif(resolution=(3280,2464)):
+    ''' Tag a full-size JPEG (with a camera-style Exif segment) by splicing, and by decoding and re-encoding it with
+    PIL. Checks that the image data is unchanged and the GPS tags read back, and reports the time taken by each. '''
+    import tempfile
+    from PIL import Image
+
+    _dir = tempfile.mkdtemp()
+    _src = os.path.join(_dir, 'picam.jpg')
+    _image = Image.effect_noise(resolution, 40).convert('RGB')
+    _exif = Image.Exif()
+    _exif[0x010f] = "RaspberryPi"   # Make
+    _exif[0x0110] = "RP_imx219"     # Model
+    _image.save(_src, 'JPEG', quality=85, exif=_exif.tobytes())
+    _position = {'latitude': -34.91734, 'longitude': 138.62372, 'altitude': 25103.4,
+        'datetime': datetime.datetime(2018, 12, 1, 3, 14, 15, 926000)}
+
+    _tagged = os.path.join(_dir, 'tagged.jpg')
+    _start = time.perf_counter()
+    _added = add_gps_exif(_src, _tagged, _position)
+    _splice_time = time.perf_counter() - _start
+
+    _start = time.perf_counter()
+    _gps = read_gps(_tagged)
+    _read_time = time.perf_counter() - _start
+
+    with open(_src, 'rb') as _f:
+        _original = _f.read()
+    with open(_tagged, 'rb') as _f:
+        _spliced = _f.read()
+    # Everything from the first non-APP segment on (tables, frame header and scan data) should be unchanged.
+    _unchanged = _spliced.endswith(_original[_original.index(b'\xff\xdb'):])
+
+    _start = time.perf_counter()
+    _reencoded = Image.open(_src)
+    _reencoded.save(os.path.join(_dir, 'reencoded.jpg'), 'JPEG', quality=85, exif=_reencoded.getexif().tobytes())
+    _reencode_time = time.perf_counter() - _start
+
+    print("%dx%d JPEG (%.1f MB): splice %.1f ms (%d bytes added), image data unchanged: %s. PIL decode + re-encode: %.0f ms." % (
+        resolution[0], resolution[1], len(_original)/1048576.0, _splice_time*1000, _added, _unchanged, _reencode_time*1000))
+    print("Make: %s, GPS read back (%.1f ms): %s" % (Image.open(_tagged).getexif().get(0x010f), _read_time*1000, str(_gps)))
+    shutil.rmtree(_dir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("filename", nargs='?', default=None, help="JPEG to tag (in place), or to read the GPS tags of.")
+    parser.add_argument("--lat", type=float, default=None, help="Latitude (decimal degrees).")
+    parser.add_argument("--lon", type=float, default=None, help="Longitude (decimal degrees).")
+    parser.add_argument("--alt", type=float, default=None, help="Altitude (metres).")
+    parser.add_argument("--benchmark", action="store_true", default=False, help="Compare splicing against re-encoding, then exit.")
+    args = parser.parse_args()
+
+    if args.benchmark or args.filename is None:
+        benchmark_exif()
+        sys.exit(0)
+
+    if (args.lat != None) and (args.lon != None):
+        tag_file(args.filename, {'latitude': args.lat, 'longitude': args.lon, 'altitude': args.alt,
+            'datetime': datetime.datetime.utcnow()})
+    print(read_gps(args.filename))
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+'''
+Exposure convergence detection for the PiCam.
+
+Rather than waiting a fixed time for the camera's gain control to settle, ExposureMonitor samples the
+camera's analog_gain, digital_gain and exposure_speed, and returns as soon as they have stopped changing.
+The exposure (and optionally the white balance) can then be locked for a burst of captures, so the frames
+are directly comparable, and can be captured back-to-back.
+
+Works with a picamera.PiCamera, or with picam_sim.SimulatedCamera.
+
+Released under GNU GPL version 3 or later
+'''
+
+from collections import deque
+from time import sleep, monotonic
+
+
+class ExposureMonitor(object):
+    ''' Waits for a camera's gains and exposure time to converge, and locks/unlocks them. '''
+
+    def __init__(self,
+                camera,
+                tolerance=0.02,
+                stable_samples=3,
+                interval=0.1,
+                timeout=5.0,
+                lock_awb=True,
+                debug_ptr=None):
+        ''' Initialise an ExposureMonitor.
+
+        Keyword Arguments:
+        camera: A PiCamera (or SimulatedCamera) object, with its preview started.
+        tolerance: Maximum relative change (e.g. 0.02 = 2%) of each value over stable_samples sample intervals,
+                   for it to be considered settled. (Comparing over several intervals, rather than between consecutive
+                   samples, catches slow convergence.)
+        stable_samples: Number of sample intervals over which the values must be within tolerance.
+        interval: Time (seconds) between samples.
+        timeout: Maximum time (seconds) to wait for the exposure to settle.
+        lock_awb: If True, lock_exposure() also locks the white balance gains.
+        debug_ptr: Reference to a function which can handle debug messages.
+        '''
+        self.camera = camera
+        self.tolerance = tolerance
+        self.stable_samples = stable_samples
+        self.interval = interval
+        self.timeout = timeout
+        self.lock_awb = lock_awb
+        self.debug_ptr = debug_ptr
+
+        self.locked = False
+        # Exposure and AWB modes to restore on unlock.
+        self.saved_modes = None
+
+        # Time to settle (seconds) of each call to wait_settled(), and the number of timeouts.
+        self.settle_times = []
+        self.timeouts = 0
+
+    def debug_message(self, message):
+        ''' Write a debug message, either to the debug_ptr function, or to stdout. '''
+        message = "Exposure Monitor: " + message
+        if self.debug_ptr != None:
+            self.debug_ptr(message)
+        else:
+            print(message)
+
+    def sample(self):
+        ''' Read the current (analog gain, digital gain, exposure time (us)). '''
+        return (float(self.camera.analog_gain), float(self.camera.digital_gain), float(self.camera.exposure_speed))
+
+    def settled(self, samples):
+        ''' Check if every value has stayed within tolerance (relative to its largest value) across a list of samples. '''
+        for _values in zip(*samples):
+            if max(_values) - min(_values) > self.tolerance*max(max([abs(_v) for _v in _values]), 1e-6):
+                return False
+        return True
+
+    def wait_settled(self):
+        ''' Wait until the gains and exposure time have stopped changing (or the timeout expires).
+        If the exposure is locked, returns immediately. Returns the time taken (seconds). '''
+        _start = monotonic()
+        if self.locked:
+            return 0.0
+
+        _samples = deque([self.sample()], maxlen=self.stable_samples + 1)
+        while (len(_samples) < _samples.maxlen) or (not self.settled(_samples)):
+            if monotonic() - _start > self.timeout:
+                self.timeouts += 1
+                self.debug_message("Exposure did not settle within %.1f s (gains %.2f/%.2f, exposure %d us)." % (
+                    self.timeout, _samples[-1][0], _samples[-1][1], _samples[-1][2]))
+                break
+            sleep(self.interval)
+            _samples.append(self.sample())
+
+        _settle_time = monotonic() - _start
+        self.settle_times.append(_settle_time)
+        self.settle_times = self.settle_times[-100:]
+        return _settle_time
+
+    def lock_exposure(self):
+        ''' Fix the shutter speed and gains (and white balance) at their current values. '''
+        if self.locked:
+            return
+        self.saved_modes = (self.camera.exposure_mode, self.camera.awb_mode)
+        self.camera.shutter_speed = int(self.camera.exposure_speed)
+        # With exposure_mode 'off', the gains stay at their current values.
+        self.camera.exposure_mode = 'off'
+        if self.lock_awb:
+            _gains = self.camera.awb_gains
+            self.camera.awb_mode = 'off'
+            self.camera.awb_gains = _gains
+        self.locked = True
+
+    def unlock_exposure(self):
+        ''' Return to automatic exposure (and the previous white balance mode). '''
+        if not self.locked:
+            return
+        (_exposure_mode, _awb_mode) = self.saved_modes
+        self.camera.shutter_speed = 0
+        self.camera.exposure_mode = _exposure_mode
+        if self.lock_awb:
+            self.camera.awb_mode = _awb_mode
+        self.locked = False
+
+    def stats(self):
+        return {
+            'settle_time': self.settle_times[-1] if len(self.settle_times) > 0 else None,
+            'mean_settle_time': sum(self.settle_times)/len(self.settle_times) if len(self.settle_times) > 0 else None,
+            'timeouts': self.timeouts
+        }
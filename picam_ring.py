@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+'''
+Continuous-capture ring buffer of recent PiCam frames.
+
+Each still capture goes through a mode switch of the camera's still port, which costs hundreds of
+milliseconds per frame. FrameRing instead runs the camera continuously on the video port, keeping a
+small ring of recent frames, decimated in time (one every interval seconds) and in size (to resolution,
+which only needs to be large enough for the SSTV modes in use), each with the time it was captured.
+When an image is needed, the best recent frame is picked immediately, and a full resolution still can
+be taken afterwards, for the archive only.
+
+Works with a picamera.PiCamera, or with picam_sim.SimulatedCamera.
+
+Released under GNU GPL version 3 or later
+'''
+
+import io
+from collections import deque
+from threading import Thread, Lock
+from time import sleep, monotonic
+
+
+class FrameRing(object):
+    ''' Captures frames from the camera's video port in a thread, keeping the most recent ones. '''
+
+    def __init__(self,
+                camera,
+                resolution=(1024,768),
+                interval=0.25,
+                length=16,
+                quality=90,
+                debug_ptr=None):
+        ''' Initialise a FrameRing. Call start() to begin capturing.
+
+        Keyword Arguments:
+        camera: A PiCamera (or SimulatedCamera) object, with its preview started.
+        resolution: Size to scale frames to (on the GPU). Should be at least the largest SSTV mode resolution in use.
+        interval: Time (seconds) between frames kept in the ring.
+        length: Number of frames to keep. The ring covers the last length*interval seconds.
+        quality: JPEG quality of the frames.
+        debug_ptr: Reference to a function which can handle debug messages.
+        '''
+        self.camera = camera
+        self.resolution = resolution
+        self.interval = interval
+        self.quality = quality
+        self.debug_ptr = debug_ptr
+
+        # Recent frames, oldest first. Each frame is a tuple of (capture time (time.monotonic()), score, JPEG data).
+        # The score is the JPEG size. All frames in the ring have the same resolution and quality, so this ranks them
+        # without re-encoding them. The selected frame is scored with image_score() before it is compared with stills.
+        self.frames = deque(maxlen=length)
+        # Held while a frame is being captured. Take this to use the camera's still port.
+        self.lock = Lock()
+
+        self.running = False
+        self.thread = None
+        self.frame_count = 0
+        self.error = None
+
+    def debug_message(self, message):
+        ''' Write a debug message, either to the debug_ptr function, or to stdout. '''
+        message = "Frame Ring: " + message
+        if self.debug_ptr != None:
+            self.debug_ptr(message)
+        else:
+            print(message)
+
+    def start(self):
+        ''' Start capturing frames in a thread. '''
+        if self.running:
+            return
+        self.running = True
+        self.error = None
+        self.thread = Thread(target=self.capture_loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        ''' Stop capturing frames, and wait for the capture thread to exit. '''
+        self.running = False
+        if self.thread != None:
+            self.thread.join()
+            self.thread = None
+
+    def capture_loop(self):
+        _stream = io.BytesIO()
+        try:
+            _frames = self.camera.capture_continuous(_stream, format='jpeg', use_video_port=True,
+                resize=self.resolution, quality=self.quality)
+            while self.running:
+                with self.lock:
+                    # The video port returns the next frame from the sensor, so the frame was exposed just after this.
+                    _time = monotonic()
+                    next(_frames)
+                _data = _stream.getvalue()
+                _stream.seek(0)
+                _stream.truncate()
+
+                self.frames.append((_time, len(_data), _data))
+                self.frame_count += 1
+                sleep(max(0, self.interval - (monotonic() - _time)))
+            _frames.close()
+        except Exception as e:
+            self.error = str(e)
+            self.debug_message("ERROR: Capture failed - %s" % str(e))
+        self.running = False
+
+    def best_frame(self, max_age=3.0):
+        ''' Pick the best (highest scoring) frame captured within the last max_age seconds.
+        Returns a (capture time, score, JPEG data) tuple, or None if there are no recent frames. '''
+        _now = monotonic()
+        _recent = [_frame for _frame in list(self.frames) if _now - _frame[0] <= max_age]
+        if len(_recent) == 0:
+            return None
+        return max(_recent, key=lambda _frame: _frame[1])
+
+    def capture_still(self, filename):
+        ''' Capture a full resolution still from the still port, pausing the ring while it is taken. '''
+        with self.lock:
+            self.camera.capture(filename)
+
+    def stats(self):
+        return {
+            'running': self.running,
+            'frames': self.frame_count,
+            'buffered': len(self.frames),
+            'buffered_bytes': sum([_frame[1] for _frame in list(self.frames)]),
+            'error': self.error
+        }
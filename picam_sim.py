@@ -0,0 +1,466 @@
+#!/usr/bin/env python
+'''
+Simulated camera and SSTVPiCam, and timing benchmarks of the capture and transmit pipeline, for testing off-Pi.
+
+SimulatedCamera stands in for a picamera.PiCamera (including its exposure convergence and video port),
+and SimulatedSSTVPiCam replaces the image conversion and audio playback with fixed delays. The benchmarks
+run against these, with simulated GPIO and DRA818 modules (see dra818.py):
+
+    python picam_sim.py --simulate [--power-save] [--radios 2] [--dedup] [--archive] [--repeat 3]
+    python picam_sim.py --settle
+    python picam_sim.py --ring
+    python picam_sim.py --recovery
+
+Released under GNU GPL version 3 or later
+'''
+
+import argparse
+import datetime
+import glob
+import math
+import os
+import random
+import sys
+import tempfile
+from time import sleep, monotonic
+
+from PIL import Image
+from PIL import ImageDraw
+
+from dra818 import *
+from picam_archive import ArchiveWriter
+from picam_exif import read_gps
+from picam_sstv import SSTVPiCam
+from sstv_best import BestImageStore
+from sstv_dedup import DuplicateFilter
+
+
+class SimulatedCamera(object):
+    """ Simulated stand-in for a PiCamera object, for testing off-Pi.
+    Captured images are small JPEGs, partly random noise, so their scores vary and the burst selection has something
+    to choose, or if scene_ptr is set, JPEGs of the PIL Image it returns.
+    Still captures take capture_time (the still port mode switch), and video port frames (capture_continuous) frame_time.
+    If fail_after is set, captures fail (as if the camera had stopped responding) after that many images and frames.
+
+    The analog_gain, digital_gain and exposure_speed values converge exponentially (with time constant
+    settle_time) towards values set by the scene brightness, after the preview starts, the brightness
+    changes (see set_brightness()), or automatic exposure is re-enabled. With exposure_mode 'off', they are frozen.
+    """
+
+    def __init__(self, capture_time=0.3, scene_ptr=None, settle_time=0.8, brightness=1.0, frame_time=1/30.0, fail_after=None):
+        self.capture_time = capture_time
+        self.frame_time = frame_time
+        self.fail_after = fail_after
+        self.captures = 0
+        self.scene_ptr = scene_ptr
+        self.settle_time = settle_time
+        self.resolution = (3280,2464)
+        self.hflip = False
+        self.vflip = False
+        self._exposure_mode = 'auto'
+        self.awb_mode = 'auto'
+        self.awb_gains = (1.5, 1.2)
+        self.shutter_speed = 0
+        self.meter_mode = 'average'
+        self.previewing = False
+        self.closed = False
+
+        # (analog gain, digital gain, exposure time (us)): at the start of convergence, and the target.
+        self._start_values = (1.0, 1.0, 1000.0)
+        self._target_values = self.target_values(brightness)
+        self._converge_start = monotonic()
+        self._frozen = None
+        # (values, target values) at each capture.
+        self.captured_values = []
+
+    def target_values(self, brightness):
+        """ Settled gains and exposure time for a scene brightness (1.0 = nominal). """
+        return (min(8.0, 2.0/brightness), min(4.0, max(1.0, 1.2/brightness)), min(33000.0, 8000.0/brightness))
+
+    def _values(self):
+        if self._frozen != None:
+            return self._frozen
+        _fraction = math.exp(-(monotonic() - self._converge_start)/self.settle_time) if self.previewing else 1.0
+        return tuple([_target + (_start - _target)*_fraction for (_start, _target) in zip(self._start_values, self._target_values)])
+
+    def _restart_convergence(self, target=None):
+        self._start_values = self._values()
+        self._frozen = None
+        if target != None:
+            self._target_values = target
+        self._converge_start = monotonic()
+
+    def set_brightness(self, brightness):
+        """ Change the scene brightness. The gains start converging to new values. """
+        if self._frozen != None:
+            self._target_values = self.target_values(brightness)
+        else:
+            self._restart_convergence(self.target_values(brightness))
+
+    @property
+    def analog_gain(self):
+        return self._values()[0]
+
+    @property
+    def digital_gain(self):
+        return self._values()[1]
+
+    @property
+    def exposure_speed(self):
+        return int(self._values()[2])
+
+    @property
+    def exposure_mode(self):
+        return self._exposure_mode
+
+    @exposure_mode.setter
+    def exposure_mode(self, mode):
+        if mode == 'off':
+            self._frozen = self._values()
+        elif self._frozen != None:
+            self._restart_convergence()
+        self._exposure_mode = mode
+
+    def start_preview(self):
+        self.previewing = True
+        self._restart_convergence()
+
+    def _check(self):
+        if self.closed:
+            raise RuntimeError("Camera is closed")
+        if (self.fail_after != None) and (self.captures >= self.fail_after):
+            raise RuntimeError("Simulated camera failure")
+        self.captures += 1
+
+    def noise_image(self, resolution=(64,48)):
+        """ A flat grey image, with a random number of rows of noise. """
+        (_width, _height) = resolution
+        _rows = random.randint(1, _height)
+        return Image.frombytes('L', resolution, os.urandom(_width*_rows) + bytes([128])*(_width*(_height - _rows)))
+
+    def capture(self, output, use_video_port=False, resize=None, **kwargs):
+        self._check()
+        if not use_video_port:
+            self.captured_values.append((self._values(), self._target_values))
+        sleep(self.frame_time if use_video_port else self.capture_time)
+        if self.scene_ptr != None:
+            _scene = self.scene_ptr()
+            if resize != None:
+                _scene = _scene.resize(resize)
+            _scene.save(output, 'JPEG')
+            return
+        self.noise_image().save(output, 'JPEG')
+
+    def capture_continuous(self, output, format='jpeg', use_video_port=False, resize=None, **kwargs):
+        while True:
+            self._check()
+            sleep(self.frame_time)
+            output.seek(0)
+            if self.scene_ptr != None:
+                _scene = self.scene_ptr()
+                if resize != None:
+                    _scene = _scene.resize(resize)
+                _scene.save(output, 'JPEG')
+            else:
+                self.noise_image().save(output, 'JPEG')
+            yield output
+
+    def close(self):
+        self.closed = True
+
+
+class SimulatedSSTVPiCam(SSTVPiCam):
+    """ SSTVPiCam with a simulated camera, image conversion and audio playback, for timing tests off-Pi.
+    Audio 'playback' takes airtime seconds. """
+
+    def __init__(self, airtime=2.0, encode_time=1.0, **kwargs):
+        self.airtime = airtime
+        self.encode_time = encode_time
+        # Number of resize and encode operations performed.
+        self.resize_count = 0
+        self.encode_count = 0
+        if kwargs.get('camera') is None:
+            kwargs['camera'] = SimulatedCamera()
+        kwargs.setdefault('camera_factory', SimulatedCamera)
+        # Don't query the (possibly real) audio device.
+        kwargs.setdefault('sample_rate', 22050)
+        SSTVPiCam.__init__(self, **kwargs)
+
+    def resize(self, filename="output.jpg", dest_filename="picam_temp.png", resolution=None):
+        self.resize_count += 1
+        os.system("cp %s %s" % (filename, dest_filename))
+        return True
+
+    def sstvify(self, filename, temp_filename="picam_temp.png", tx_mode=None):
+        self.encode_count += 1
+        sleep(self.encode_time)
+        open(temp_filename + ".wav", 'wb').close()
+        return temp_filename + ".wav"
+
+    def play_audio(self, filename, device=None):
+        sleep(self.airtime)
+        return 0
+
+
+def benchmark_ptt_timing(num_images=3, airtime=2.0, delay=1.0, ptt_delay=2.0, power_save=False, num_radios=1, repeat_every=0, dedup=False, archive=False):
+    """ Run auto_capture against simulated GPIO, camera and audio, and report the
+    PTT-on to audio-start latency, the audio-end to PTT-off tail time, and the PTT duty cycle.
+    If power_save is set, the simulated radio is powered down between transmissions.
+    If num_radios is more than 1, transmit on that many simulated DRA818Radios at once (alternating
+    between PD120 and Robot 36), and report the timing of each, and the number of encodes per image.
+    If repeat_every is non-zero, every repeat_every'th transmission is a repeat from a BestImageStore.
+    If dedup is set, the simulated camera sees a scene which only changes every 15 seconds, and a DuplicateFilter
+    skips the repeated frames.
+    If archive is set, the captured images are archived (and GPS tagged with a simulated ascent) by an ArchiveWriter. """
+
+    _gpio = SimulatedGPIO()
+    set_gpio_backend(_gpio)
+    dra818_setup_io()
+
+    # Without power saving, a single radio is driven via the default pin set.
+    _radios = None
+    if (num_radios > 1) or power_save:
+        _radios = []
+        for i in range(num_radios):
+            # Each radio gets its own set of (simulated) pins.
+            if num_radios > 1:
+                _pins = dict(ptt_pin=100+4*i, sq_pin=101+4*i, hl_pin=102+4*i, pd_pin=103+4*i)
+            else:
+                _pins = dict(ptt_pin=DRA818_PTT, sq_pin=DRA818_SQ, hl_pin=DRA818_HL, pd_pin=DRA818_PD)
+            _radio = DRA818Radio(name='radio%d' % i,
+                port=SimulatedDRA818Serial(gpio=_gpio, pd_pin=_pins['pd_pin']) if power_save else None,
+                audio_device=('plughw:%d,0' % i) if num_radios > 1 else None,
+                tx_mode=['pd120', 'r36'][i % 2] if num_radios > 1 else None,
+                power_save=power_save,
+                gpio=_gpio,
+                debug_ptr=lambda x: None,
+                **_pins)
+            _radio.setup_io()
+            _radios.append(_radio)
+
+    _tx_count = [0]
+    def _post_tx():
+        _tx_count[0] += 1
+
+    _dir = tempfile.mkdtemp()
+    _camera = None
+    _duplicate_filter = None
+    if dedup:
+        _scenes = [Image.new('RGB', (640, 480), _colour) for _colour in [(200, 40, 40), (40, 200, 40), (40, 40, 200)]]
+        for (i, _scene) in enumerate(_scenes):
+            ImageDraw.Draw(_scene).rectangle([(100*i, 50), (100*i + 300, 300)], fill=(255, 255, 255))
+        _start = monotonic()
+        _camera = SimulatedCamera(scene_ptr=lambda: _scenes[int((monotonic() - _start)//15) % len(_scenes)])
+        _duplicate_filter = DuplicateFilter(debug_ptr=lambda x: None)
+
+    _archive = None
+    _position_ptr = None
+    if archive:
+        _archive = ArchiveWriter(directory=os.path.join(_dir, 'archive'), max_bytes=None, min_free_bytes=200*1024*1024, debug_ptr=lambda x: None)
+        _archive.start()
+        # Climbing at 5 m/s.
+        _launch = monotonic()
+        _position_ptr = lambda t: {'latitude': -34.9, 'longitude': 138.6, 'altitude': 100.0 + 5.0*(t - _launch),
+            'datetime': datetime.datetime.utcnow() - datetime.timedelta(seconds=monotonic() - t)}
+        if _camera is None:
+            _camera = SimulatedCamera(scene_ptr=lambda: Image.new('RGB', (640, 480), (40, 120, 200)))
+
+    _best_store = None
+    if repeat_every > 0:
+        _best_store = BestImageStore(directory=os.path.join(_dir, 'best'), capacity=3, repeat_every=repeat_every, debug_ptr=lambda x: None)
+    _picam = SimulatedSSTVPiCam(airtime=airtime, ptt_delay=ptt_delay, num_images=2, image_delay=0.1,
+        temp_filename_prefix=os.path.join(_dir, 'picam_temp'), debug_ptr=lambda x: None,
+        radios=_radios, best_store=_best_store,
+        camera=_camera, duplicate_filter=_duplicate_filter, archive=_archive, position_ptr=_position_ptr)
+
+    _picam.run(destination_directory=_dir, post_tx_function=_post_tx, delay=delay)
+    while _tx_count[0] < num_images:
+        sleep(0.1)
+    _picam.stop()
+    _picam.capture_thread.join()
+
+    if _duplicate_filter != None:
+        _stats = _duplicate_filter.stats()
+        print("%d images transmitted, %d of %d captured images skipped as duplicates. %.1f s airtime saved." % (
+            _tx_count[0], _stats['skipped'], _stats['checked'], _stats['airtime_saved']))
+
+    if _best_store != None:
+        _repeats = sum([_entry['sent'] for _entry in _best_store.entries.values()])
+        print("%d transmissions, %d of them repeats: %d encodes, %d resizes. Best-image store holds %d images." % (
+            _tx_count[0], _repeats, _picam.encode_count, _picam.resize_count, len(_best_store.entries)))
+
+    if _archive != None:
+        _archive.stop()
+        print("%d transmissions. Archive: %s, files: %s" % (_tx_count[0], str(_archive.stats()), ", ".join(sorted(_archive.entries.keys()))))
+        for _name in sorted(_archive.entries.keys()):
+            if _name.endswith(".jpg"):
+                print("%s GPS tags: %s" % (_name, str(read_gps(os.path.join(_archive.directory, _name)))))
+    os.system("rm -rf %s" % _dir)
+
+    if _radios != None:
+        _timings = [(_radio.name, _gpio.ptt_timing(pin=_radio.ptt_pin, start_event='audio_start:%s' % _radio.name,
+            end_event='audio_end:%s' % _radio.name), _radio.power_manager) for _radio in _radios]
+    else:
+        _timings = [('radio', _gpio.ptt_timing(), None)]
+
+    for (_name, _timing, _pm) in _timings:
+        for _session in _timing['sessions']:
+            print("%s: PTT on for %.3f s: PTT to audio start %.3f s, audio end to PTT off %.6f s" % (
+                _name, _session['duration'], _session['ptt_to_audio'], _session['tail']))
+        print("%s: Mean PTT to audio start: %.3f s, mean tail: %.6f s, PTT duty cycle: %.1f%%" % (
+            _name, _timing['ptt_to_audio'], _timing['tail'], _timing['duty_cycle']*100.0))
+
+        if _pm != None:
+            _stats = _pm.stats()
+            print("%s: Radio powered %.1f%% of the time, transmitting %.1f%%. %d wakes (%d late), wake latency %.0f ms (max %.0f ms)." % (
+                _name, _stats['powered_fraction']*100.0, _stats['transmit_fraction']*100.0, _stats['wake_count'],
+                _stats['late_wakes'], _stats['wake_latency']*1000, (_stats['wake_latency_max'] or 0.0)*1000))
+
+    if num_radios > 1:
+        _first_on = [_timing['sessions'][0]['ptt_on'] for (_name, _timing, _pm) in _timings if len(_timing['sessions']) > 0]
+        print("%d images on %d radios: %.1f resizes and %.1f encodes per image. Transmit start spread (first image): %.3f s" % (
+            _tx_count[0], len(_radios), _picam.resize_count/_tx_count[0], _picam.encode_count/_tx_count[0],
+            max(_first_on) - min(_first_on)))
+
+
+def benchmark_settle(cycles=5, num_images=3, settle_time=0.8, seed=0):
+    """ Capture bursts from a SimulatedCamera whose scene brightness changes before each burst, using a fixed
+    0.5 s settle and inter-image delay, the exposure monitor, and the exposure monitor with the exposure locked.
+    Reports the time per burst, the time to settle, and how far the exposure was from its settled value at each shutter. """
+
+    _dir = tempfile.mkdtemp()
+    for (_name, _settle, _lock) in [("Fixed 0.5 s delays", False, False), ("Exposure monitor", True, False), ("Monitor + lock", True, True)]:
+        _random = random.Random(seed)
+        _camera = SimulatedCamera(capture_time=0.1, settle_time=settle_time)
+        _picam = SSTVPiCam(num_images=num_images, image_delay=0.5, camera=_camera, sample_rate=22050,
+            temp_filename_prefix=os.path.join(_dir, 'picam_temp'), debug_ptr=lambda x: None,
+            settle_exposure=_settle, lock_exposure=_lock)
+
+        _burst_times = []
+        _settle_times = []
+        for i in range(cycles):
+            _camera.set_brightness(_random.uniform(0.3, 3.0))
+            if not _settle:
+                # The old approach: a fixed settle delay.
+                sleep(0.5)
+            _start = monotonic()
+            _picam.capture(os.path.join(_dir, 'picam.jpg'))
+            _burst_times.append(monotonic() - _start)
+            if _picam.settle_time != None:
+                _settle_times.append(_picam.settle_time)
+
+        _errors = [max([abs(_v - _t)/_t for (_v, _t) in zip(_values, _target)]) for (_values, _target) in _camera.captured_values]
+        _spread = []
+        for i in range(cycles):
+            _burst = [_values[0] for (_values, _target) in _camera.captured_values[i*num_images:(i + 1)*num_images]]
+            _spread.append((max(_burst) - min(_burst))/min(_burst))
+        print("%-20s burst %.2f s%s, exposure error at shutter: mean %.1f%%, max %.1f%%, gain spread within burst %.1f%%" % (
+            _name, sum(_burst_times)/cycles + (0.0 if _settle else 0.5),
+            (" (settle %.2f s)" % (sum(_settle_times)/len(_settle_times))) if len(_settle_times) > 0 else " (incl. 0.5 s settle)",
+            100.0*sum(_errors)/len(_errors), 100.0*max(_errors), 100.0*max(_spread)))
+
+    os.system("rm -rf %s" % _dir)
+
+
+def benchmark_ring(cycles=5, num_images=3, capture_time=0.3):
+    """ Compare the latency of capture() using a burst of stills (each costing capture_time seconds for the still
+    port mode switch), against picking the best frame from the continuous-capture ring. """
+
+    _dir = tempfile.mkdtemp()
+    for (_name, _continuous) in [("Burst of stills", False), ("Frame ring", True)]:
+        _camera = SimulatedCamera(capture_time=capture_time)
+        _picam = SSTVPiCam(num_images=num_images, image_delay=0.5, camera=_camera, sample_rate=22050,
+            temp_filename_prefix=os.path.join(_dir, 'picam_temp'), debug_ptr=lambda x: None,
+            continuous_capture=_continuous)
+        # Let the ring fill.
+        sleep(1.0)
+
+        _latencies = []
+        _ages = []
+        for i in range(cycles):
+            _filename = os.path.join(_dir, 'picam_%d.jpg' % i)
+            _start = monotonic()
+            _picam.capture(_filename)
+            _latencies.append(monotonic() - _start)
+            _ages.append(_picam.capture_time - _start)
+            # Time for the archive still, while we would be encoding and transmitting.
+            sleep(1.0)
+
+        _archived = len(glob.glob(os.path.join(_dir, 'picam_*_full.jpg')))
+        print("%-16s capture latency: mean %.3f s, max %.3f s. Selected image shutter %+.2f s from the call. Archive stills: %d" % (
+            _name, sum(_latencies)/cycles, max(_latencies), sum(_ages)/cycles, _archived))
+        if _picam.frame_ring != None:
+            print("%-16s %s" % ("", str(_picam.frame_ring.stats())))
+        _picam.close()
+
+    os.system("rm -rf %s" % _dir)
+
+
+def benchmark_recovery(num_images=6, airtime=1.0, delay=0.5):
+    """ Run auto_capture with a simulated camera which fails after 2 images, where re-initialising it fails
+    3 times (so it comes back at a degraded resolution, then recovers fully), and where it never comes back
+    (so test cards are sent). Reports the transmissions made, the longest gap between them, and the camera statistics. """
+
+    _gpio = SimulatedGPIO()
+    set_gpio_backend(_gpio)
+    dra818_setup_io()
+
+    for (_name, _init_failures) in [("Flaky camera", 3), ("Dead camera", None)]:
+        _attempts = [0]
+        def _camera_factory():
+            _attempts[0] += 1
+            if (_init_failures is None) or (_attempts[0] <= _init_failures):
+                raise RuntimeError("Camera not detected")
+            return SimulatedCamera(capture_time=0.1)
+
+        _tx_times = []
+        def _post_tx():
+            _tx_times.append(monotonic())
+
+        _dir = tempfile.mkdtemp()
+        _start = monotonic()
+        _picam = SimulatedSSTVPiCam(airtime=airtime, encode_time=0.2, ptt_delay=0.1, num_images=1, image_delay=0,
+            temp_filename_prefix=os.path.join(_dir, 'picam_temp'), debug_ptr=lambda x: None,
+            camera=SimulatedCamera(capture_time=0.1, fail_after=2), camera_factory=_camera_factory, camera_backoff=3.0)
+        _picam.run(destination_directory=_dir, post_tx_function=_post_tx, delay=delay)
+        while len(_tx_times) < num_images:
+            sleep(0.1)
+        _picam.stop()
+        _picam.capture_thread.join()
+        _picam.close()
+
+        _gaps = [_b - _a for (_a, _b) in zip([_start] + _tx_times[:-1], _tx_times)]
+        print("%-13s %d transmissions in %.1f s, longest gap %.1f s. %s" % (
+            _name, len(_tx_times), _tx_times[-1] - _start, max(_gaps), str(_picam.camera_stats())))
+        os.system("rm -rf %s" % _dir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--simulate", action="store_true", default=False, help="Run a simulated auto-capture session, report PTT timing, then exit.")
+    parser.add_argument("--power-save", action="store_true", default=False, help="Power the radio down between transmissions.")
+    parser.add_argument("--radios", type=int, default=1, help="Number of radios to transmit on at once (simulation only).")
+    parser.add_argument("--dedup", action="store_true", default=False, help="Skip duplicate frames of a slowly changing scene (simulation only).")
+    parser.add_argument("--settle", action="store_true", default=False, help="Compare fixed settle delays against exposure monitoring, then exit.")
+    parser.add_argument("--ring", action="store_true", default=False, help="Compare burst capture latency against the continuous-capture frame ring, then exit.")
+    parser.add_argument("--recovery", action="store_true", default=False, help="Simulate camera failures, and report how the camera recovers, then exit.")
+    parser.add_argument("--archive", action="store_true", default=False, help="Archive images with an ArchiveWriter (simulation only).")
+    parser.add_argument("--repeat", type=int, default=0, help="Repeat a stored best image every N transmissions (simulation only).")
+    args = parser.parse_args()
+
+    if args.settle:
+        benchmark_settle()
+        sys.exit(0)
+
+    if args.ring:
+        benchmark_ring()
+        sys.exit(0)
+
+    if args.recovery:
+        benchmark_recovery()
+        sys.exit(0)
+
+    if args.simulate:
+        benchmark_ptt_timing(num_images=6 if (args.repeat or args.dedup) else 3, power_save=args.power_save, num_radios=args.radios,
+            repeat_every=args.repeat, dedup=args.dedup, archive=args.archive)
+        sys.exit(0)
@@ -9,22 +9,53 @@
 #
 #   This script is hacked together from the WenetPiCam class out of the Wenet project.
 #
-#   Dependencies: picamera, pySSTV
-
-from picamera import PiCamera
-from time import sleep
-from threading import Thread
+#   Dependencies: picamera, pySSTV (or numpy, for the fixed-point encoder)
+
+try:
+    from picamera import PiCamera
+except ImportError:
+    print("ERROR: Could not load picamera library. Only a SimulatedCamera can be used.")
+    PiCamera = None
+from time import sleep, monotonic
+from threading import Thread, Event
 from dra818 import *
+from sstv_encoder import encode_file, close_encoders, ENCODER_VERSION
+from sstv_modes import get_mode, airtime
+from sstv_cache import SSTVAudioCache
+from sstv_best import BestImageStore, image_score
+from sstv_dedup import DuplicateFilter
+from picam_exposure import ExposureMonitor
+from picam_ring import FrameRing
+from picam_archive import ArchiveWriter
+from tx_queue import TransmitQueue, AudioStream, load_wav, cw_ident, device_sample_rate
 from PIL import Image
 from PIL import ImageDraw
 from PIL import ImageFont
 import glob
 import os
 import os.path
+import shutil
 import datetime
+import io
 import traceback
 
 
+def make_test_card(filename, resolution=(640,480), text="CAMERA FAULT"):
+    """ Generate a test card image: colour bars over the top half, and a grey ramp over the bottom half, with a caption. """
+    (_width, _height) = resolution
+    _image = Image.new('RGB', resolution)
+    _draw = ImageDraw.Draw(_image)
+    _bars = [(255,255,255), (255,255,0), (0,255,255), (0,255,0), (255,0,255), (255,0,0), (0,0,255), (0,0,0)]
+    for (i, _colour) in enumerate(_bars):
+        _draw.rectangle([(i*_width//len(_bars), 0), ((i + 1)*_width//len(_bars) - 1, _height//2 - 1)], fill=_colour)
+    for _x in range(_width):
+        _level = (_x*255)//(_width - 1)
+        _draw.line([(_x, _height//2), (_x, _height - 1)], fill=(_level, _level, _level))
+    _draw.rectangle([(0, _height//2 - 20), (_width - 1, _height//2 + 20)], fill=(0,0,0))
+    _draw.text((_width//2 - 4*len(text), _height//2 - 6), text, fill=(255,255,255))
+    _image.save(filename, 'JPEG', quality=95)
+
+
 class SSTVPiCam(object):
     """ PiCam Wrapper Class """
 
@@ -37,7 +68,31 @@ class SSTVPiCam(object):
                 temp_filename_prefix = 'picam_temp',
                 ptt_locked = False,
                 post_image_function = None,
-                debug_ptr = None
+                debug_ptr = None,
+                position_ptr = None,
+                radios = None,
+                ptt_delay = 2.0,
+                camera = None,
+                camera_factory = None,
+                camera_retries = 2,
+                camera_backoff = 10.0,
+                max_camera_backoff = 300.0,
+                degraded_resolutions = ((1640,1232), (640,480)),
+                test_card = None,
+                archive = None,
+                encoder = "pisstv",
+                encoder_workers = 1,
+                sample_rate = None,
+                audio_cache = None,
+                best_store = None,
+                duplicate_filter = None,
+                settle_exposure = False,
+                lock_exposure = False,
+                continuous_capture = False,
+                ring_resolution = (1024,768),
+                ring_window = 3.0,
+                archive_stills = True,
+                scheduler = None
                 ):
 
         """ Instantiate a SSTVPiCam Object
@@ -45,15 +100,29 @@ class SSTVPiCam(object):
 
             Keyword Arguments:
             callsign: The callsign to be used when converting images to SSTV. Must be <=6 characters in length.
-            tx_mode: SSTV Mode to transmit using. 
-                    Valid Modes:
-                    s1: Scottie 1
-                    r36: Robot 36
-                    pd120: PD120
+            tx_mode: SSTV Mode to transmit using. Defaults to m1 (Martin 1).
+                    Valid Modes (refer sstv_modes.py for the full list, with airtimes):
+                    r36, r72: Robot 36, Robot 72
+                    m1, m2: Martin 1, Martin 2
+                    s1, s2, sdx: Scottie 1, Scottie 2, Scottie DX
+                    pd50, pd90, pd120, pd160, pd180, pd240, pd290: PD modes
+                    Modes which pisstv does not support are always encoded using the fixed-point encoder.
 
             num_images: Number of images to capture in sequence when the 'capture' function is called.
                         The 'best' (largest filesize) image is selected and saved.
             image_delay: Delay time (seconds) between each captured image.
+            settle_exposure: If True, wait for the camera's gains and exposure time to stop changing before capturing
+                        each image (see picam_exposure.py), instead of waiting image_delay between images.
+            lock_exposure: If True (and settle_exposure is set), lock the exposure and white balance once settled,
+                        for the whole burst, so the images are comparable and can be captured back-to-back.
+            continuous_capture: If True, run the camera continuously on its video port, keeping a ring of recent
+                        frames (see picam_ring.py). capture() then picks the best frame from the last ring_window
+                        seconds immediately, instead of capturing a burst of stills. num_images, image_delay and
+                        settle_exposure are only used if there are no recent frames.
+            ring_resolution: Size of the frames in the ring. Should be at least the largest SSTV mode resolution in use.
+            ring_window: Age (seconds) of the oldest frame which capture() will pick.
+            archive_stills: If True (and continuous_capture is set), a full resolution still is captured in the background
+                        after each frame is picked, and saved alongside it with a _full suffix, for the archive only.
 
             vertical_flip: Flip captured images vertically.
             horizontal_flip: Flip captured images horizontally.
@@ -67,6 +136,71 @@ class SSTVPiCam(object):
 
             ptt_locked: If True, lock the PTT on.
 
+            position_ptr: 'pointer' to a function which accepts a time.monotonic() timestamp, and returns
+                        a position dictionary for that time (e.g. UBloxGPS.position_at).
+                        If supplied, the position at the shutter time of the selected image is stored
+                        in capture_position after each capture. When a stored image is repeated, capture_position
+                        is set to the position stored with it.
+
+            radios: An optional list of DRA818Radio objects to transmit on. Each radio owns its own options:
+                        its tx_mode (or this object's tx_mode), channel rotation, listen-before-talk, power
+                        management and transmit queue. With several radios, each image is transmitted on all
+                        of them at the same time, resized once per resolution and encoded once per mode.
+                        If None, the default DRA818 pin set is keyed (via dra818_ptt), and aplay plays the audio
+                        on the default sound device.
+
+                        Channel rotation retunes the radio in the background after each transmission, so it
+                        does not add any dead time. With listen-before-talk, each image waits for the channel to
+                        be clear (for at most the radio's channel_monitor.timeout). With power saving, the radio
+                        is powered down after each transmission, and woken (based on the expected SSTV encode time
+                        and the measured wake latency) so that it is ready just as the next image is ready.
+                        With a transmit queue, images are sent through it rather than by keying the radio and
+                        running aplay directly, so any ident which is due is sent in the same PTT session
+                        (ptt_delay and ptt_locked are then ignored, as the queue has its own ptt_delay).
+
+            ptt_delay: Delay (seconds) between keying the transmitter and starting the audio.
+
+            camera: An optional camera object to use instead of a PiCamera (e.g. a SimulatedCamera).
+            camera_factory: An optional function which returns a new camera object, used when the camera is
+                        re-initialised. Defaults to PiCamera.
+            camera_retries: Number of attempts to initialise the camera at each resolution, when (re-)initialising it.
+            camera_backoff: If the camera could only be initialised at a degraded resolution (or not at all), time (seconds)
+                        before the next attempt to fully recover it. This doubles after each failed attempt,
+                        up to max_camera_backoff.
+            degraded_resolutions: Lower capture resolutions to fall back to, in order, if the camera cannot be
+                        initialised (or stops working) at full resolution.
+            test_card: Image to transmit if the camera cannot be initialised at all, so the transmit pipeline does
+                        not stall. If None, a test card is generated. If False, capture() fails instead.
+
+            archive: An optional (started) ArchiveWriter object. If supplied, auto_capture works on each image in the
+                        archive's incoming directory, and hands the files over to the archive writer (which fsyncs them
+                        and moves them into its directory in the background) once the image has been transmitted,
+                        rather than writing them into destination_directory.
+
+            encoder: SSTV encoder to use. "pisstv" uses the external pisstv binary, "fixed" uses the
+                        low-CPU fixed-point encoder in sstv_encoder.py (requires numpy).
+            encoder_workers: Number of processes the fixed-point encoder splits each image across
+                        (e.g. 4 on a Pi 3 or 4). The output is identical to a single-process encode.
+            sample_rate: Sample rate (Hz) to generate SSTV audio at. If None, the sample rate of the first radio's
+                        transmit queue's audio stream is used, or else the native rate of the (first radio's) audio device,
+                        so ALSA does not need to resample the audio during playback.
+            audio_cache: An optional SSTVAudioCache object. If supplied, encoded audio is cached (keyed by the
+                        image pixels, mode, sample rate and encoder version), and re-sent images are not re-encoded.
+
+            best_store: An optional BestImageStore object. If supplied, each captured image is offered to it
+                        (scored in the same way as burst selection), and the resized and encoded variants of
+                        the images it keeps are stored alongside them. If its repeat_every is set, every
+                        repeat_every'th transmission is a repeat of one of its best recent images, instead of
+                        a new capture. Repeats use the stored variants, so they need no capture, resize or encode.
+
+            duplicate_filter: An optional DuplicateFilter object. If supplied, captured images which are visually
+                        near-identical to a recent transmission are skipped (or sent in a faster mode).
+
+            scheduler: An optional AirtimeScheduler object. If supplied, it chooses the tx_mode and the delay
+                        before each image (the auto_capture delay argument is ignored), and holds off
+                        transmissions which would exceed its duty cycle. Measured stage timings are fed back to it.
+                        With multiple radios, only radios without their own tx_mode follow the scheduler.
+
         """
 
         self.debug_ptr = debug_ptr
@@ -76,35 +210,160 @@ class SSTVPiCam(object):
         self.post_image_function = post_image_function
         self.tx_mode = tx_mode
         self.ptt_locked = ptt_locked
+        self.position_ptr = position_ptr
+        self.radios = radios
+        self.ptt_delay = ptt_delay
+        self.encoder = encoder
+        self.encoder_workers = encoder_workers
+        if sample_rate is None:
+            if radios and (radios[0].tx_queue != None):
+                sample_rate = radios[0].tx_queue.stream.sample_rate
+            else:
+                # The same device transmit_image() plays on.
+                sample_rate = device_sample_rate(radios[0].audio_device if radios else None, debug_ptr=self.debug_message)
+        self.sample_rate = sample_rate
+        self.audio_cache = audio_cache
+        self.best_store = best_store
+        self.duplicate_filter = duplicate_filter
+        self.lock_exposure = lock_exposure
+        self.ring_window = ring_window
+        self.archive_stills = archive_stills
+        self.archive_thread = None
+        # Time (seconds) taken for the exposure to settle before the last burst.
+        self.settle_time = None
+        # Number of images transmitted.
+        self.tx_count = 0
+        self.scheduler = scheduler
+        # Durations of each stage (capture, resize, encode, channel_wait, tx_overhead, airtime) of the last cycle.
+        self.stage_times = {}
+        self.tx_start = None
+        # Recent SSTV encode durations, used to schedule radio wake-ups.
+        self.encode_times = []
+        # Time spent waiting for a clear channel before the last transmission.
+        self.channel_wait = 0.0
+
+        # Shutter time (time.monotonic()) and position of the most recently captured image.
+        self.capture_time = None
+        self.capture_position = None
 
 
         # Default capture resolution is full-frame Picam 2 images
         self.src_resolution=(3280,2464)
 
-        if self.tx_mode == "r36":
-            # Robot 36
-            self.tx_resolution = (320,240)
-        elif self.tx_mode == "pd120":
-            # PD120
-            self.tx_resolution = (640,496)
+        self.set_mode(self.tx_mode)
+
+
+        self.vertical_flip = vertical_flip
+        self.horizontal_flip = horizontal_flip
+        self.settle_exposure = settle_exposure
+        self.continuous_capture = continuous_capture
+        self.ring_resolution = ring_resolution
+        self.camera_factory = camera_factory
+        self.camera_retries = camera_retries
+        self.camera_backoff = camera_backoff
+        self.max_camera_backoff = max_camera_backoff
+        self.degraded_resolutions = degraded_resolutions
+        self.test_card = test_card
+        self.archive = archive
+
+        self.cam = None
+        self.exposure_monitor = None
+        self.frame_ring = None
+        # Camera object to use on the first initialisation.
+        self.new_camera = camera
+
+        # Camera health. degraded is None when the camera is working at full resolution, 'resolution'
+        # when it is working at a lower resolution, or 'test_card' if it could not be initialised.
+        self.camera_resolution = None
+        self.degraded = None
+        # Time (time.monotonic()) of the next attempt to recover from degraded operation, and the backoff after that.
+        self.next_recovery = None
+        self.recovery_backoff = camera_backoff
+        # Time (time.monotonic()) the camera failed, if it has not yet recovered.
+        self.camera_failed_at = None
+        # Statistics
+        self.capture_failures = 0
+        self.camera_init_failures = 0
+        self.camera_recoveries = 0
+        self.recovery_times = []
+        self.test_card_captures = 0
+
+        # Attempt to start picam.
+        self.recover_camera()
+
+
+    def set_mode(self, tx_mode):
+        """ Set the SSTV mode used for subsequent images. """
+        get_mode(tx_mode)
+        self.tx_mode = tx_mode
+        # Image resolution and expected airtime (seconds) of our SSTV mode.
+        self.tx_resolution = get_mode(tx_mode)['resolution']
+        self.tx_airtime = airtime(tx_mode)
+
+
+    def debug_message(self, message):
+        """ Write a debug message.
+        If debug_ptr was set to a function during init, this will
+        pass the message to that function, else it will just print it.
+        This is used mainly to get updates on image capture into the Wenet downlink.
+
+        """
+        message = datetime.datetime.utcnow().isoformat() + " PiCam Debug: " + message
+        if self.debug_ptr != None:
+            self.debug_ptr(message)
         else:
-            # Scottie 2
-            self.tx_resolution = (320,256)
+            print(message)
 
 
-        # Attempt to start picam.
-        self.cam = PiCamera()
+    def close(self):
+        self.close_camera()
+        close_encoders()
+
+
+    def close_camera(self):
+        """ Stop the frame ring (and any archive capture), and close the camera, ignoring any errors. """
+        if self.frame_ring != None:
+            self.frame_ring.stop()
+            self.frame_ring = None
+        if self.archive_thread != None:
+            self.archive_thread.join()
+            self.archive_thread = None
+        if self.cam != None:
+            try:
+                self.cam.close()
+            except Exception as e:
+                self.debug_message("Closing camera object failed: %s" % str(e))
+            self.cam = None
+        self.exposure_monitor = None
+
+
+    def init_camera(self, resolution=None):
+        """ (Re-)initialise the camera at a capture resolution (by default, src_resolution), closing it first if
+        it is open, then check it is working. Returns True if the camera passed the health probe. """
+        if resolution is None:
+            resolution = self.src_resolution
+        self.close_camera()
+
+        if self.new_camera != None:
+            self.cam = self.new_camera
+            self.new_camera = None
+        elif self.camera_factory != None:
+            self.cam = self.camera_factory()
+        elif PiCamera != None:
+            self.cam = PiCamera()
+        else:
+            raise RuntimeError("No camera available (picamera could not be loaded).")
 
         # Configure camera.
         try:
-            self.cam.resolution = self.src_resolution
+            self.cam.resolution = resolution
         except:
             # Default to Picam 1 max resolution if we cannot set the higher PiCam 2 resolution.
             self.cam.resolution = (2592,1944)
         
         # These may need to be changed depending on camera orientation.
-        self.cam.hflip = horizontal_flip
-        self.cam.vflip = vertical_flip
+        self.cam.hflip = self.horizontal_flip
+        self.cam.vflip = self.vertical_flip
         self.cam.exposure_mode = 'auto'
         self.cam.awb_mode = 'sunlight' # Fixed white balance compensation. 
         self.cam.meter_mode = 'matrix'
@@ -113,23 +372,125 @@ class SSTVPiCam(object):
         # This lets the camera gain control algs start to settle.
         self.cam.start_preview()
 
+        self.exposure_monitor = ExposureMonitor(self.cam, debug_ptr=self.debug_ptr) if self.settle_exposure else None
 
-    def debug_message(self, message):
-        """ Write a debug message.
-        If debug_ptr was set to a function during init, this will
-        pass the message to that function, else it will just print it.
-        This is used mainly to get updates on image capture into the Wenet downlink.
+        # Keep a ring of recent frames from the video port.
+        if self.continuous_capture:
+            self.frame_ring = FrameRing(self.cam, resolution=self.ring_resolution, debug_ptr=self.debug_ptr)
+            self.frame_ring.start()
 
-        """
-        message = datetime.datetime.utcnow().isoformat() + " PiCam Debug: " + message
-        if self.debug_ptr != None:
-            self.debug_ptr(message)
-        else:
-            print(message)
+        return self.probe_camera()
 
 
-    def close(self):
-        self.cam.close()
+    def probe_camera(self, timeout=2.0):
+        """ Check the camera is working: that the frame ring is receiving frames, or else that a small frame
+        can be captured from the video port. Returns True if it is. """
+        if self.cam is None:
+            return False
+        try:
+            if self.frame_ring != None:
+                _start = monotonic()
+                while monotonic() - _start < timeout:
+                    if not self.frame_ring.running:
+                        return False
+                    if self.frame_ring.best_frame(timeout) != None:
+                        return True
+                    sleep(0.05)
+                return False
+
+            _stream = io.BytesIO()
+            self.cam.capture(_stream, format='jpeg', use_video_port=True, resize=(160,120))
+            return len(_stream.getvalue()) > 0
+        except Exception as e:
+            self.debug_message("Camera health probe failed: %s" % str(e))
+            return False
+
+
+    def recover_camera(self):
+        """ Initialise the camera at full resolution, or failing that at each of the degraded resolutions in turn,
+        making camera_retries attempts at each (with a short backoff between them). If the camera cannot be initialised
+        at all, capture() returns the test card, until the next recovery attempt. Returns True if the camera is working. """
+        _start = monotonic()
+        for _resolution in [self.src_resolution] + list(self.degraded_resolutions):
+            for _attempt in range(self.camera_retries):
+                if _attempt > 0:
+                    sleep(0.5*2**(_attempt - 1))
+                try:
+                    if self.init_camera(_resolution):
+                        break
+                    self.debug_message("Camera failed health probe at %dx%d." % _resolution)
+                except Exception as e:
+                    self.debug_message("Could not initialise camera at %dx%d: %s" % (_resolution[0], _resolution[1], str(e)))
+                self.camera_init_failures += 1
+            else:
+                continue
+            break
+        else:
+            self.close_camera()
+            _resolution = None
+
+        self.camera_resolution = _resolution
+        if _resolution == self.src_resolution:
+            self.degraded = None
+        elif _resolution != None:
+            self.degraded = 'resolution'
+        else:
+            self.degraded = 'test_card' if self.test_card != False else 'failed'
+
+        if self.degraded is None:
+            self.next_recovery = None
+            self.recovery_backoff = self.camera_backoff
+        else:
+            self.next_recovery = monotonic() + self.recovery_backoff
+            self.recovery_backoff = min(self.max_camera_backoff, self.recovery_backoff*2)
+
+        # Record the time from the camera failing to it working again.
+        if _resolution is None:
+            if self.camera_failed_at is None:
+                self.camera_failed_at = _start
+        elif self.camera_failed_at != None:
+            self.camera_recoveries += 1
+            self.recovery_times.append(monotonic() - self.camera_failed_at)
+            self.recovery_times = self.recovery_times[-100:]
+            self.camera_failed_at = None
+
+        if self.degraded is None:
+            self.debug_message("Camera initialised in %.2f s." % (monotonic() - _start))
+        elif _resolution != None:
+            self.debug_message("Camera running at degraded resolution %dx%d. Retrying full resolution in %d s." % (
+                _resolution[0], _resolution[1], int(self.next_recovery - monotonic())))
+        else:
+            self.debug_message("Camera could not be initialised. Retrying in %d s." % int(self.next_recovery - monotonic()))
+        return _resolution != None
+
+
+    def camera_stats(self):
+        return {
+            'degraded': self.degraded,
+            'resolution': self.camera_resolution,
+            'capture_failures': self.capture_failures,
+            'init_failures': self.camera_init_failures,
+            'recoveries': self.camera_recoveries,
+            'recovery_time': self.recovery_times[-1] if len(self.recovery_times) > 0 else None,
+            'mean_recovery_time': sum(self.recovery_times)/len(self.recovery_times) if len(self.recovery_times) > 0 else None,
+            'test_card_captures': self.test_card_captures
+        }
+
+
+    def capture_test_card(self, filename):
+        """ Copy the test card to filename, in place of a captured image. """
+        _test_card = self.test_card
+        if _test_card is None:
+            # (Not matching the burst's temporary image names.)
+            _test_card = "%s.test_card.jpg" % self.temp_filename_prefix
+            if not os.path.isfile(_test_card):
+                make_test_card(_test_card)
+        self.debug_message("Camera unavailable, using test card.")
+        shutil.copyfile(_test_card, filename)
+        self.test_card_captures += 1
+        self.tag_capture(monotonic())
+        self.settle_time = None
+        return True
 
 
     def capture(self, filename='picam.jpg'):
@@ -139,45 +500,154 @@ class SSTVPiCam(object):
             filename:   destination filename.
         """
 
-        # Attempt to capture a set of images.
-        for i in range(self.num_images):
-            self.debug_message("Capturing Image %d of %d" % (i+1,self.num_images))
-            # Wrap this in error handling in case we lose the camera for some reason.
+        # Periodically try to get out of degraded operation.
+        if (self.next_recovery != None) and (monotonic() >= self.next_recovery):
+            self.debug_message("Attempting to recover camera...")
+            self.recover_camera()
+
+        if self.cam is None:
+            if self.degraded == 'test_card':
+                return self.capture_test_card(filename)
+            return False
+
+        # Pick the best recent frame from the ring, rather than capturing a burst.
+        if (self.frame_ring != None) and self.frame_ring.running:
+            _frame = self.frame_ring.best_frame(self.ring_window)
+            if _frame != None:
+                return self.capture_frame(_frame, filename)
+            self.debug_message("No recent frames in the ring, capturing a burst.")
+
+        # Shutter times of each captured image, indexed by filename.
+        shutter_times = {}
+
+        # Wait for the gain control to settle, rather than for a fixed time.
+        self.settle_time = None
+        if self.exposure_monitor != None:
             try:
-                self.cam.capture("%s_%d.jpg" % (self.temp_filename_prefix,i))
-                if self.image_delay > 0:
-                    sleep(self.image_delay)
-            except Exception as e: # TODO: Narrow this down...
-                self.debug_message("ERROR: %s" % str(e))
-                # Immediately return false. Not much point continuing to try and capture images.
-                return False
+                self.settle_time = self.exposure_monitor.wait_settled()
+                self.debug_message("Exposure settled in %.2f s." % self.settle_time)
+                if self.lock_exposure:
+                    self.exposure_monitor.lock_exposure()
+            except Exception as e:
+                self.debug_message("ERROR: Could not monitor exposure: %s" % str(e))
+
+        # Attempt to capture a set of images.
+        try:
+            for i in range(self.num_images):
+                self.debug_message("Capturing Image %d of %d" % (i+1,self.num_images))
+                # Wrap this in error handling in case we lose the camera for some reason.
+                try:
+                    _temp_filename = "%s_%d.jpg" % (self.temp_filename_prefix,i)
+                    shutter_times[_temp_filename] = monotonic()
+                    if self.frame_ring != None:
+                        self.frame_ring.capture_still(_temp_filename)
+                    else:
+                        self.cam.capture(_temp_filename)
+                    if self.exposure_monitor != None:
+                        # If the exposure is locked, this returns immediately.
+                        if i < self.num_images - 1:
+                            self.exposure_monitor.wait_settled()
+                    elif self.image_delay > 0:
+                        sleep(self.image_delay)
+                except Exception as e: # TODO: Narrow this down...
+                    self.debug_message("ERROR: %s" % str(e))
+                    # Immediately return false. Not much point continuing to try and capture images.
+                    return False
+        finally:
+            if self.exposure_monitor != None:
+                try:
+                    self.exposure_monitor.unlock_exposure()
+                except Exception as e:
+                    self.debug_message("ERROR: Could not unlock exposure: %s" % str(e))
 
         
         # Otherwise, continue to pick the 'best' image based on filesize.
         self.debug_message("Choosing Best Image.")
         pic_list = glob.glob("%s_*.jpg" % self.temp_filename_prefix)
         pic_sizes = []
-        # Iterate through list of images and get the file sizes.
+        # Iterate through list of images and score them (see sstv_best.image_score()).
         for pic in pic_list:
-            pic_sizes.append(os.path.getsize(pic))
+            pic_sizes.append(image_score(pic))
         largest_pic = pic_list[pic_sizes.index(max(pic_sizes))]
 
-        # Copy best image to target filename.
-        self.debug_message("Copying image to storage with filename %s" % filename)
-        os.system("cp %s %s" % (largest_pic, filename))
+        self.tag_capture(shutter_times.get(largest_pic, None))
+
+        # Move best image to target filename.
+        self.debug_message("Moving image to storage with filename %s" % filename)
+        shutil.move(largest_pic, filename)
         # Clean up temporary images.
-        os.system("rm %s_*.jpg" % self.temp_filename_prefix)
+        for pic in pic_list:
+            if pic != largest_pic:
+                os.remove(pic)
 
         return True 
 
 
-    def resize(self, filename="output.jpg", dest_filename="picam_temp.png"):
-        """ Resize the supplied image to a resolution suitable for SSTV encoding.
+    def tag_capture(self, capture_time):
+        """ Record the shutter time of the selected image, and our position at that time. """
+        self.capture_time = capture_time
+        self.capture_position = None
+        if (self.position_ptr != None) and (self.capture_time != None):
+            try:
+                self.capture_position = self.position_ptr(self.capture_time)
+            except Exception as e:
+                self.debug_message("Could not get capture position: %s" % str(e))
+
+
+    def capture_frame(self, frame, filename):
+        """ Save a frame from the ring to filename, and (if archive_stills is set) start capturing a full
+        resolution still for the archive in the background. """
+        (_time, _score, _data) = frame
+        self.debug_message("Using frame from %.2f s ago (%d bytes)." % (monotonic() - _time, _score))
+        try:
+            with open(filename, 'wb') as _f:
+                _f.write(_data)
+        except Exception as e:
+            self.debug_message("ERROR: Could not save frame: %s" % str(e))
+            return False
+
+        self.tag_capture(_time)
+        self.settle_time = None
+
+        if self.archive_stills:
+            # Only one archive still at a time.
+            if self.archive_thread != None:
+                self.archive_thread.join()
+            _archive_filename = "%s_full%s" % os.path.splitext(filename)
+            self.archive_thread = Thread(target=self.archive_still, args=(_archive_filename,))
+            self.archive_thread.start()
+
+        return True
+
+
+    def archive_still(self, filename):
+        """ Capture a full resolution still, for the archive only. """
+        try:
+            _shutter_time = monotonic()
+            self.frame_ring.capture_still(filename)
+            self.debug_message("Archived full resolution still to %s" % filename)
+        except Exception as e:
+            self.debug_message("ERROR: Could not capture archive still: %s" % str(e))
+            return
+        if self.archive != None:
+            _position = None
+            if self.position_ptr != None:
+                try:
+                    _position = self.position_ptr(_shutter_time)
+                except Exception as e:
+                    self.debug_message("Could not get archive still position: %s" % str(e))
+            self.archive.put(filename, remove=True, position=_position)
+
 
+    def resize(self, filename="output.jpg", dest_filename="picam_temp.png", resolution=None):
+        """ Resize the supplied image to a resolution suitable for SSTV encoding.
+        If resolution is not supplied, the resolution of our tx_mode is used.
 
         """
+        if resolution is None:
+            resolution = self.tx_resolution
         self.debug_message("Resizing image.")
-        return_code = os.system("convert %s -resize %dx%d\! %s" % (filename, self.tx_resolution[0], self.tx_resolution[1], dest_filename))
+        return_code = os.system("convert %s -resize %dx%d\! %s" % (filename, resolution[0], resolution[1], dest_filename))
         if return_code != 0:
             self.debug_message("Resize operation failed!")
             return False
@@ -185,7 +655,7 @@ class SSTVPiCam(object):
         return True
 
 
-    def sstvify(self, filename, temp_filename="picam_temp.png"):
+    def sstvify(self, filename, temp_filename="picam_temp.png", tx_mode=None):
         """ Convert a supplied PNG image to SSTV Audio.
         Returns the filename of the converted SSTV file.
 
@@ -193,16 +663,65 @@ class SSTVPiCam(object):
         filename:   Source PNG filename.
                     Output SSTV image will be saved to to a temporary file (output.wav) which should be
                     transmitted immediately.
+        tx_mode:    SSTV mode to use. Defaults to our tx_mode.
 
         """
+        if tx_mode is None:
+            tx_mode = self.tx_mode
+
+        if self.audio_cache is None:
+            return self.encode_sstv(filename, temp_filename, tx_mode)
+
+        try:
+            _key = self.audio_cache.key(filename, tx_mode, self.sample_rate, self.encoder_version(tx_mode))
+        except Exception as e:
+            self.debug_message("Could not hash image for the SSTV cache: %s" % str(e))
+            return self.encode_sstv(filename, temp_filename, tx_mode)
+
+        _cached = self.audio_cache.get(_key)
+        if _cached != None:
+            self.debug_message("Using cached %s SSTV audio." % get_mode(tx_mode)['name'])
+            return _cached
+
+        _wav = self.encode_sstv(filename, temp_filename, tx_mode)
+        if _wav != "FAIL":
+            try:
+                self.audio_cache.put(_key, _wav)
+            except Exception as e:
+                self.debug_message("Could not add SSTV audio to the cache: %s" % str(e))
+        return _wav
+
+    def use_fixed_encoder(self, tx_mode):
+        return (self.encoder == "fixed") or (get_mode(tx_mode)['pisstv'] == None)
+
+    def encoder_version(self, tx_mode):
+        """ Name and version of the encoder used for a mode, for the SSTV audio cache. """
+        if self.use_fixed_encoder(tx_mode):
+            return ENCODER_VERSION
+        # Use the size and modification time of the pisstv binary as its version.
+        try:
+            _stat = os.stat("./pisstv")
+            return "pisstv-%d-%d" % (_stat.st_size, int(_stat.st_mtime))
+        except OSError:
+            return "pisstv"
+
+    def encode_sstv(self, filename, temp_filename, tx_mode):
+        """ Convert a PNG image to SSTV audio, without using the cache. Returns the WAV filename, or "FAIL". """
+        if self.use_fixed_encoder(tx_mode):
+            self.debug_message("Converting image to %s SSTV (fixed-point encoder, %.1f s airtime)." % (get_mode(tx_mode)['name'], airtime(tx_mode)))
+            try:
+                return encode_file(filename, temp_filename + ".wav", mode=tx_mode, sample_rate=self.sample_rate, workers=self.encoder_workers)
+            except Exception as e:
+                self.debug_message("Failed to convert image to SSTV: %s" % str(e))
+                return "FAIL"
 
         # Copy out file, since pisstv doesnt have an output filename argument...
         os.system("cp %s %s" % (filename, temp_filename))
 
         # Convert to sstv
-        sstv_convert_command = "./pisstv -p %s -r 22050 %s" % (self.tx_mode, temp_filename)
+        sstv_convert_command = "./pisstv -p %s -r %d %s" % (get_mode(tx_mode)['pisstv'], self.sample_rate, temp_filename)
 
-        self.debug_message("Converting image to SSTV.")
+        self.debug_message("Converting image to %s SSTV (%.1f s airtime)." % (get_mode(tx_mode)['name'], airtime(tx_mode)))
         return_code = os.system(sstv_convert_command)
         if return_code != 0:
             self.debug_message("Failed to convert image to SSTV!")
@@ -211,26 +730,254 @@ class SSTVPiCam(object):
             return temp_filename + ".wav"
 
 
-    def transmit_image(self, filename="output.wav"):
-        ''' Transmit an image '''
+    def next_channel(self):
+        """ Start retuning the radios to the next channel in their rotations, in the background. """
+        for _radio in (self.radios or []):
+            _channel = _radio.next_channel()
+            if _channel != None:
+                self.debug_message("Retuning %s to channel %s" % (_radio.name, _channel))
+
+
+    def expected_encode_time(self):
+        """ Estimate how long the next SSTV encode will take. Errs on the short side, so the radio wakes early rather than late. """
+        if len(self.encode_times) == 0:
+            return 0.0
+        return min(self.encode_times[-5:])
+
+
+    def play_audio(self, filename, device=None):
+        ''' Play an audio file (on an ALSA device, if supplied), blocking until playback is complete. Returns the aplay return code. '''
+        if device != None:
+            tx_command = "aplay -D %s %s" % (device, filename)
+        else:
+            tx_command = "aplay %s" % filename
+        return os.system(tx_command)
+
+
+    def transmit_image(self, filename="output.wav", radio=None):
+        ''' Transmit an image, either on a DRA818Radio, or (if radio is None) on the default DRA818 pin set.
+        Returns (the time spent waiting for a clear channel, the duration of the image audio),
+        or None if the image was not transmitted. '''
         # TODO: Make a non-blocking transmit function.
 
+        if radio != None:
+            _dra818 = radio.dra818
+            _channel_monitor = radio.channel_monitor
+            _ptt = radio.ptt
+            _mark = radio.mark
+            _device = radio.audio_device
+            _tx_queue = radio.tx_queue
+            _power_manager = radio.power_manager
+            _name = " on %s" % radio.name
+        else:
+            _dra818 = None
+            _channel_monitor = None
+            _ptt = dra818_ptt
+            _mark = gpio_mark
+            _device = None
+            _tx_queue = None
+            _power_manager = None
+            _name = ""
+
+        # Make sure any background retune has completed. Never transmit while the retune thread may still be
+        # talking to the module, or if we don't know which channel it is on.
+        if _dra818 != None:
+            if not _dra818.wait_retune(timeout=5):
+                if (_dra818.retune_thread != None) and _dra818.retune_thread.is_alive():
+                    self.debug_message("Retune%s is taking a while, waiting for it to finish." % _name)
+                if not _dra818.wait_retune():
+                    self.debug_message("Retune%s failed, not transmitting. Retrying the retune." % _name)
+                    if _dra818.retune_target != None:
+                        _dra818.retune_async(_dra818.retune_target)
+                    return None
+
+        # Make sure the radio is powered up.
+        if _power_manager != None:
+            _power_manager.wait_ready()
+
+        # Listen before talk.
+        _channel_wait = 0.0
+        if _channel_monitor != None:
+            _start = monotonic()
+            if not _channel_monitor.wait_clear():
+                self.debug_message("Channel still busy, transmitting anyway.")
+            _channel_wait = monotonic() - _start
+
+        if _tx_queue != None:
+            # The queue keys the transmitter, and adds an ident if one is due.
+            if _power_manager != None:
+                _power_manager.transmit_started()
+            self.debug_message("Transmitting%s..." % _name)
+            _item = _tx_queue.put_wav(filename)
+            if not _item.wait():
+                self.debug_message("Error playing SSTV file.")
+            if _power_manager != None:
+                _power_manager.transmit_finished()
+            return (_channel_wait, _tx_queue.stream.duration(_item.data))
+
         # PTT On
-        dra818_ptt(True)
+        _ptt(True)
+        if _power_manager != None:
+            _power_manager.transmit_started()
         # Delay slightly.
-        sleep(2)
+        sleep(self.ptt_delay)
 
-        self.debug_message("Transmitting...")
-        tx_command = "aplay %s" % filename
-        return_code = os.system(tx_command)
+        self.debug_message("Transmitting%s..." % _name)
+        _mark('audio_start')
+        _audio_start = monotonic()
+        return_code = self.play_audio(filename, device=_device)
+        _audio_time = monotonic() - _audio_start
+        _mark('audio_end')
 
         # If we are not locking the PTT on, stop the transmitter.
         if self.ptt_locked == False:
-            dra818_ptt(False)
+            _ptt(False)
+            if _power_manager != None:
+                _power_manager.transmit_finished()
 
         if return_code != 0:
             self.debug_message("Error playing SSTV file.")
 
+        return (_channel_wait, _audio_time)
+
+
+    def encode_and_transmit(self, capture_filename_full, capture_filename_small, post_process_ptr_small=None, entry=None):
+        ''' Resize, encode and transmit a captured image, on all of our radios at once.
+
+        The image is resized (and post-processed) once per resolution, and encoded once per SSTV mode.
+        Each radio starts transmitting as soon as the audio for its mode is ready, while the remaining
+        modes are encoded. Returns True if the image was transmitted on at least one radio.
+
+        entry: An optional best_store entry id for this image. Stored resized images and audio are used
+               where available, and any new ones are added to the store.
+        '''
+        _radios = self.radios if self.radios != None else [None]
+        _radio_modes = [(_radio, _radio.tx_mode if (_radio != None and _radio.tx_mode != None) else self.tx_mode) for _radio in _radios]
+
+        _modes = []
+        for (_radio, _mode) in _radio_modes:
+            if _mode not in _modes:
+                _modes.append(_mode)
+
+        # SSTV audio filename for each mode, and an Event which is set once it is available.
+        _encoded = {}
+        _encoded_events = {_mode: Event() for _mode in _modes}
+        _channel_waits = []
+        # (audio duration, transmit overhead, end time) of each transmission, indexed by mode.
+        _airtimes = {}
+
+        def _transmit(radio, mode):
+            _encoded_events[mode].wait()
+            if _encoded.get(mode, "FAIL") != "FAIL":
+                # Stay within the scheduler's duty cycle.
+                if self.scheduler != None:
+                    _hold = self.scheduler.transmit_delay(mode)
+                    if _hold > 0:
+                        self.debug_message("Holding transmission for %.1f s to stay within the duty cycle." % _hold)
+                        sleep(_hold)
+                _start = monotonic()
+                _result = self.transmit_image(_encoded[mode], radio=radio)
+                _end = monotonic()
+                if _result is None:
+                    return
+                (_channel_wait, _audio_time) = _result
+                _channel_waits.append(_channel_wait)
+                # Only the audio counts as airtime. The rest (waking the radio, finishing a retune, the PTT delay)
+                # is transmit overhead, which delays the image but isn't charged against the duty cycle.
+                _airtimes.setdefault(mode, []).append((_audio_time, _end - _start - _channel_wait - _audio_time, _end))
+
+        _threads = []
+        for (_radio, _mode) in _radio_modes:
+            _thread = Thread(target=_transmit, args=(_radio, _mode))
+            _thread.start()
+            _threads.append(_thread)
+
+        self.stage_times = {'resize': 0.0}
+        try:
+            # Resized images, indexed by resolution.
+            _resized = {}
+
+            for _mode in _modes:
+                _resolution = get_mode(_mode)['resolution']
+
+                if (_resolution not in _resized) and (entry != None) and (self.best_store.variant(entry, _resolution) != None):
+                    _resized[_resolution] = self.best_store.variant(entry, _resolution)
+
+                if _resolution not in _resized:
+                    if len(_resized) == 0:
+                        _filename = capture_filename_small
+                    else:
+                        _filename = capture_filename_small.replace(".png", "_%dx%d.png" % _resolution)
+
+                    # Resize the image.
+                    _resize_start = monotonic()
+                    _resize_ok = self.resize(capture_filename_full, _filename, resolution=_resolution)
+                    self.stage_times['resize'] += monotonic() - _resize_start
+                    if not _resize_ok:
+                        _resized[_resolution] = None
+                    else:
+                        _resized[_resolution] = _filename
+
+                        # Otherwise, proceed to post-processing step.
+                        if post_process_ptr_small != None:
+                            try:
+                                self.debug_message("Running Image Post-Processing (Resized)")
+                                post_process_ptr_small(_filename)
+                            except:
+                                error_str = traceback.format_exc()
+                                self.debug_message("Image Post-Processing Failed: %s" % error_str)
+
+                        if entry != None:
+                            self.best_store.add_variant(entry, _resolution, _filename)
+
+                if _resized[_resolution] == None:
+                    _encoded[_mode] = "FAIL"
+                    _encoded_events[_mode].set()
+                    continue
+
+                if (entry != None) and (self.best_store.audio(entry, _mode) != None):
+                    _encoded[_mode] = self.best_store.audio(entry, _mode)
+                    _encoded_events[_mode].set()
+                    continue
+
+                # Wake the radios up in time for the end of the encode.
+                for (_radio, _radio_mode) in _radio_modes:
+                    if (_radio_mode == _mode) and (_radio != None) and (_radio.power_manager != None):
+                        _radio.power_manager.schedule_wake(monotonic() + self.expected_encode_time())
+
+                # SSTV'ify the image.
+                if len(_modes) == 1:
+                    _temp_filename = "%s.png" % self.temp_filename_prefix
+                else:
+                    _temp_filename = "%s_%s.png" % (self.temp_filename_prefix, _mode)
+                _encode_start = monotonic()
+                _encoded[_mode] = self.sstvify(_resized[_resolution], temp_filename=_temp_filename, tx_mode=_mode)
+                self.encode_times.append(monotonic() - _encode_start)
+                self.encode_times = self.encode_times[-10:]
+                if _mode == self.tx_mode:
+                    self.stage_times['encode'] = self.encode_times[-1]
+                if (entry != None) and (_encoded[_mode] != "FAIL"):
+                    self.best_store.add_audio(entry, _mode, _encoded[_mode])
+                _encoded_events[_mode].set()
+
+        finally:
+            # Make sure no transmit thread is left waiting.
+            for _mode in _modes:
+                _encoded_events[_mode].set()
+            for _thread in _threads:
+                _thread.join()
+
+        # If we already had to wait for a channel to clear, we can wait that much less before the next image.
+        self.channel_wait = min(_channel_waits) if len(_channel_waits) > 0 else 0.0
+        self.stage_times['channel_wait'] = self.channel_wait
+        if self.tx_mode in _airtimes:
+            (_airtime, _overhead, _end) = max(_airtimes[self.tx_mode])
+            self.stage_times['airtime'] = _airtime
+            self.stage_times['tx_overhead'] = _overhead
+            self.tx_start = _end - _airtime
+
+        return len(_channel_waits) > 0
+
 
     auto_capture_running = False
     def auto_capture(self, destination_directory, post_process_ptr=None, post_process_ptr_small=None, post_tx_function=None, delay = 0):
@@ -242,6 +989,7 @@ class SSTVPiCam(object):
         
         Keyword Arguments:
         destination_directory:  Folder to save images to. Raw JPG images are saved here.
+                                If we have an archive writer, images are archived to its directory instead.
         post_process_ptr: An optional function which is called after the image is captured. This function
                           will be passed the path/filename of the captured image.
                           This can be used to add overlays, etc to the image before it is SSDVified and transmitted.
@@ -253,37 +1001,72 @@ class SSTVPiCam(object):
         post_tx_function: An optional function which is called after the image has been transmitted.
         delay:  An optional delay in seconds between capturing images. Defaults to 0.
                 This delay is added on top of any delays caused while waiting for the transmit queue to empty.
+                Any time spent waiting for a clear channel counts towards this delay.
         """
 
+        # Tune to the first channel while we capture the first image.
+        self.next_channel()
 
         while self.auto_capture_running:
 
+            # Let the scheduler pick the mode and delay for this image.
+            if self.scheduler != None:
+                (_mode, _delay) = self.scheduler.plan()
+                if _mode != self.tx_mode:
+                    self.debug_message("Scheduler selected %s (%.1f s airtime)." % (get_mode(_mode)['name'], airtime(_mode)))
+                    self.set_mode(_mode)
+                sleep(_delay)
+
             # Grab current timestamp.
             capture_time = datetime.datetime.utcnow().strftime("%Y%m%d-%H%M%SZ")
-            capture_filename_full = destination_directory + "/%s_picam.jpg" % capture_time
-            capture_filename_small = destination_directory + "/%s_picam_small.png" % capture_time
+            # With an archive writer, work in its incoming directory, and hand the files over once transmitted.
+            _work_directory = self.archive.incoming if self.archive != None else destination_directory
+            capture_filename_full = _work_directory + "/%s_picam.jpg" % capture_time
+            capture_filename_small = _work_directory + "/%s_picam_small.png" % capture_time
+
+            # Every so often, repeat one of the best recent images instead of capturing a new one.
+            _entry = None
+            if (self.best_store != None) and self.best_store.repeat_due(self.tx_count):
+                _entry = self.best_store.best(max_age=self.best_store.repeat_window)
+
+            if _entry != None:
+                self.debug_message("Repeating stored image %d." % _entry)
+                _repeat_filename_small = _work_directory + "/%s_repeat_small.png" % capture_time
+                # Overlays must show the repeated image's capture state, not ours. The stored resized images were
+                # post-processed when the image was captured, and are sent as they are. Any other resolution is
+                # post-processed with capture_position set to the stored position, or not at all if there isn't one.
+                self.capture_time = None
+                self.capture_position = self.best_store.position(_entry)
+                _repeat_post_process = post_process_ptr_small if self.capture_position != None else None
+                _repeat_ok = self.encode_and_transmit(self.best_store.path(self.best_store.entries[_entry]['full']), _repeat_filename_small, _repeat_post_process, entry=_entry)
+                self.archive_capture(capture_time)
+                if _repeat_ok:
+                    self.best_store.mark_sent(_entry)
+                    self.stage_times['capture'] = 0.0
+                    self.finish_cycle(post_tx_function, delay)
+                    continue
+                self.debug_message("Repeat failed, capturing a new image.")
+                _entry = None
 
             # Attempt to capture.
+            _capture_start = monotonic()
             capture_successful = self.capture(capture_filename_full)
+            _capture_time = monotonic() - _capture_start
 
-			# If capture was unsuccessful, try again in a little bit
+			# If capture was unsuccessful, re-initialise the camera (falling back to a lower resolution,
+            # or the test card), and try again straight away.
             if not capture_successful:
-                sleep(5)
-
+                self.capture_failures += 1
+                if self.camera_failed_at is None:
+                    self.camera_failed_at = _capture_start
                 self.debug_message("Capture failed! Attempting to reset camera...")
-
-                try:
-                    self.cam.close()
-                except:
-                    self.debug_message("Closing camera object failed.")
-
-                try:
-                    self.init_camera()
-                except:
-                    self.debug_message("Error initializing camera!")
-                    sleep(1)
-
-                continue
+                self.recover_camera()
+                capture_successful = self.capture(capture_filename_full)
+                _capture_time = monotonic() - _capture_start
+                if not capture_successful:
+                    self.archive_capture(capture_time)
+                    sleep(5)
+                    continue
 
             # Otherwise, proceed to post-processing step.
             if post_process_ptr != None:
@@ -294,39 +1077,88 @@ class SSTVPiCam(object):
                     error_str = traceback.format_exc()
                     self.debug_message("Image Post-Processing Failed: %s" % error_str)
 
-            # Resize the image.
-            resize_successful = self.resize(capture_filename_full, capture_filename_small)
-
-            if not resize_successful:
+            # Skip (or demote) images which look the same as a recent transmission.
+            _action = 'send'
+            if (self.duplicate_filter != None) and (self.degraded != 'test_card'):
+                try:
+                    _action = self.duplicate_filter.check(capture_filename_full, self.tx_mode)
+                except Exception as e:
+                    self.debug_message("Could not check for a duplicate image: %s" % str(e))
+            if _action == 'skip':
+                self.archive_capture(capture_time, self.capture_position)
+                if self.scheduler == None:
+                    sleep(delay)
                 continue
 
-            # Otherwise, proceed to post-processing step.
-            if post_process_ptr_small != None:
+            # Offer the image to the best-image store. If it is kept, its resized and encoded variants are stored too.
+            if (self.best_store != None) and (_action == 'send') and (self.degraded != 'test_card'):
                 try:
-                    self.debug_message("Running Image Post-Processing (Resized)")
-                    post_process_ptr_small(capture_filename_small)
-                except:
-                    error_str = traceback.format_exc()
-                    self.debug_message("Image Post-Processing Failed: %s" % error_str)
+                    _entry = self.best_store.add(capture_filename_full, position=self.capture_position)
+                except Exception as e:
+                    self.debug_message("Could not add image to the best-image store: %s" % str(e))
 
-            # SSTV'ify the image.
-            sstv_filename = self.sstvify(capture_filename_small)
+            _normal_mode = self.tx_mode
+            if _action == 'demote':
+                self.set_mode(self.duplicate_filter.demote_mode)
 
-            # Check the SSDV Conversion has completed properly. If not, break.
-            if sstv_filename == "FAIL":
-                continue
+            try:
+                # Resize, SSTV'ify and transmit the image. If this failed, try again.
+                _transmitted = self.encode_and_transmit(capture_filename_full, capture_filename_small, post_process_ptr_small, entry=_entry)
+                self.archive_capture(capture_time, self.capture_position)
+                if not _transmitted:
+                    continue
+
+                if self.duplicate_filter != None:
+                    self.duplicate_filter.transmitted()
+                self.stage_times['capture'] = _capture_time
+                if self.settle_time != None:
+                    self.stage_times['settle'] = self.settle_time
+                self.finish_cycle(post_tx_function, delay)
+            finally:
+                self.set_mode(_normal_mode)
+        # Loop!
 
-            # Transmit the image. TODO: Make this non-blocking.
-            self.transmit_image(sstv_filename)
+        self.debug_message("Exited auto capture thread!")
 
-            if post_tx_function != None:
-                post_tx_function()
 
-            # Sleep before capturing next image.
-            sleep(delay)
-        # Loop!
+    def archive_capture(self, capture_time, position=None):
+        """ Hand the work files of a capture (except a full resolution still, which is archived once it has been
+        captured) over to the archive writer. If a position is supplied, the captured JPEG is GPS tagged with it. """
+        if self.archive is None:
+            return
+        for _filename in glob.glob(os.path.join(self.archive.incoming, "%s_*" % capture_time)):
+            if not os.path.splitext(_filename)[0].endswith("_full"):
+                self.archive.put(_filename, remove=True, position=position)
 
-        self.debug_message("Exited auto capture thread!")
+
+    def finish_cycle(self, post_tx_function=None, delay=0):
+        """ Record the timings of a transmitted image, then power down and retune for the next one. """
+        self.tx_count += 1
+
+        if self.scheduler != None:
+            self.scheduler.record_cycle(self.tx_mode, self.stage_times, tx_start=self.tx_start)
+
+        if post_tx_function != None:
+            post_tx_function()
+
+        # Retune for the next image while we sleep/capture.
+        self.next_channel()
+
+        # Power the radio(s) down until the next image is ready. If the PTT is locked on (which the transmit
+        # queue ignores), the transmitter is meant to stay keyed, so leave it powered.
+        for _radio in (self.radios or []):
+            if self.ptt_locked and (_radio.tx_queue is None):
+                continue
+            if _radio.power_manager != None:
+                _radio.power_manager.power_down()
+                _stats = _radio.power_manager.stats()
+                self.debug_message("Radio %s powered %.1f%% of the time, transmitting %.1f%%, wake latency %d ms." % (
+                    _radio.name, _stats['powered_fraction']*100.0, _stats['transmit_fraction']*100.0, int(_stats['wake_latency']*1000)))
+
+        # Sleep before capturing next image (unless the scheduler is choosing the delay).
+        # If we already had to wait for the channel to clear, don't wait again.
+        if self.scheduler == None:
+            sleep(max(0, delay - self.channel_wait))
 
 
     def run(self, destination_directory, post_process_ptr=None, post_process_ptr_small=None, post_tx_function=None, delay = 0):
@@ -350,14 +1182,14 @@ class SSTVPiCam(object):
 
         self.auto_capture_running = True
 
-        capture_thread = Thread(target=self.auto_capture, kwargs=dict(
+        self.capture_thread = Thread(target=self.auto_capture, kwargs=dict(
             destination_directory=destination_directory,
             post_process_ptr=post_process_ptr,
             post_process_ptr_small=post_process_ptr_small,
             post_tx_function=post_tx_function,
             delay=delay))
 
-        capture_thread.start()
+        self.capture_thread.start()
 
     def stop(self):
         self.auto_capture_running = False
@@ -396,6 +1228,12 @@ if __name__ == "__main__":
                 gps_state = gps.read_state()
                 print("Current GPS State: " + str(gps_state))
 
+                # Prefer the position at the time the image was actually taken. This is None if the
+                # capture was more than max_extrapolation from a fix, in which case the last real fix is shown.
+                if picam.capture_position != None:
+                    gps_state.update(picam.capture_position)
+                    print("Position at capture time: " + str(picam.capture_position))
+
                 # Format time
                 short_time = gps_state['datetime'].strftime("%Y-%m-%d %H:%M:%S")
 
@@ -457,9 +1295,11 @@ if __name__ == "__main__":
     dra818_high_power(False)
 
     # Initialize the SSTV Image Capture/Encode class.
+    # See the README for the optional features (archiving, audio cache, best-image repeats, transmit queue etc.).
     picam = SSTVPiCam(
-        tx_mode = "pd120", # Valid modes: s2, r36, pd120
-        num_images = 5
+        tx_mode = "pd120", # Refer sstv_modes.py for valid modes.
+        num_images = 5,
+        position_ptr = gps.position_at if gps != None else None
         )
 
     picam.run(destination_directory="./tx_images/",
@@ -474,4 +1314,3 @@ if __name__ == "__main__":
     except KeyboardInterrupt:
         print("Closing")
         picam.stop()
-
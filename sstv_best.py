@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+'''
+Persistent store of the best images captured so far.
+
+capture() only picks the best image within one burst, so during ascent (sun glare, a spinning payload)
+most transmitted frames are mediocre. BestImageStore keeps the top-K images seen so far (by the same
+score used for burst selection), along with their resized and SSTV-encoded variants, so that repeats of
+the best recent images can be transmitted without recapturing, resizing or re-encoding them.
+
+The store is a min-heap of scores (the worst kept image is replaced first) over a directory of files,
+with a compact JSON index which is rewritten atomically on each change, so it survives restarts.
+
+Released under GNU GPL version 3 or later
+'''
+
+import argparse
+import datetime
+import heapq
+import io
+import json
+import os
+import shutil
+import sys
+import time
+from threading import Lock
+
+from PIL import Image
+
+# Images are scored on a thumbnail of this size, re-encoded as a JPEG at this quality (see image_score()).
+SCORE_SIZE = (320, 240)
+SCORE_QUALITY = 75
+
+
+def image_score(filename):
+    ''' Score an image, for burst selection and the best-image store. Higher is better.
+    The image is scaled to a SCORE_SIZE thumbnail and re-encoded as a JPEG at SCORE_QUALITY, and the score
+    is the size of that JPEG in kB: sharp, detailed images compress less than blurred or washed-out ones.
+    The size of the original file isn't used, as JPEG bytes per pixel fall as the resolution rises, so
+    ring frames and full resolution stills would not be compared fairly.
+    Images which cannot be read score 0. '''
+    try:
+        with Image.open(filename) as _image:
+            # Let the JPEG decoder scale the image down as it decodes, which is much faster than a full decode.
+            # Stopping at twice the thumbnail size leaves the final scaling to resize(), which is the same
+            # for all images, so the decoder's scaling doesn't change the score.
+            _image.draft('RGB', (2*SCORE_SIZE[0], 2*SCORE_SIZE[1]))
+            _thumbnail = _image.convert('RGB').resize(SCORE_SIZE, Image.BILINEAR)
+        _output = io.BytesIO()
+        _thumbnail.save(_output, format='JPEG', quality=SCORE_QUALITY)
+    except Exception:
+        return 0.0
+    return len(_output.getvalue())/1024.0
+
+
+class BestImageStore(object):
+    ''' Bounded, persistent top-K store of images, with their resized and encoded variants. '''
+
+    def __init__(self,
+                directory='./best_images',
+                capacity=10,
+                repeat_every=0,
+                repeat_window=3600,
+                debug_ptr=None):
+        ''' Initialise a BestImageStore, loading the index if one exists.
+
+        Keyword Arguments:
+        directory: Directory to store images (and the index) in. Created if it does not exist.
+        capacity: Number of images to keep.
+        repeat_every: If non-zero, every repeat_every'th transmission is a repeat of one of the best images
+                      captured in the last repeat_window seconds, instead of a new capture (see repeat_due()).
+        repeat_window: Age (seconds) of the oldest image which is repeated.
+        debug_ptr: Reference to a function which can handle debug messages.
+        '''
+        self.directory = directory
+        self.capacity = capacity
+        self.repeat_every = repeat_every
+        self.repeat_window = repeat_window
+        self.debug_ptr = debug_ptr
+
+        self.lock = Lock()
+        # Entries, indexed by id. Each entry is a dictionary containing:
+        #   id, score, time (capture time, seconds since the epoch), position (at capture time, or None),
+        #   full (full-size image filename), variants (resized image filenames, indexed by 'WxH'),
+        #   audio (encoded audio filenames, indexed by SSTV mode), sent (number of times repeated), last_sent.
+        self.entries = {}
+        # Min-heap of (score, id), so the worst image is at the top.
+        self.heap = []
+        self.next_id = 0
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self.load()
+
+    def debug_message(self, message):
+        ''' Write a debug message, either to the debug_ptr function, or to stdout. '''
+        message = "Best Images: " + message
+        if self.debug_ptr != None:
+            self.debug_ptr(message)
+        else:
+            print(message)
+
+    def index_filename(self):
+        return os.path.join(self.directory, 'index.json')
+
+    def load(self):
+        ''' Load the index, dropping any entries whose full-size image is missing. '''
+        if not os.path.isfile(self.index_filename()):
+            return
+        try:
+            with open(self.index_filename(), 'r') as _f:
+                _index = json.load(_f)
+        except Exception as e:
+            self.debug_message("Could not load index - %s" % str(e))
+            return
+
+        self.next_id = _index.get('next_id', 0)
+        for _entry in _index.get('entries', []):
+            if not os.path.isfile(os.path.join(self.directory, _entry['full'])):
+                continue
+            # Forget any variants which have gone missing.
+            for _kind in ('variants', 'audio'):
+                _entry[_kind] = {_k: _v for (_k, _v) in _entry[_kind].items() if os.path.isfile(os.path.join(self.directory, _v))}
+            # Re-score, in case the index was written with a different scoring.
+            try:
+                _entry['score'] = image_score(os.path.join(self.directory, _entry['full']))
+            except Exception:
+                continue
+            self.entries[_entry['id']] = _entry
+
+        self.heap = [(_entry['score'], _id) for (_id, _entry) in self.entries.items()]
+        heapq.heapify(self.heap)
+        while len(self.heap) > self.capacity:
+            self.remove(heapq.heappop(self.heap)[1])
+
+    def save(self):
+        ''' Write the index, via a temporary file, so a crash cannot leave a partial index. '''
+        _index = {'next_id': self.next_id, 'entries': list(self.entries.values())}
+        _temp = self.index_filename() + ".tmp"
+        with open(_temp, 'w') as _f:
+            json.dump(_index, _f, separators=(',', ':'))
+        os.rename(_temp, self.index_filename())
+
+    def path(self, filename):
+        ''' Full path of a file in the store. '''
+        return os.path.join(self.directory, filename)
+
+    def remove(self, entry_id):
+        ''' Delete an entry and its files (the caller must remove it from the heap). '''
+        _entry = self.entries.pop(entry_id)
+        for _filename in [_entry['full']] + list(_entry['variants'].values()) + list(_entry['audio'].values()):
+            try:
+                os.remove(self.path(_filename))
+            except OSError:
+                pass
+
+    def add(self, filename, score=None, capture_time=None, position=None):
+        ''' Offer a full-size image to the store. If it scores better than the worst image kept (or the
+        store is not yet full), it is copied into the store, replacing the worst image.
+        Returns the new entry id, or None if the image was not kept. '''
+        if score is None:
+            score = image_score(filename)
+
+        with self.lock:
+            if (len(self.heap) >= self.capacity) and (score <= self.heap[0][0]):
+                return None
+
+            _id = self.next_id
+            self.next_id += 1
+            _full = "%d%s" % (_id, os.path.splitext(filename)[1])
+            shutil.copyfile(filename, self.path(_full))
+
+            if position != None:
+                position = {_k: position[_k] for _k in ('latitude', 'longitude', 'altitude', 'datetime') if _k in position}
+                if isinstance(position.get('datetime'), datetime.datetime):
+                    position['datetime'] = position['datetime'].isoformat()
+
+            self.entries[_id] = {
+                'id': _id,
+                'score': score,
+                'time': capture_time if capture_time != None else time.time(),
+                'position': position,
+                'full': _full,
+                'variants': {},
+                'audio': {},
+                'sent': 0,
+                'last_sent': None
+            }
+
+            if len(self.heap) >= self.capacity:
+                (_score, _worst) = heapq.heapreplace(self.heap, (score, _id))
+                self.remove(_worst)
+            else:
+                heapq.heappush(self.heap, (score, _id))
+
+            self.save()
+            return _id
+
+    def add_file(self, entry_id, kind, key, filename):
+        ''' Copy a derived file (kind = 'variants' or 'audio') into an entry. Ignored if the entry has gone. '''
+        with self.lock:
+            if entry_id not in self.entries:
+                return
+            _stored = "%d_%s%s" % (entry_id, key, os.path.splitext(filename)[1])
+            try:
+                shutil.copyfile(filename, self.path(_stored))
+            except (IOError, OSError) as e:
+                self.debug_message("Could not store %s - %s" % (filename, str(e)))
+                return
+            self.entries[entry_id][kind][key] = _stored
+            self.save()
+
+    def add_variant(self, entry_id, resolution, filename):
+        ''' Store a resized (and post-processed) copy of an entry's image. '''
+        self.add_file(entry_id, 'variants', "%dx%d" % resolution, filename)
+
+    def add_audio(self, entry_id, mode, filename):
+        ''' Store the SSTV audio for an entry's image, encoded in mode. '''
+        self.add_file(entry_id, 'audio', mode, filename)
+
+    def variant(self, entry_id, resolution):
+        ''' Path of an entry's resized image at resolution, or None. '''
+        _entry = self.entries.get(entry_id)
+        if (_entry is None) or ("%dx%d" % resolution not in _entry['variants']):
+            return None
+        return self.path(_entry['variants']["%dx%d" % resolution])
+
+    def audio(self, entry_id, mode):
+        ''' Path of an entry's encoded audio in mode, or None. '''
+        _entry = self.entries.get(entry_id)
+        if (_entry is None) or (mode not in _entry['audio']):
+            return None
+        return self.path(_entry['audio'][mode])
+
+    def position(self, entry_id):
+        ''' The position stored with an entry (as passed to add(), with its datetime restored), or None. '''
+        _entry = self.entries.get(entry_id)
+        if (_entry is None) or (_entry['position'] is None):
+            return None
+        _position = dict(_entry['position'])
+        if 'datetime' in _position:
+            try:
+                _position['datetime'] = datetime.datetime.fromisoformat(_position['datetime'])
+            except (ValueError, TypeError):
+                del _position['datetime']
+        return _position
+
+    def repeat_due(self, tx_count):
+        ''' Return True if the transmission after tx_count transmissions should be a repeat. '''
+        return (self.repeat_every > 0) and (tx_count % self.repeat_every == self.repeat_every - 1)
+
+    def best(self, max_age=3600):
+        ''' Pick an image to repeat: the best scoring of the images captured within the last max_age seconds.
+        Images with the same score are rotated through, least recently repeated first.
+        Returns an entry id, or None. '''
+        _now = time.time()
+        with self.lock:
+            _recent = [_entry for _entry in self.entries.values() if (max_age is None) or (_now - _entry['time'] <= max_age)]
+            if len(_recent) == 0:
+                return None
+            return min(_recent, key=lambda _entry: (-_entry['score'], _entry['last_sent'] if _entry['last_sent'] != None else 0.0))['id']
+
+    def mark_sent(self, entry_id):
+        ''' Record that an entry has been repeated. '''
+        with self.lock:
+            if entry_id in self.entries:
+                self.entries[entry_id]['sent'] += 1
+                self.entries[entry_id]['last_sent'] = time.time()
+                self.save()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("directory", nargs='?', default='./best_images', help="Store directory.")
+    args = parser.parse_args()
+
+    _store = BestImageStore(directory=args.directory)
+    for (_score, _id) in sorted(_store.heap, reverse=True):
+        _entry = _store.entries[_id]
+        print("%4d  score %6.3f  %s  sent %d  variants: %s  audio: %s" % (_id, _score,
+            time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(_entry['time'])), _entry['sent'],
+            ", ".join(sorted(_entry['variants'].keys())), ", ".join(sorted(_entry['audio'].keys()))))
+    sys.exit(0)
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+'''
+Content-addressed cache of encoded SSTV audio.
+
+Encoded WAV files are stored in a cache directory, named by a hash of the image pixels, SSTV mode,
+sample rate and encoder version, so re-sending an image (a repeat of the best picture, a test card,
+or a fallback image when the camera fails) costs only a hash and a lookup, rather than a re-encode.
+
+An index of the cached files is kept in memory, in least-recently-used order, and the oldest entries
+are removed once the cache exceeds its size limit. The index is rebuilt from the directory (in order
+of file modification time, which is updated on each hit) at startup.
+
+Released under GNU GPL version 3 or later
+'''
+
+import argparse
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+from threading import Lock
+
+from PIL import Image
+from sstv_modes import get_mode
+
+
+class SSTVAudioCache(object):
+    ''' Size-bounded LRU cache of encoded SSTV audio, keyed by image content. '''
+
+    def __init__(self,
+                directory='./sstv_cache',
+                max_bytes=200*1024*1024,
+                debug_ptr=None):
+        ''' Initialise a SSTVAudioCache.
+
+        Keyword Arguments:
+        directory: Directory to store cached WAV files in. Created if it does not exist.
+        max_bytes: Maximum total size of the cached files. The least recently used files are removed beyond this.
+        debug_ptr: Reference to a function which can handle debug messages.
+        '''
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.debug_ptr = debug_ptr
+
+        self.lock = Lock()
+        # Cached files (key -> size in bytes), least recently used first.
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+
+        # Statistics
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self.load_index()
+
+    def debug_message(self, message):
+        ''' Write a debug message, either to the debug_ptr function, or to stdout. '''
+        message = "SSTV Cache: " + message
+        if self.debug_ptr != None:
+            self.debug_ptr(message)
+        else:
+            print(message)
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".wav")
+
+    def load_index(self):
+        ''' Rebuild the index from the cache directory, oldest (least recently used) first. '''
+        _files = []
+        for _name in os.listdir(self.directory):
+            if _name.endswith(".wav"):
+                _stat = os.stat(os.path.join(self.directory, _name))
+                _files.append((_stat.st_mtime, _name[:-4], _stat.st_size))
+
+        self.entries = OrderedDict([(_key, _size) for (_mtime, _key, _size) in sorted(_files)])
+        self.total_bytes = sum(self.entries.values())
+        self.evict()
+
+    def key(self, image, mode, sample_rate, encoder):
+        ''' Cache key for an image (filename or PIL Image), encoded in mode at sample_rate by encoder
+        (an encoder name and version string). Only the decoded pixels are hashed, so re-saving an image
+        (e.g. with different PNG metadata) does not change the key. '''
+        if not isinstance(image, Image.Image):
+            image = Image.open(image)
+        image = image.convert('RGB')
+
+        _hash = hashlib.sha1()
+        _hash.update(("%s|%d|%s|%dx%d|" % (mode, sample_rate, encoder, image.size[0], image.size[1])).encode('ascii'))
+        _hash.update(image.tobytes())
+        return _hash.hexdigest()
+
+    def get(self, key):
+        ''' Look up a key. Returns the path of the cached WAV file, or None if it is not cached. '''
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+
+            _path = self.path(key)
+            try:
+                # Record the access, so the LRU order survives a restart.
+                os.utime(_path, None)
+            except OSError:
+                # The file has been removed from under us.
+                self.total_bytes -= self.entries.pop(key)
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return _path
+
+    def put(self, key, filename):
+        ''' Add an encoded WAV file to the cache (the file is copied). Returns the path of the cached copy. '''
+        _path = self.path(key)
+        # Copy to a temporary file first, so a partial file is never seen as a cache entry.
+        _temp = _path + ".tmp"
+        shutil.copyfile(filename, _temp)
+        os.rename(_temp, _path)
+        _size = os.path.getsize(_path)
+
+        with self.lock:
+            if key in self.entries:
+                self.total_bytes -= self.entries.pop(key)
+            self.entries[key] = _size
+            self.total_bytes += _size
+            self.evict(keep=key)
+
+        return _path
+
+    def evict(self, keep=None):
+        ''' Remove least recently used files until the cache is within max_bytes. '''
+        while (self.total_bytes > self.max_bytes) and (len(self.entries) > 0):
+            _key = next(iter(self.entries))
+            if _key == keep:
+                break
+            self.total_bytes -= self.entries.pop(_key)
+            self.evictions += 1
+            try:
+                os.remove(self.path(_key))
+            except OSError:
+                pass
+
+    def stats(self):
+        _lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits/float(_lookups) if _lookups > 0 else 0.0,
+            'evictions': self.evictions,
+            'entries': len(self.entries),
+            'bytes': self.total_bytes
+        }
+
+
+def benchmark_cache(mode='pd120', sample_rate=22050):
+    ''' Compare the time to encode an image, against the time to look it up in the cache. '''
+    from sstv_encoder import encode_file, test_card, ENCODER_VERSION
+
+    _dir = tempfile.mkdtemp()
+    _cache = SSTVAudioCache(directory=os.path.join(_dir, 'cache'))
+    _png = os.path.join(_dir, 'test_card.png')
+    _wav = _png + ".wav"
+    Image.fromarray(test_card(get_mode(mode)['resolution'])).save(_png)
+
+    _start = time.perf_counter()
+    _key = _cache.key(_png, mode, sample_rate, ENCODER_VERSION)
+    if _cache.get(_key) is None:
+        encode_file(_png, _wav, mode=mode, sample_rate=sample_rate)
+        _cache.put(_key, _wav)
+    _miss = time.perf_counter() - _start
+
+    _start = time.perf_counter()
+    _key = _cache.key(_png, mode, sample_rate, ENCODER_VERSION)
+    _path = _cache.get(_key)
+    _hit = time.perf_counter() - _start
+
+    print("%s at %d Hz: miss (hash + encode + store) %.3f s, hit (hash + lookup) %.3f s. %s" % (
+        mode, sample_rate, _miss, _hit, str(_cache.stats())))
+    shutil.rmtree(_dir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("directory", nargs='?', default='./sstv_cache', help="Cache directory.")
+    parser.add_argument("--benchmark", action="store_true", default=False, help="Compare encode and cache lookup times, then exit.")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark_cache()
+        sys.exit(0)
+
+    _cache = SSTVAudioCache(directory=args.directory)
+    print("%s: %d entries, %.1f MB." % (args.directory, len(_cache.entries), _cache.total_bytes/1048576.0))
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+'''
+Perceptual-hash deduplication of captured frames.
+
+Before launch, or when the payload is hanging still, consecutive frames are visually identical, and
+each one costs minutes of airtime. DuplicateFilter keeps a perceptual hash of each recently transmitted
+frame, and flags new frames within a Hamming distance of any of them, so they can be skipped, or sent
+in a faster mode.
+
+The hash is a DCT pHash: the image is reduced to a 32x32 luma plane, and each bit of the 64-bit hash
+is whether one of the lowest 8x8 DCT coefficients is above their median. This ignores noise, JPEG
+artefacts and small exposure changes, but not changes in the scene.
+
+Released under GNU GPL version 3 or later
+'''
+
+import argparse
+import math
+import sys
+from collections import deque
+
+from PIL import Image
+from sstv_modes import airtime
+
+# Size of the reduced luma plane, and of the block of low-frequency DCT coefficients used in the hash.
+PHASH_SIZE = 32
+PHASH_BITS = 8
+
+# DCT-II basis, for the coefficients we use.
+_DCT = [[math.cos(math.pi*(2*n + 1)*k/(2.0*PHASH_SIZE)) for n in range(PHASH_SIZE)] for k in range(PHASH_BITS)]
+
+
+def phash(image):
+    ''' 64-bit DCT perceptual hash of an image (filename or PIL Image). '''
+    if not isinstance(image, Image.Image):
+        image = Image.open(image)
+    # For JPEGs, let the decoder scale the image down (in the DCT domain), rather than decoding full size.
+    image.draft('L', (4*PHASH_SIZE, 4*PHASH_SIZE))
+    _pixels = list(image.convert('L').resize((PHASH_SIZE, PHASH_SIZE), Image.BILINEAR).tobytes())
+    _rows = [_pixels[i*PHASH_SIZE:(i + 1)*PHASH_SIZE] for i in range(PHASH_SIZE)]
+
+    # Separable 2D DCT, of the low-frequency block only: first along each row, then down each column.
+    _row_dct = [[sum([_basis[n]*_row[n] for n in range(PHASH_SIZE)]) for _basis in _DCT] for _row in _rows]
+    _coeffs = []
+    for _v in range(PHASH_BITS):
+        for _u in range(PHASH_BITS):
+            _coeffs.append(sum([_DCT[_v][m]*_row_dct[m][_u] for m in range(PHASH_SIZE)]))
+
+    # The DC term only reflects overall brightness, so leave it out of the median.
+    _median = sorted(_coeffs[1:])[len(_coeffs[1:])//2]
+    _hash = 0
+    for _coeff in _coeffs:
+        _hash = (_hash << 1) | (1 if _coeff > _median else 0)
+    return _hash
+
+
+def hamming(a, b):
+    ''' Number of differing bits between two hashes. '''
+    return bin(a ^ b).count('1')
+
+
+class DuplicateFilter(object):
+    ''' Flags captured frames which are near-duplicates of recently transmitted ones. '''
+
+    def __init__(self,
+                threshold=8,
+                history=4,
+                action='skip',
+                demote_mode='r36',
+                max_skips=10,
+                debug_ptr=None):
+        ''' Initialise a DuplicateFilter.
+
+        Keyword Arguments:
+        threshold: Frames with a hash within this Hamming distance (of 64 bits) of a recent transmission are duplicates.
+        history: Number of recent transmissions to compare against.
+        action: What to do with duplicates - 'skip' (don't transmit them), or 'demote' (transmit them in demote_mode).
+        demote_mode: SSTV mode to transmit duplicates in, if action is 'demote'.
+        max_skips: After this many consecutive skipped frames, transmit one anyway (so there is still some sign
+                   of life on the channel). 0 = skip indefinitely.
+        debug_ptr: Reference to a function which can handle debug messages.
+        '''
+        if action not in ('skip', 'demote'):
+            raise ValueError("action must be 'skip' or 'demote'.")
+        self.threshold = threshold
+        self.action = action
+        self.demote_mode = demote_mode
+        self.max_skips = max_skips
+        self.debug_ptr = debug_ptr
+
+        self.recent = deque(maxlen=history)
+        # Hash and distance (to the nearest recent transmission) of the last frame checked.
+        self.last_hash = None
+        self.last_distance = None
+        self.consecutive_skips = 0
+
+        # Statistics
+        self.checked = 0
+        self.skipped = 0
+        self.demoted = 0
+        self.airtime_saved = 0.0
+
+    def debug_message(self, message):
+        ''' Write a debug message, either to the debug_ptr function, or to stdout. '''
+        message = "Duplicate Filter: " + message
+        if self.debug_ptr != None:
+            self.debug_ptr(message)
+        else:
+            print(message)
+
+    def check(self, image, mode):
+        ''' Check a captured frame, which would be transmitted in mode.
+        Returns 'send', 'skip' or 'demote'. Call transmitted() if the frame is then sent. '''
+        self.checked += 1
+        self.last_hash = phash(image)
+        self.last_distance = min([hamming(self.last_hash, _hash) for _hash in self.recent]) if len(self.recent) > 0 else None
+
+        if (self.last_distance is None) or (self.last_distance > self.threshold):
+            self.consecutive_skips = 0
+            return 'send'
+
+        if self.action == 'demote':
+            _saved = max(0.0, airtime(mode) - airtime(self.demote_mode))
+            if _saved == 0:
+                return 'send'
+            self.demoted += 1
+            self.airtime_saved += _saved
+            self.debug_message("Frame is within %d bits of a recent transmission, sending in %s. %.0f s airtime saved so far." % (
+                self.last_distance, self.demote_mode, self.airtime_saved))
+            return 'demote'
+
+        if (self.max_skips > 0) and (self.consecutive_skips >= self.max_skips):
+            self.consecutive_skips = 0
+            return 'send'
+
+        self.consecutive_skips += 1
+        self.skipped += 1
+        self.airtime_saved += airtime(mode)
+        self.debug_message("Frame is within %d bits of a recent transmission, skipping. %.0f s airtime saved so far." % (
+            self.last_distance, self.airtime_saved))
+        return 'skip'
+
+    def transmitted(self):
+        ''' Record that the last checked frame was transmitted. '''
+        if self.last_hash != None:
+            self.recent.append(self.last_hash)
+
+    def stats(self):
+        return {
+            'checked': self.checked,
+            'skipped': self.skipped,
+            'demoted': self.demoted,
+            'airtime_saved': self.airtime_saved
+        }
+
+
+def test_distances():
+    ''' Print hash distances between a synthetic scene, slightly altered copies of it (noise, brightness,
+    a small shift, JPEG recompression), and different scenes, to help choose a threshold. '''
+    import io
+    import random
+
+    def _scene(seed):
+        _r = random.Random(seed)
+        _image = Image.new('RGB', (640, 480), (_r.randint(0, 255), _r.randint(0, 255), _r.randint(0, 255)))
+        for i in range(12):
+            _x = _r.randint(0, 600)
+            _y = _r.randint(0, 440)
+            _image.paste((_r.randint(0, 255), _r.randint(0, 255), _r.randint(0, 255)), (_x, _y, _x + _r.randint(40, 300), _y + _r.randint(40, 300)))
+        return _image
+
+    _base = _scene(1)
+    _noisy = Image.blend(_base, Image.effect_noise(_base.size, 64).convert('RGB'), 0.15)
+    _brighter = Image.eval(_base, lambda v: min(255, int(v*1.15)))
+    _shifted = _base.transform(_base.size, Image.AFFINE, (1, 0, 6, 0, 1, 4))
+    _buffer = io.BytesIO()
+    _base.save(_buffer, 'JPEG', quality=30)
+    _jpeg = Image.open(io.BytesIO(_buffer.getvalue()))
+
+    _hash = phash(_base)
+    for (_name, _image) in [('noise', _noisy), ('brightness +15%', _brighter), ('shifted 6 px', _shifted), ('JPEG q30', _jpeg)]:
+        print("%-28s %2d bits" % ("Same scene, %s:" % _name, hamming(_hash, phash(_image))))
+    for _seed in range(2, 6):
+        print("%-28s %2d bits" % ("Different scene %d:" % _seed, hamming(_hash, phash(_scene(_seed)))))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("images", nargs='*', help="Images to hash. Distances from the first image are printed.")
+    parser.add_argument("--test", action="store_true", default=False, help="Print distances between synthetic test scenes, then exit.")
+    args = parser.parse_args()
+
+    if args.test or len(args.images) == 0:
+        test_distances()
+        sys.exit(0)
+
+    _first = phash(args.images[0])
+    for _filename in args.images:
+        _hash = phash(_filename)
+        print("%016x  %2d  %s" % (_hash, hamming(_first, _hash), _filename))
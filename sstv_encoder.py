@@ -0,0 +1,817 @@
+#!/usr/bin/env python
+'''
+Fixed-point SSTV encoder.
+
+A low-CPU alternative to pisstv, for single-core boards where capture, GPS parsing and encoding
+all share one slow CPU. Audio is synthesised as int16 samples from a sine lookup table, indexed by
+a 32-bit integer phase accumulator. The work is done with numpy array operations, a block of lines
+at a time, so there is no per-sample Python loop and no per-sample sin() call.
+
+All segment timing is kept in integer nanoseconds, and each segment boundary is rounded to the
+nearest sample from its absolute start time, so timing errors do not accumulate across an image.
+Pixel frequencies are kept in units of 1/255 Hz, so they are exact integers.
+
+An image can also be split into bands of lines, and the bands synthesised in a process pool (one per
+core). The phase accumulator value at the start of each band is computed up front from the segment
+frequencies and sample counts (which is cheap, compared to synthesis), so the stitched output is
+bit-identical to a serial encode.
+
+Audio should be synthesised at the output device's native sample rate (see tx_queue.device_sample_rate()),
+so ALSA does not have to resample it on the CPU during playback. Segment timing depends only on the mode
+and sample rate, so the sample count of every segment is calculated once per (mode, rate), and cached.
+
+Mode timing, resolution and colour encoding parameters come from the registry in sstv_modes.py.
+
+Released under GNU GPL version 3 or later
+'''
+
+import argparse
+import multiprocessing
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import wave
+from threading import Lock
+
+from PIL import Image
+from sstv_modes import *
+
+try:
+    import numpy as np
+except ImportError:
+    print("ERROR: Could not load numpy. The fixed-point SSTV encoder is not available.")
+    np = None
+
+# Encoder name and version, used to key cached audio (see sstv_cache.py). Change this if the output changes.
+ENCODER_VERSION = "fixed-1"
+
+# Frequencies are handled in units of 1/FREQ_SCALE Hz, so pixel frequencies (1500 + 800*value/255 Hz) are integers.
+FREQ_SCALE = 255
+
+# Phase accumulator width and sine lookup table size (bits).
+PHASE_BITS = 32
+PHASE_MASK = (1 << PHASE_BITS) - 1
+LUT_BITS = 12
+
+# Start methods for encoder worker processes, in order of preference. The encoder is called from picam_sstv's
+# capture thread while the GPS, camera and transmit threads are running, and a child forked from a
+# multithreaded process can inherit locks that will never be released. A fork server (or a spawned process,
+# where fork servers are not available) starts workers from a clean, single-threaded process instead.
+POOL_START_METHODS = ['forkserver', 'spawn']
+
+# Output must be within this many dB of the floating point reference's power spectral density,
+# across the SSTV tone band (see compare()).
+SPECTRAL_TOLERANCE_DB = 0.5
+SPECTRAL_BAND = (1000, 2400)
+
+# Line layouts used by decode(), written out independently of sstv_modes.py from the published mode
+# specifications (times in ms), so a round trip checks the encoder against the specification rather than
+# against its own tables. One mode of each family. Each layout is one line (or line pair), with the index of
+# the sync pulse which the line is located by, and the number of line syncs per line (or line pair).
+# Scan channels are pixel values of G/B/R, or Y/R-Y/B-Y. Robot 36 alternates R-Y and B-Y between lines.
+DECODE_LAYOUTS = {
+    'r36': {'vis': 8, 'resolution': (320,240), 'lines': 2, 'sync': 0, 'syncs': 2,
+            'line': [('sync', 9.0), ('porch', 3.0), ('y0', 88.0), ('porch', 4.5), ('porch', 1.5), ('cr', 44.0),
+                     ('sync', 9.0), ('porch', 3.0), ('y1', 88.0), ('porch', 4.5), ('porch', 1.5), ('cb', 44.0)]},
+    'm1': {'vis': 44, 'resolution': (320,256), 'lines': 1, 'sync': 0, 'syncs': 1,
+            'line': [('sync', 4.862), ('porch', 0.572), ('g', 146.432), ('porch', 0.572), ('b', 146.432),
+                     ('porch', 0.572), ('r', 146.432), ('porch', 0.572)]},
+    's1': {'vis': 60, 'resolution': (320,256), 'lines': 1, 'sync': 4, 'syncs': 1,
+            'line': [('porch', 1.5), ('g', 138.24), ('porch', 1.5), ('b', 138.24), ('sync', 9.0), ('porch', 1.5),
+                     ('r', 138.24)]},
+    'pd120': {'vis': 95, 'resolution': (640,496), 'lines': 2, 'sync': 0, 'syncs': 1,
+            'line': [('sync', 20.0), ('porch', 2.08), ('y0', 121.6), ('cr', 121.6), ('cb', 121.6), ('y1', 121.6)]},
+}
+# Maximum line period error (ppm), and mean pixel error (0-255 levels) of a decoded round trip (see round_trip()).
+DECODE_PERIOD_TOLERANCE_PPM = 50.0
+DECODE_PIXEL_TOLERANCE = 3.0
+
+
+class FixedPointSSTVEncoder(object):
+    ''' Encode images to SSTV audio, using a sine lookup table and integer phase accumulators. '''
+
+    def __init__(self,
+                mode='pd120',
+                sample_rate=22050,
+                amplitude=26000,
+                block_units=16):
+        ''' Initialise a FixedPointSSTVEncoder.
+
+        Keyword Arguments:
+        mode: SSTV mode (short name, from sstv_modes.MODES).
+        sample_rate: Output sample rate (Hz).
+        amplitude: Peak output amplitude (int16 units).
+        block_units: Number of lines (or line pairs) synthesised per block. This bounds memory use.
+        '''
+        if np is None:
+            raise RuntimeError("numpy is required for the fixed-point SSTV encoder.")
+        self.mode_name = mode
+        self.mode = get_mode(mode)
+        self.sample_rate = sample_rate
+        self.amplitude = amplitude
+        self.block_units = block_units
+
+        # Process pool used for parallel encodes. Created on first use.
+        self.pool = None
+        self.pool_workers = 0
+
+        self.timing = timing_table(mode, sample_rate)
+
+        # Sine lookup table. This is the only place sin() is evaluated.
+        self.lut = np.round(amplitude*np.sin(2*np.pi*np.arange(1 << LUT_BITS)/(1 << LUT_BITS))).astype(np.int16)
+
+    def increments(self, freqs):
+        ''' Convert frequencies (in 1/FREQ_SCALE Hz units) to phase accumulator increments. '''
+        _divisor = FREQ_SCALE*self.sample_rate
+        return ((freqs.astype(np.int64) << PHASE_BITS) + _divisor//2) // _divisor
+
+    def sample_index(self, time_ns):
+        ''' Index of the sample nearest to a time (ns). Works on integers and integer arrays. '''
+        return sample_index(time_ns, self.sample_rate)
+
+    def tones(self, items):
+        ''' Convert a list of ('tone', frequency, duration) items to frequency and duration arrays. '''
+        _freqs = np.array([_item[1]*FREQ_SCALE for _item in items], dtype=np.int64)
+        _durations = np.array([_item[2] for _item in items], dtype=np.int64)
+        return (_freqs, _durations)
+
+    def header(self):
+        ''' VIS header (and any mode prefix), as frequency and duration arrays. '''
+        return self.tones(header_items(self.mode_name))
+
+    def duration_ns(self):
+        ''' Total duration (ns) of an encoded image. '''
+        return duration_ns(self.mode_name)
+
+    def image_array(self, image):
+        ''' Load an image (filename, PIL Image or numpy array) as an RGB uint8 array at the mode's resolution. '''
+        if isinstance(image, np.ndarray):
+            _array = image
+        else:
+            if not isinstance(image, Image.Image):
+                image = Image.open(image)
+            image = image.convert('RGB')
+            if image.size != self.mode['resolution']:
+                image = image.resize(self.mode['resolution'])
+            _array = np.asarray(image)
+
+        if _array.shape != (self.mode['resolution'][1], self.mode['resolution'][0], 3):
+            raise ValueError("Image must be %dx%d RGB." % self.mode['resolution'])
+        return _array
+
+    def channels(self, rows):
+        ''' Convert a block of RGB image rows into the colour channels used by the mode. '''
+        _rgb = rows.astype(np.int32)
+        (_r, _g, _b) = (_rgb[..., 0], _rgb[..., 1], _rgb[..., 2])
+
+        if self.mode['colour'] == 'rgb':
+            return {'r': _r, 'g': _g, 'b': _b}
+
+        # ITU-R BT.601 integer YCrCb conversion.
+        _y = ((66*_r + 129*_g + 25*_b + 128) >> 8) + 16
+        _cr = ((112*_r - 94*_g - 18*_b + 128) >> 8) + 128
+        _cb = ((-38*_r - 74*_g + 112*_b + 128) >> 8) + 128
+
+        if self.mode['lines_per_unit'] == 2:
+            return {'y0': _y[0::2], 'y1': _y[1::2],
+                    'cr': (_cr[0::2] + _cr[1::2] + 1) >> 1,
+                    'cb': (_cb[0::2] + _cb[1::2] + 1) >> 1}
+        else:
+            return {'y': _y, 'cr': _cr, 'cb': _cb}
+
+    def unit_segments(self, rows):
+        ''' Build the frequency and duration arrays for a block of image rows. '''
+        _channels = self.channels(rows)
+        _units = rows.shape[0]//self.mode['lines_per_unit']
+
+        _freqs = []
+        _durations = []
+        for _item in self.mode['line']:
+            if _item[0] == 'tone':
+                _freqs.append(np.full((_units, 1), _item[1]*FREQ_SCALE, dtype=np.int64))
+                _durations.append(np.full((_units, 1), _item[2], dtype=np.int64))
+            else:
+                _values = _channels[_item[1]]
+                _freqs.append(BLACK_FREQ*FREQ_SCALE + (WHITE_FREQ - BLACK_FREQ)*_values.astype(np.int64))
+                _durations.append(np.full(_values.shape, _item[2], dtype=np.int64))
+
+        return (np.hstack(_freqs).ravel(), np.hstack(_durations).ravel())
+
+    def segments(self, image):
+        ''' Generate (frequencies, durations) array pairs for an image: the header, then each block of lines. '''
+        _rows = self.image_array(image)
+        yield self.header()
+
+        _block_rows = self.block_units*self.mode['lines_per_unit']
+        for _first in range(0, _rows.shape[0], _block_rows):
+            yield self.unit_segments(_rows[_first:_first + _block_rows])
+
+    def sample_counts(self, durations, start_ns):
+        ''' Number of samples in each segment, given the start time (ns) of the first segment. '''
+        return sample_counts(durations, start_ns, self.sample_rate)
+
+    def line_counts(self, first_row, last_row):
+        ''' Sample counts of the segments for image rows first_row to last_row, from the cached timing table. '''
+        _lines = self.mode['lines_per_unit']
+        _per_unit = self.timing['segments_per_unit']
+        return self.timing['lines'][(first_row//_lines)*_per_unit:(last_row//_lines)*_per_unit]
+
+    def synthesise(self, freqs, durations, start_ns, start_phase, output, counts=None):
+        ''' Synthesise a set of segments into output, starting at start_ns with phase start_phase.
+        counts are the sample counts of each segment, if already known.
+        Returns the end time (ns) and phase, to continue from. '''
+        _counts = counts if counts is not None else self.sample_counts(durations, start_ns)
+        _start = self.sample_index(start_ns)
+
+        _increments = np.repeat(self.increments(freqs), _counts)
+        # Phase accumulator value at the start of each sample.
+        _phase = np.cumsum(_increments)
+        _total = int(_phase[-1]) if len(_phase) > 0 else 0
+        _phase -= _increments
+        _phase += start_phase
+        _phase &= PHASE_MASK
+        _phase >>= (PHASE_BITS - LUT_BITS)
+
+        output[_start:_start + len(_phase)] = self.lut[_phase]
+
+        return (start_ns + int(durations.sum()), (start_phase + _total) & PHASE_MASK)
+
+    def encode(self, image, workers=1):
+        ''' Encode an image (filename, PIL Image or numpy array). Returns an int16 numpy array.
+        If workers > 1, bands of lines are synthesised in parallel, in a pool of that many processes. '''
+        if workers > 1:
+            return self.parallel_encode(image, workers)
+
+        _output = np.zeros(self.sample_index(self.duration_ns()), dtype=np.int16)
+
+        _rows = self.image_array(image)
+        (_freqs, _durations) = self.header()
+        (_time, _phase) = self.synthesise(_freqs, _durations, 0, 0, _output, self.timing['header'])
+
+        _block_rows = self.block_units*self.mode['lines_per_unit']
+        for _first in range(0, _rows.shape[0], _block_rows):
+            _last = min(_first + _block_rows, _rows.shape[0])
+            (_freqs, _durations) = self.unit_segments(_rows[_first:_last])
+            (_time, _phase) = self.synthesise(_freqs, _durations, _time, _phase, _output, self.line_counts(_first, _last))
+
+        return _output
+
+    def phase_advance(self, freqs, counts):
+        ''' Total phase accumulator advance (modulo 2^PHASE_BITS) over a set of segments, without synthesising them. '''
+        _steps = self.increments(freqs)*counts
+        return int(_steps.sum()) & PHASE_MASK
+
+    def bands(self, rows, num_bands):
+        ''' Split image rows into bands (on line-pair boundaries where needed).
+        Returns a list of (rows, first row, start time (ns), start phase) for each band. '''
+        _lines = self.mode['lines_per_unit']
+        _units = rows.shape[0]//_lines
+        _header_ns = int(self.header()[1].sum())
+        _unit_ns = unit_ns(self.mode_name)
+        _block_rows = self.block_units*_lines
+
+        _bands = []
+        _phase = self.phase_advance(self.header()[0], self.timing['header'])
+        for i in range(num_bands):
+            _first = (i*_units//num_bands)*_lines
+            _last = ((i + 1)*_units//num_bands)*_lines
+            _start_ns = _header_ns + (_first//_lines)*_unit_ns
+            _bands.append((rows[_first:_last], _first, _start_ns, _phase))
+
+            # Work out the phase at the start of the next band, a block at a time to bound memory use.
+            for _block in range(_first, _last, _block_rows):
+                _block_end = min(_block + _block_rows, _last)
+                (_freqs, _durations) = self.unit_segments(rows[_block:_block_end])
+                _phase = (_phase + self.phase_advance(_freqs, self.line_counts(_block, _block_end))) & PHASE_MASK
+
+        return _bands
+
+    def encode_band(self, rows, first_row, start_ns, start_phase):
+        ''' Synthesise a band of image rows (starting at image row first_row), starting at start_ns with phase start_phase.
+        Returns an int16 array of the band's samples only. '''
+        _end_ns = start_ns + (rows.shape[0]//self.mode['lines_per_unit'])*unit_ns(self.mode_name)
+        _offset = self.sample_index(start_ns)
+        _output = np.zeros(self.sample_index(_end_ns) - _offset, dtype=np.int16)
+        # synthesise() writes at absolute sample positions, so give it a view which starts at this band.
+        _view = _BandOutput(_output, _offset)
+
+        _block_rows = self.block_units*self.mode['lines_per_unit']
+        _time = start_ns
+        _phase = start_phase
+        for _first in range(0, rows.shape[0], _block_rows):
+            _last = min(_first + _block_rows, rows.shape[0])
+            (_freqs, _durations) = self.unit_segments(rows[_first:_last])
+            _counts = self.line_counts(first_row + _first, first_row + _last)
+            (_time, _phase) = self.synthesise(_freqs, _durations, _time, _phase, _view, _counts)
+
+        return _output
+
+    def parallel_encode(self, image, workers):
+        ''' Encode an image, synthesising bands of lines in a pool of worker processes.
+        The output is bit-identical to encode(image). '''
+        _rows = self.image_array(image)
+        _output = np.zeros(self.sample_index(self.duration_ns()), dtype=np.int16)
+
+        (_freqs, _durations) = self.header()
+        self.synthesise(_freqs, _durations, 0, 0, _output, self.timing['header'])
+
+        if (self.pool is None) or (self.pool_workers != workers):
+            self.close()
+            self.pool = pool_context().Pool(workers)
+            self.pool_workers = workers
+
+        _args = [(self.mode_name, self.sample_rate, self.amplitude, self.block_units) + _band for _band in self.bands(_rows, workers)]
+        for (_band, _samples) in zip(_args, self.pool.map(_encode_band, _args)):
+            _start = self.sample_index(_band[6])
+            _output[_start:_start + len(_samples)] = _samples
+
+        return _output
+
+    def close(self):
+        ''' Shut down the process pool, if one has been started. '''
+        if self.pool != None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+            self.pool_workers = 0
+
+    def reference_encode(self, image):
+        ''' Encode an image using floating point phase and sin(), with the same segment timing.
+        This is slow, and is only used to check the accuracy of encode(). '''
+        _output = np.zeros(self.sample_index(self.duration_ns()), dtype=np.float64)
+
+        _time = 0
+        _phase = 0.0
+        for (_freqs, _durations) in self.segments(image):
+            _counts = self.sample_counts(_durations, _time)
+            _start = self.sample_index(_time)
+            _step = np.repeat(_freqs/float(FREQ_SCALE*self.sample_rate), _counts)
+            _cycles = np.cumsum(_step) - _step + _phase
+            _output[_start:_start + len(_cycles)] = self.amplitude*np.sin(2*np.pi*_cycles)
+            _phase = (_phase + _step.sum()) % 1.0
+            _time += int(_durations.sum())
+
+        return _output
+
+
+# Cached timing tables, indexed by (mode, sample_rate). See timing_table().
+_timing_tables = {}
+
+
+def sample_index(time_ns, sample_rate):
+    ''' Index of the sample nearest to a time (ns). Works on integers and integer arrays. '''
+    return (time_ns*sample_rate + NS_PER_SECOND//2) // NS_PER_SECOND
+
+
+def sample_counts(durations, start_ns, sample_rate):
+    ''' Number of samples in each segment, given the start time (ns) of the first segment. '''
+    _ends = sample_index(start_ns + np.cumsum(durations), sample_rate)
+    return np.diff(_ends, prepend=sample_index(start_ns, sample_rate))
+
+
+def timing_table(mode, sample_rate):
+    ''' Sample counts of every segment of an image in a mode, at a sample rate. These depend only on
+    the mode timing, so are calculated once per (mode, sample rate), and cached. Returns a dictionary:
+        header: Sample counts of the header (and mode prefix) segments.
+        lines: Sample counts of every line segment in the image, in order.
+        segments_per_unit: Number of segments per line (or line pair).
+    '''
+    if (mode, sample_rate) in _timing_tables:
+        return _timing_tables[(mode, sample_rate)]
+
+    _mode = get_mode(mode)
+    _width = _mode['resolution'][0]
+    _units = _mode['resolution'][1]//_mode['lines_per_unit']
+
+    _header = np.array([_item[2] for _item in header_items(mode)], dtype=np.int64)
+    _unit = []
+    for _item in _mode['line']:
+        _unit += [_item[2]]*(_width if _item[0] == 'scan' else 1)
+    _lines = np.tile(np.array(_unit, dtype=np.int64), _units)
+
+    _table = {
+        'header': sample_counts(_header, 0, sample_rate),
+        'lines': sample_counts(_lines, int(_header.sum()), sample_rate).astype(np.int32),
+        'segments_per_unit': len(_unit)
+    }
+    _timing_tables[(mode, sample_rate)] = _table
+    return _table
+
+
+class _BandOutput(object):
+    ''' Wraps a band's output array, so it can be indexed by absolute sample position. '''
+
+    def __init__(self, output, offset):
+        self.output = output
+        self.offset = offset
+
+    def __setitem__(self, key, value):
+        self.output[key.start - self.offset:key.stop - self.offset] = value
+
+
+def pool_context():
+    ''' Return the multiprocessing context used to start encoder worker processes (see POOL_START_METHODS). '''
+    _available = multiprocessing.get_all_start_methods()
+    for _method in POOL_START_METHODS:
+        if _method in _available:
+            return multiprocessing.get_context(_method)
+    raise RuntimeError("None of the process start methods %s are available." % ", ".join(POOL_START_METHODS))
+
+
+def _encode_band(args):
+    ''' Process pool entry point: (mode, sample_rate, amplitude, block_units, rows, first_row, start_ns, start_phase). '''
+    (_mode, _rate, _amplitude, _block_units, _rows, _first_row, _start_ns, _start_phase) = args
+    _encoder = FixedPointSSTVEncoder(mode=_mode, sample_rate=_rate, amplitude=_amplitude, block_units=_block_units)
+    return _encoder.encode_band(_rows, _first_row, _start_ns, _start_phase)
+
+
+def write_wav(samples, filename, sample_rate):
+    ''' Write int16 samples to a mono WAV file. '''
+    _wav = wave.open(filename, 'wb')
+    _wav.setnchannels(1)
+    _wav.setsampwidth(2)
+    _wav.setframerate(sample_rate)
+    _wav.writeframes(samples.astype('<i2').tobytes())
+    _wav.close()
+
+
+def read_wav(filename):
+    ''' Read a mono 16-bit WAV file. Returns (samples, sample_rate). '''
+    _wav = wave.open(filename, 'rb')
+    _samples = np.frombuffer(_wav.readframes(_wav.getnframes()), dtype='<i2')
+    if _wav.getnchannels() > 1:
+        _samples = _samples[::_wav.getnchannels()]
+    _rate = _wav.getframerate()
+    _wav.close()
+    return (_samples, _rate)
+
+
+# Encoders used by encode_file(), indexed by (mode, sample_rate, workers), so their process pools are reused.
+_encoders = {}
+_encoders_lock = Lock()
+
+
+def encode_file(filename, wav_filename, mode='pd120', sample_rate=22050, workers=1):
+    ''' Encode an image file to a SSTV WAV file, using workers processes. Returns wav_filename.
+    The encoder (and its process pool) is kept for the next call. Call close_encoders() on shutdown. '''
+    _key = (mode, sample_rate, workers)
+    with _encoders_lock:
+        if _key not in _encoders:
+            _encoders[_key] = FixedPointSSTVEncoder(mode=mode, sample_rate=sample_rate)
+        _encoder = _encoders[_key]
+    write_wav(_encoder.encode(filename, workers=workers), wav_filename, sample_rate)
+    return wav_filename
+
+
+def close_encoders():
+    ''' Shut down the process pools of the encoders cached by encode_file(). '''
+    with _encoders_lock:
+        for _encoder in _encoders.values():
+            _encoder.close()
+        _encoders.clear()
+
+
+def power_spectrum(samples, sample_rate, nfft=2048):
+    ''' Averaged (Welch) power spectral density. Returns (frequencies, psd). '''
+    _frames = len(samples)//nfft
+    _data = np.asarray(samples[:_frames*nfft], dtype=np.float64).reshape(_frames, nfft)*np.hanning(nfft)
+    _psd = (np.abs(np.fft.rfft(_data, axis=1))**2).mean(axis=0)
+    return (np.fft.rfftfreq(nfft, 1.0/sample_rate), _psd)
+
+
+def compare(samples, reference, sample_rate, band=SPECTRAL_BAND, floor_db=-40.0):
+    ''' Compare encoder output against a reference encoding of the same image.
+
+    Returns a dictionary containing the maximum difference (dB) between the normalised power spectral
+    densities, over bins within band which are no more than floor_db below the reference's peak, and
+    (if the two are the same length, i.e. sample-aligned) the signal to error ratio (dB).
+    '''
+    (_freqs, _psd) = power_spectrum(samples, sample_rate)
+    (_freqs, _ref_psd) = power_spectrum(reference, sample_rate)
+
+    _band = (_freqs >= band[0]) & (_freqs <= band[1])
+    _psd = _psd/_psd[_band].sum()
+    _ref_psd = _ref_psd/_ref_psd[_band].sum()
+    _bins = _band & (_ref_psd > _ref_psd[_band].max()*10**(floor_db/10.0))
+
+    _result = {'spectral_error_db': float(np.abs(10*np.log10(_psd[_bins]/_ref_psd[_bins])).max())}
+    _result['within_tolerance'] = _result['spectral_error_db'] <= SPECTRAL_TOLERANCE_DB
+
+    if len(samples) == len(reference):
+        _error = np.asarray(samples, dtype=np.float64) - reference
+        _result['snr_db'] = float(10*np.log10((np.asarray(reference, dtype=np.float64)**2).sum()/max((_error**2).sum(), 1e-12)))
+    else:
+        _result['snr_db'] = None
+
+    return _result
+
+
+class _PhaseTrack(object):
+    ''' Unwrapped phase of the analytic signal of some audio, so the mean frequency over any interval can
+    be measured from the phase advance across it. '''
+
+    def __init__(self, samples, sample_rate):
+        self.sample_rate = sample_rate
+        _spectrum = np.fft.fft(np.asarray(samples, dtype=np.float64))
+        _weights = np.zeros(len(_spectrum))
+        _weights[0] = 1.0
+        _weights[1:(len(_spectrum) + 1)//2] = 2.0
+        if len(_spectrum) % 2 == 0:
+            _weights[len(_spectrum)//2] = 1.0
+        self.phase = np.unwrap(np.angle(np.fft.ifft(_spectrum*_weights)))
+
+    def duration(self):
+        return len(self.phase)/float(self.sample_rate)
+
+    def frequency(self, start, end):
+        ''' Mean frequency (Hz) between times start and end (seconds, scalars or arrays). '''
+        _samples = np.arange(len(self.phase))
+        _start = np.interp(np.asarray(start)*self.sample_rate, _samples, self.phase)
+        _end = np.interp(np.asarray(end)*self.sample_rate, _samples, self.phase)
+        return (_end - _start)/(2*np.pi*(np.asarray(end) - np.asarray(start)))
+
+    def smoothed(self, window):
+        ''' Mean frequency over a window (seconds) centred on each sample. '''
+        _half = max(1, int(window*self.sample_rate/2))
+        _freq = np.zeros(len(self.phase))
+        _freq[_half:-_half] = (self.phase[2*_half:] - self.phase[:-2*_half])*self.sample_rate/(2*np.pi*2*_half)
+        return _freq
+
+
+def decode(samples, sample_rate, mode):
+    ''' Decode SSTV audio in one of the DECODE_LAYOUTS modes, as a receiver would: the VIS code is read from
+    the header, the line sync pulses are found in the audio, a line period is fitted to them, and each pixel
+    is measured from the mean frequency over its slot, relative to the fitted sync times.
+
+    Returns a dictionary containing the VIS code, the number of line syncs found, the measured line (or line
+    pair) period and its error against the specification (ppm), the largest sync timing residual (ms), and the decoded
+    image (an RGB uint8 array).
+    '''
+    _layout = DECODE_LAYOUTS[mode]
+    _track = _PhaseTrack(samples, sample_rate)
+
+    # VIS: 300 ms leader, 10 ms break, 300 ms leader, then a start bit, 7 data bits (LSB first), parity
+    # and a stop bit, 30 ms each. Bits are 1100 Hz (1) or 1300 Hz (0). Find the break and the start bit,
+    # as crossings of the midpoint between the leader and the break, which a centred average does not bias.
+    _freq = _track.smoothed(0.005)
+    _low = np.flatnonzero((_freq > 0) & (_freq < (LEADER_FREQ + SYNC_FREQ)/2.0))
+    _break = _low[0]/float(sample_rate)
+    _start_bit = _low[_low > (_break + 0.26)*sample_rate][0]/float(sample_rate)
+    _bits = [1 if _track.frequency(_start_bit + 0.035 + 0.03*i, _start_bit + 0.055 + 0.03*i) < 1200 else 0 for i in range(8)]
+    _vis = sum([_bit << i for (i, _bit) in enumerate(_bits[:7])])
+    _parity_ok = (sum(_bits[:7]) % 2) == _bits[7]
+    _header_end = _start_bit + 0.3
+
+    # Line syncs: runs below 1350 Hz (between the sync and black) of at least half the sync length, ending
+    # after the header. Each sync is timed by its end, as it is always followed by a black porch (whereas it can
+    # follow pixels of any value), using a window no longer than the porch, so the crossing is not biased.
+    _sync = _layout['line'][_layout['sync']][1]/1000.0
+    _porch = _layout['line'][(_layout['sync'] + 1) % len(_layout['line'])][1]/1000.0
+    _threshold = (SYNC_FREQ + BLACK_FREQ)/2.0
+    _freq = _track.smoothed(_sync/2)
+    _is_sync = np.concatenate(([False], (_freq < _threshold) & (_freq > 0), [False]))
+    _edges = np.flatnonzero(np.diff(_is_sync.astype(np.int8)))
+    _runs = [(_a/float(sample_rate), _b/float(sample_rate)) for (_a, _b) in zip(_edges[0::2], _edges[1::2])]
+    _fine = _track.smoothed(_porch)
+    _syncs = []
+    for (_a, _b) in _runs:
+        if (_b > _header_end + _sync/2) and (_b - _a >= _sync/2):
+            _search = np.arange(int((_b - _sync/2)*sample_rate), min(int((_b + _sync/2)*sample_rate), len(_fine) - 1))
+            _rising = _search[(_fine[_search] < _threshold) & (_fine[_search + 1] >= _threshold)]
+            if len(_rising) > 0:
+                # Interpolate the crossing between samples.
+                _i = _rising[-1]
+                _b = (_i + (_threshold - _fine[_i])/(_fine[_i + 1] - _fine[_i]))/float(sample_rate)
+            _syncs.append(_b - _sync)
+    _syncs = np.array(_syncs)
+
+    # Keep only the syncs which are a whole number of sync spacings apart (e.g. not Scottie's starting sync).
+    _unit = sum([_ms for (_kind, _ms) in _layout['line']])/1000.0
+    _spacing = _unit/_layout['syncs']
+    _keep = np.zeros(len(_syncs), dtype=bool)
+    for i in range(len(_syncs)):
+        for j in (i - 1, i + 1):
+            if (0 <= j < len(_syncs)):
+                _steps = abs(_syncs[j] - _syncs[i])/_spacing
+                if (round(_steps) > 0) and (abs(_steps - round(_steps)) < 0.02):
+                    _keep[i] = True
+    _syncs = _syncs[_keep]
+    _index = np.round((_syncs - _syncs[0])/_spacing)
+    (_period, _offset) = np.polyfit(_index, _syncs, 1)
+    _residual = np.abs(_syncs - (_offset + _period*_index)).max()
+
+    # Measure each scan segment's pixels, relative to the fitted sync time of its line.
+    (_width, _height) = _layout['resolution']
+    _units = _height//_layout['lines']
+    _scale = _period/_spacing
+    _channels = {}
+    _position = -sum([_ms for (_kind, _ms) in _layout['line'][:_layout['sync']]])/1000.0
+    for (_kind, _ms) in _layout['line']:
+        if _kind not in ('sync', 'porch'):
+            _pixel = _ms/1000.0/_width
+            _starts = (_offset + _period*_layout['syncs']*np.arange(_units))[:, None] + (_position + _pixel*np.arange(_width))*_scale
+            _values = (_track.frequency(_starts, _starts + _pixel*_scale) - BLACK_FREQ)*255.0/(WHITE_FREQ - BLACK_FREQ)
+            _channels[_kind] = np.clip(_values, 0, 255)
+        _position += _ms/1000.0
+
+    if 'g' in _channels:
+        _rgb = np.dstack((_channels['r'], _channels['g'], _channels['b']))
+    else:
+        if 'y' in _channels:
+            (_y, _cr, _cb) = (_channels['y'], _channels['cr'], _channels['cb'])
+        else:
+            # Interleave the line pairs, sharing the chroma between both lines.
+            _y = np.empty((_height, _width))
+            _y[0::2] = _channels['y0']
+            _y[1::2] = _channels['y1']
+            (_cr, _cb) = (np.repeat(_channels['cr'], 2, axis=0), np.repeat(_channels['cb'], 2, axis=0))
+        # ITU-R BT.601 YCrCb to RGB.
+        _y = (_y - 16)*255.0/219
+        (_cr, _cb) = ((_cr - 128)*255.0/224, (_cb - 128)*255.0/224)
+        _rgb = np.dstack((_y + 1.402*_cr, _y - 0.344136*_cb - 0.714136*_cr, _y + 1.772*_cb))
+
+    return {
+        'vis': _vis,
+        'parity_ok': _parity_ok,
+        'syncs': len(_syncs),
+        'line_period': _period*_layout['syncs'],
+        'period_error_ppm': (_period/_spacing - 1.0)*1e6,
+        'sync_residual_ms': _residual*1000.0,
+        'image': np.clip(np.round(_rgb), 0, 255).astype(np.uint8)
+    }
+
+
+def round_trip(samples, sample_rate, mode, image):
+    ''' Decode encoder output (see decode()) and check it against the specification, and against the image
+    which was encoded. Returns the decode() result, with the mean absolute pixel error (0-255 levels),
+    and a 'pass' flag: the VIS code and parity must be correct, every line sync found, the line period
+    within DECODE_PERIOD_TOLERANCE_PPM, and the mean pixel error within DECODE_PIXEL_TOLERANCE. '''
+    _layout = DECODE_LAYOUTS[mode]
+    _result = decode(samples, sample_rate, mode)
+    _units = _layout['resolution'][1]//_layout['lines']
+    _result['pixel_error'] = float(np.abs(_result['image'].astype(np.float64) - image).mean())
+    _result['pass'] = ((_result['vis'] == _layout['vis']) and _result['parity_ok'] and (_result['syncs'] == _units*_layout['syncs'])
+        and (abs(_result['period_error_ppm']) <= DECODE_PERIOD_TOLERANCE_PPM) and (_result['pixel_error'] <= DECODE_PIXEL_TOLERANCE))
+    return _result
+
+
+def test_card(resolution):
+    ''' Generate a test image: colour bars over the top half, and a grey ramp over the bottom half. '''
+    (_width, _height) = resolution
+    _bars = np.array([[255,255,255], [255,255,0], [0,255,255], [0,255,0], [255,0,255], [255,0,0], [0,0,255], [0,0,0]], dtype=np.uint8)
+    _image = np.zeros((_height, _width, 3), dtype=np.uint8)
+    _image[:_height//2] = _bars[(np.arange(_width)*len(_bars))//_width]
+    _image[_height//2:] = ((np.arange(_width)*255)//(_width - 1)).astype(np.uint8)[:, None]
+    return _image
+
+
+def peak_rss():
+    ''' Peak resident set size of this process (kB). '''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def benchmark_encoder(mode='pd120', sample_rate=22050, runs=3, pisstv='./pisstv'):
+    ''' Benchmark the fixed-point encoder: CPU time and peak RSS growth per encode, and spectral accuracy
+    against the floating point reference. If a pisstv binary is available, its CPU time and peak RSS are
+    measured for comparison, and its output compared against ours. '''
+    _encoder = FixedPointSSTVEncoder(mode=mode, sample_rate=sample_rate)
+    _image = test_card(_encoder.mode['resolution'])
+    _airtime = _encoder.duration_ns()/float(NS_PER_SECOND)
+
+    _rss_start = peak_rss()
+    _cpu_times = []
+    for i in range(runs):
+        _start = time.process_time()
+        _samples = _encoder.encode(_image)
+        _cpu_times.append(time.process_time() - _start)
+    _rss_fixed = peak_rss()
+
+    print("%s at %d Hz: %.1f s airtime, %d samples." % (_encoder.mode['name'], sample_rate, _airtime, len(_samples)))
+    print("Fixed-point encoder: %.3f s CPU per encode (min of %d, %.0fx real time), peak RSS +%d kB." % (
+        min(_cpu_times), runs, _airtime/min(_cpu_times), _rss_fixed - _rss_start))
+
+    _start = time.process_time()
+    _reference = _encoder.reference_encode(_image)
+    _reference_time = time.process_time() - _start
+    print("Floating point reference: %.3f s CPU, peak RSS +%d kB." % (_reference_time, peak_rss() - _rss_fixed))
+
+    _result = compare(_samples, _reference, sample_rate)
+    print("Against reference: SNR %.1f dB, max spectral error %.3f dB in %d-%d Hz (tolerance %.1f dB): %s" % (
+        _result['snr_db'], _result['spectral_error_db'], SPECTRAL_BAND[0], SPECTRAL_BAND[1],
+        SPECTRAL_TOLERANCE_DB, "PASS" if _result['within_tolerance'] else "FAIL"))
+
+    if not os.path.exists(pisstv):
+        print("%s not found, skipping pisstv comparison." % pisstv)
+        return
+
+    _dir = tempfile.mkdtemp()
+    _png = os.path.join(_dir, 'test_card.png')
+    Image.fromarray(_image).save(_png)
+    _children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    subprocess.call([pisstv, '-p', mode, '-r', str(sample_rate), _png])
+    _children_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    print("pisstv: %.3f s CPU, peak RSS %d kB." % (
+        (_children_after.ru_utime + _children_after.ru_stime) - (_children.ru_utime + _children.ru_stime),
+        _children_after.ru_maxrss))
+
+    (_pisstv_samples, _pisstv_rate) = read_wav(_png + ".wav")
+    if _pisstv_rate == sample_rate:
+        _result = compare(_samples, _pisstv_samples, sample_rate)
+        print("Against pisstv: max spectral error %.3f dB in %d-%d Hz." % (_result['spectral_error_db'], SPECTRAL_BAND[0], SPECTRAL_BAND[1]))
+    os.system("rm -rf %s" % _dir)
+
+
+def benchmark_decode(sample_rate=22050, pisstv='./pisstv'):
+    ''' Round trip one mode of each family through decode() (see round_trip()), checking the encoder against the
+    published mode specifications rather than its own reference. If a pisstv binary is available, its output
+    is decoded and checked in the same way, for the modes it supports. Returns True if every check passed. '''
+    _dir = tempfile.mkdtemp()
+    _passed = True
+    for _mode in sorted(DECODE_LAYOUTS.keys()):
+        _encoder = FixedPointSSTVEncoder(mode=_mode, sample_rate=sample_rate)
+        _image = test_card(_encoder.mode['resolution'])
+        _sources = [("fixed-point", _encoder.encode(_image), sample_rate)]
+
+        if os.path.exists(pisstv) and (_encoder.mode['pisstv'] != None):
+            _png = os.path.join(_dir, '%s.png' % _mode)
+            Image.fromarray(_image).save(_png)
+            subprocess.call([pisstv, '-p', _encoder.mode['pisstv'], '-r', str(sample_rate), _png])
+            (_samples, _rate) = read_wav(_png + ".wav")
+            _sources.append(("pisstv", _samples, _rate))
+
+        for (_name, _samples, _rate) in _sources:
+            try:
+                _result = round_trip(_samples, _rate, _mode, _image)
+            except Exception as e:
+                print("%-8s %-11s could not be decoded - %s: FAIL" % (_mode, _name, str(e)))
+                _passed = False
+                continue
+            _passed = _passed and _result['pass']
+            print("%-8s %-11s VIS %d%s, %d line syncs, line%s period %.4f ms (%+.2f ppm, residual %.3f ms), mean pixel error %.2f: %s" % (
+                _mode, _name, _result['vis'], "" if _result['parity_ok'] else " (parity error)", _result['syncs'],
+                " pair" if DECODE_LAYOUTS[_mode]['lines'] == 2 else "",
+                _result['line_period']*1000.0, _result['period_error_ppm'], _result['sync_residual_ms'], _result['pixel_error'],
+                "PASS" if _result['pass'] else "FAIL"))
+
+    if not os.path.exists(pisstv):
+        print("%s not found, skipping pisstv round trips." % pisstv)
+    os.system("rm -rf %s" % _dir)
+    return _passed
+
+
+def benchmark_workers(mode='pd120', sample_rate=22050, runs=3, max_workers=4):
+    ''' Measure the wall time of an encode with 1 to max_workers worker processes, and check that the
+    parallel output is bit-identical to the serial encode. Pool start-up is excluded (the pool is reused). '''
+    _image = test_card(get_mode(mode)['resolution'])
+    print("%s at %d Hz, %d CPU cores. Wall time per encode (min of %d):" % (get_mode(mode)['name'], sample_rate, multiprocessing.cpu_count(), runs))
+
+    _serial = None
+    _base = None
+    for _workers in range(1, max_workers + 1):
+        _encoder = FixedPointSSTVEncoder(mode=mode, sample_rate=sample_rate)
+        _samples = _encoder.encode(_image, workers=_workers)
+        _times = []
+        for i in range(runs):
+            _start = time.perf_counter()
+            _samples = _encoder.encode(_image, workers=_workers)
+            _times.append(time.perf_counter() - _start)
+        _encoder.close()
+
+        if _serial is None:
+            _serial = _samples
+            _base = min(_times)
+        print("%d worker%s: %.3f s (%.2fx), output %s" % (_workers, "" if _workers == 1 else "s", min(_times), _base/min(_times),
+            "bit-identical" if np.array_equal(_samples, _serial) else "DIFFERS FROM SERIAL"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("image", nargs='?', default=None, help="Image to encode.")
+    parser.add_argument("wav", nargs='?', default=None, help="Output WAV file. Defaults to <image>.wav")
+    parser.add_argument("--mode", type=str, default='pd120', choices=sorted(MODES.keys()), help="SSTV mode.")
+    parser.add_argument("--rate", type=int, default=22050, help="Sample rate (Hz).")
+    parser.add_argument("--benchmark", action="store_true", default=False, help="Benchmark the encoder, then exit.")
+    parser.add_argument("--runs", type=int, default=3, help="Number of benchmark encodes.")
+    parser.add_argument("--workers", type=int, default=1, help="Number of encoder processes.")
+    parser.add_argument("--scaling", action="store_true", default=False, help="Benchmark the encode wall time with 1-4 workers, then exit.")
+    parser.add_argument("--decode", action="store_true", default=False, help="Decode one mode of each family, check it against the mode specification, then exit.")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark_encoder(mode=args.mode, sample_rate=args.rate, runs=args.runs)
+        sys.exit(0)
+
+    if args.scaling:
+        benchmark_workers(mode=args.mode, sample_rate=args.rate, runs=args.runs)
+        sys.exit(0)
+
+    if args.decode:
+        sys.exit(0 if benchmark_decode(sample_rate=args.rate) else 1)
+
+    if args.image is None:
+        parser.error("An image to encode is required.")
+
+    encode_file(args.image, args.wav if args.wav != None else args.image + ".wav", mode=args.mode, sample_rate=args.rate, workers=args.workers)
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+'''
+SSTV mode registry.
+
+Timing, resolution and colour encoding parameters for each supported SSTV mode. This drives both
+the image resolution used by SSTVPiCam, and the fixed-point encoder in sstv_encoder.py.
+
+Each mode is indexed by its short name (the same name pisstv uses, where pisstv supports it), and contains:
+    name: Full mode name.
+    vis: VIS code.
+    resolution: (width, height) in pixels.
+    colour: Colour encoding - 'rgb' (G, B, R scans) or 'ycrcb' (luminance and colour difference scans).
+    lines_per_unit: Number of image lines sent in each 'line' sequence (2 for PD and Robot 36, which share colour between lines).
+    line: The transmitted line (or line pair) as a list of ('tone', frequency (Hz), duration (ns)) and
+          ('scan', channel, pixel time (ns)) items. Channels are r/g/b, y/cr/cb, or y0/y1/cr/cb for line pairs.
+    prefix: Items sent once, after the VIS header (e.g. the Scottie starting sync pulse).
+    pisstv: Mode name to pass to pisstv, or None if pisstv does not support the mode.
+
+Timings are from the Dayton paper (JL Barber, N7CXI) and the PD mode specifications.
+
+Released under GNU GPL version 3 or later
+'''
+
+import sys
+
+# Tone frequencies (Hz)
+SYNC_FREQ = 1200
+BLACK_FREQ = 1500
+WHITE_FREQ = 2300
+LEADER_FREQ = 1900
+VIS_ONE_FREQ = 1100
+VIS_ZERO_FREQ = 1300
+
+NS_PER_SECOND = 1000000000
+
+
+def _pd_line(pixel_ns):
+    ''' PD modes send a pair of lines: Y (line 0), R-Y and B-Y (averaged over both lines), and Y (line 1). '''
+    return [('tone', SYNC_FREQ, 20000000), ('tone', BLACK_FREQ, 2080000),
+            ('scan', 'y0', pixel_ns), ('scan', 'cr', pixel_ns), ('scan', 'cb', pixel_ns), ('scan', 'y1', pixel_ns)]
+
+def _martin_line(pixel_ns):
+    return [('tone', SYNC_FREQ, 4862000), ('tone', BLACK_FREQ, 572000),
+            ('scan', 'g', pixel_ns), ('tone', BLACK_FREQ, 572000),
+            ('scan', 'b', pixel_ns), ('tone', BLACK_FREQ, 572000),
+            ('scan', 'r', pixel_ns), ('tone', BLACK_FREQ, 572000)]
+
+def _scottie_line(pixel_ns):
+    return [('tone', BLACK_FREQ, 1500000), ('scan', 'g', pixel_ns),
+            ('tone', BLACK_FREQ, 1500000), ('scan', 'b', pixel_ns),
+            ('tone', SYNC_FREQ, 9000000), ('tone', BLACK_FREQ, 1500000), ('scan', 'r', pixel_ns)]
+
+# Robot 36 sends R-Y on even lines, and B-Y on odd lines (each averaged over both lines).
+_ROBOT36_LINE = [('tone', SYNC_FREQ, 9000000), ('tone', BLACK_FREQ, 3000000), ('scan', 'y0', 275000),
+            ('tone', BLACK_FREQ, 4500000), ('tone', LEADER_FREQ, 1500000), ('scan', 'cr', 137500),
+            ('tone', SYNC_FREQ, 9000000), ('tone', BLACK_FREQ, 3000000), ('scan', 'y1', 275000),
+            ('tone', WHITE_FREQ, 4500000), ('tone', LEADER_FREQ, 1500000), ('scan', 'cb', 137500)]
+
+# Robot 72 sends Y, R-Y and B-Y on every line.
+_ROBOT72_LINE = [('tone', SYNC_FREQ, 9000000), ('tone', BLACK_FREQ, 3000000), ('scan', 'y', 431250),
+            ('tone', BLACK_FREQ, 4500000), ('tone', LEADER_FREQ, 1500000), ('scan', 'cr', 215625),
+            ('tone', WHITE_FREQ, 4500000), ('tone', LEADER_FREQ, 1500000), ('scan', 'cb', 215625)]
+
+_SCOTTIE_PREFIX = [('tone', SYNC_FREQ, 9000000)]
+
+
+MODES = {
+    # Robot
+    'r36': {'name': 'Robot 36', 'vis': 8, 'resolution': (320,240), 'colour': 'ycrcb', 'lines_per_unit': 2, 'line': _ROBOT36_LINE, 'prefix': [], 'pisstv': 'r36'},
+    'r72': {'name': 'Robot 72', 'vis': 12, 'resolution': (320,240), 'colour': 'ycrcb', 'lines_per_unit': 1, 'line': _ROBOT72_LINE, 'prefix': [], 'pisstv': None},
+    # Martin
+    'm1': {'name': 'Martin 1', 'vis': 44, 'resolution': (320,256), 'colour': 'rgb', 'lines_per_unit': 1, 'line': _martin_line(457600), 'prefix': [], 'pisstv': 'm1'},
+    'm2': {'name': 'Martin 2', 'vis': 40, 'resolution': (320,256), 'colour': 'rgb', 'lines_per_unit': 1, 'line': _martin_line(228800), 'prefix': [], 'pisstv': 'm2'},
+    # Scottie
+    's1': {'name': 'Scottie 1', 'vis': 60, 'resolution': (320,256), 'colour': 'rgb', 'lines_per_unit': 1, 'line': _scottie_line(432000), 'prefix': _SCOTTIE_PREFIX, 'pisstv': 's1'},
+    's2': {'name': 'Scottie 2', 'vis': 56, 'resolution': (320,256), 'colour': 'rgb', 'lines_per_unit': 1, 'line': _scottie_line(275200), 'prefix': _SCOTTIE_PREFIX, 'pisstv': 's2'},
+    'sdx': {'name': 'Scottie DX', 'vis': 76, 'resolution': (320,256), 'colour': 'rgb', 'lines_per_unit': 1, 'line': _scottie_line(1080000), 'prefix': _SCOTTIE_PREFIX, 'pisstv': 'sdx'},
+    # PD
+    'pd50': {'name': 'PD50', 'vis': 93, 'resolution': (320,256), 'colour': 'ycrcb', 'lines_per_unit': 2, 'line': _pd_line(286000), 'prefix': [], 'pisstv': None},
+    'pd90': {'name': 'PD90', 'vis': 99, 'resolution': (320,256), 'colour': 'ycrcb', 'lines_per_unit': 2, 'line': _pd_line(532000), 'prefix': [], 'pisstv': None},
+    'pd120': {'name': 'PD120', 'vis': 95, 'resolution': (640,496), 'colour': 'ycrcb', 'lines_per_unit': 2, 'line': _pd_line(190000), 'prefix': [], 'pisstv': 'pd120'},
+    'pd160': {'name': 'PD160', 'vis': 98, 'resolution': (512,400), 'colour': 'ycrcb', 'lines_per_unit': 2, 'line': _pd_line(382000), 'prefix': [], 'pisstv': None},
+    'pd180': {'name': 'PD180', 'vis': 96, 'resolution': (640,496), 'colour': 'ycrcb', 'lines_per_unit': 2, 'line': _pd_line(286000), 'prefix': [], 'pisstv': None},
+    'pd240': {'name': 'PD240', 'vis': 97, 'resolution': (640,496), 'colour': 'ycrcb', 'lines_per_unit': 2, 'line': _pd_line(382000), 'prefix': [], 'pisstv': None},
+    'pd290': {'name': 'PD290', 'vis': 94, 'resolution': (800,616), 'colour': 'ycrcb', 'lines_per_unit': 2, 'line': _pd_line(286000), 'prefix': [], 'pisstv': None},
+}
+
+
+def get_mode(mode):
+    ''' Look up a mode by short name. Raises a ValueError if the mode is not known. '''
+    if mode not in MODES:
+        raise ValueError("Unknown SSTV mode %s. Valid modes: %s" % (mode, ", ".join(sorted(MODES.keys()))))
+    return MODES[mode]
+
+
+def header_items(mode):
+    ''' VIS header (and any mode prefix) for a mode, as a list of ('tone', frequency, duration) items. '''
+    _mode = get_mode(mode)
+    _items = [('tone', LEADER_FREQ, 300000000), ('tone', SYNC_FREQ, 10000000),
+              ('tone', LEADER_FREQ, 300000000), ('tone', SYNC_FREQ, 30000000)]
+    # 7 data bits (LSB first), then even parity, then the stop bit.
+    _parity = 0
+    for _bit in range(7):
+        _value = (_mode['vis'] >> _bit) & 1
+        _parity ^= _value
+        _items.append(('tone', VIS_ONE_FREQ if _value else VIS_ZERO_FREQ, 30000000))
+    _items.append(('tone', VIS_ONE_FREQ if _parity else VIS_ZERO_FREQ, 30000000))
+    _items.append(('tone', SYNC_FREQ, 30000000))
+
+    return _items + _mode['prefix']
+
+
+def unit_ns(mode):
+    ''' Duration (ns) of one transmitted line (or line pair). '''
+    _mode = get_mode(mode)
+    _width = _mode['resolution'][0]
+    return sum([_item[2]*(_width if _item[0] == 'scan' else 1) for _item in _mode['line']])
+
+
+def duration_ns(mode):
+    ''' Total duration (ns) of an image transmitted in a mode, including the VIS header. '''
+    _mode = get_mode(mode)
+    _units = _mode['resolution'][1]//_mode['lines_per_unit']
+    return sum([_item[2] for _item in header_items(mode)]) + _units*unit_ns(mode)
+
+
+def airtime(mode):
+    ''' Expected airtime (seconds) of an image transmitted in a mode. '''
+    return duration_ns(mode)/float(NS_PER_SECOND)
+
+
+def print_modes():
+    ''' Print a table of the supported modes. '''
+    print("Mode   Name          Resolution  Colour  Airtime  pisstv")
+    for _key in sorted(MODES.keys(), key=airtime):
+        _mode = MODES[_key]
+        print("%-6s %-13s %4dx%-6d %-7s %6.1fs  %s" % (_key, _mode['name'], _mode['resolution'][0], _mode['resolution'][1],
+            _mode['colour'], airtime(_key), "yes" if _mode['pisstv'] != None else "no"))
+
+
+if __name__ == "__main__":
+    print_modes()
+    sys.exit(0)
@@ -0,0 +1,398 @@
+#!/usr/bin/env python
+'''
+Airtime-budgeted SSTV mode and cadence scheduler.
+
+Chooses the SSTV mode, and the delay before the next image, so that an image is transmitted at
+least every `interval` seconds while keeping the transmitter within a duty cycle.
+
+Transmissions are paced by an airtime 'credit' bucket, which fills at duty_cycle seconds per second
+(up to one image of the current mode), and is emptied by each transmission. The duty cycle over any
+rolling window (default one hour) is checked again just before each transmission (transmit_delay()),
+so it is never exceeded even if the pipeline runs faster than predicted. Mode choice
+uses the measured airtime of each mode, and the measured capture, resize, encode and channel-wait
+times, to predict when the next image would start transmitting. If the pipeline falls behind (or
+the channel is busy) the scheduler steps straight down to a mode which keeps the cadence, and
+steps back up one mode at a time when there is slack.
+
+Also contains a simulation harness, which replays recorded (or synthetic) cycle timings against
+the scheduler on a virtual clock.
+
+Released under GNU GPL version 3 or later
+'''
+
+import argparse
+import json
+import random
+import time
+from collections import deque
+
+from sstv_modes import airtime
+
+
+class AirtimeScheduler(object):
+    ''' Pick the SSTV mode and inter-image delay for each cycle. '''
+
+    def __init__(self,
+                modes=('pd120', 'm1', 'pd90', 's2', 'r36'),
+                interval=600.0,
+                duty_cycle=0.25,
+                min_delay=0.0,
+                step_up_margin=0.2,
+                history=5,
+                window=3600.0,
+                max_channel_wait=60.0,
+                log_file=None,
+                time_ptr=time.monotonic,
+                debug_ptr=None):
+        ''' Initialise an AirtimeScheduler.
+
+        Keyword Arguments:
+        modes: SSTV modes to choose from. These are ordered from slowest (best) to fastest.
+        interval: Maximum time (seconds) between the start of each image transmission.
+        duty_cycle: Maximum fraction of time spent transmitting, over any window.
+        min_delay: Minimum delay (seconds) between the end of one image and the capture of the next.
+        step_up_margin: Fraction of the interval which must be spare before stepping up to a slower mode.
+        history: Number of recent measurements used for each timing estimate.
+        window: Window (seconds) over which the duty cycle is enforced.
+        max_channel_wait: Longest time (seconds) a transmission can wait for a clear channel, i.e. the listen-before-talk
+                  timeout (ChannelMonitor.timeout), after which it transmits anyway. Modes and delays are chosen so
+                  that the interval is kept even if the channel is busy for this long. None = no listen-before-talk.
+        log_file: An optional filename, to which the timings of each cycle are appended (as JSON lines).
+                  These can be replayed against the scheduler using replay().
+        time_ptr: Function returning the current time. Defaults to time.monotonic.
+        debug_ptr: Reference to a function which can handle debug messages.
+        '''
+        self.modes = sorted(modes, key=airtime, reverse=True)
+        self.interval = interval
+        self.duty_cycle = duty_cycle
+        self.min_delay = min_delay
+        self.step_up_margin = step_up_margin
+        self.window = window
+        self.max_channel_wait = max_channel_wait
+        self.log_file = log_file
+        self.time_ptr = time_ptr
+        self.debug_ptr = debug_ptr
+
+        # Index into modes of the current mode.
+        self.level = 0
+
+        # Airtime credit (seconds). Allow one image of the current mode to be sent at any time.
+        # The capacity follows the current mode, so a burst never exceeds one image of the mode in use.
+        self.credit_capacity = airtime(self.modes[0])
+        self.credit = self.credit_capacity
+        self.credit_time = self.time_ptr()
+
+        self.last_tx_start = None
+
+        # Recent stage timings. Encode and airtime are recorded per mode.
+        self.timings = {
+            'capture': deque(maxlen=history),
+            'resize': deque(maxlen=history),
+            'channel_wait': deque(maxlen=history),
+            'tx_overhead': deque(maxlen=history)
+        }
+        self.encode_times = {}
+        self.airtimes = {}
+        self.history = history
+
+        # (tx_start, airtime, mode) of each transmission.
+        self.transmissions = deque(maxlen=1000)
+
+    def debug_message(self, message):
+        ''' Write a debug message, either to the debug_ptr function, or to stdout. '''
+        message = "Scheduler: " + message
+        if self.debug_ptr != None:
+            self.debug_ptr(message)
+        else:
+            print(message)
+
+    def mode(self):
+        ''' The current mode. '''
+        return self.modes[self.level]
+
+    def credit_at(self, t):
+        ''' Airtime credit available at time t. '''
+        return min(self.credit_capacity, self.credit + max(0.0, t - self.credit_time)*self.duty_cycle)
+
+    def set_credit_capacity(self, capacity, now):
+        ''' Resize the credit bucket (e.g. on a mode change), discarding any credit above the new capacity. '''
+        self.credit = self.credit_at(now)
+        self.credit_time = now
+        self.credit_capacity = capacity
+        self.credit = min(self.credit, capacity)
+
+    def stage_estimate(self, stage):
+        ''' Conservative (worst recent) estimate of a stage's duration. '''
+        _times = self.timings[stage]
+        return max(_times) if len(_times) > 0 else 0.0
+
+    def mode_airtime(self, mode):
+        ''' Expected airtime (seconds of audio) of a mode. Uses measurements if we have them, otherwise the nominal airtime. '''
+        if len(self.airtimes.get(mode, [])) > 0:
+            return max(self.airtimes[mode])
+        return airtime(mode)
+
+    def encode_estimate(self, mode):
+        ''' Expected encode time of a mode. Unmeasured modes are scaled (by airtime) from measured ones. '''
+        if len(self.encode_times.get(mode, [])) > 0:
+            return max(self.encode_times[mode])
+
+        _rates = [max(_times)/airtime(_mode) for (_mode, _times) in self.encode_times.items() if len(_times) > 0]
+        return airtime(mode)*max(_rates) if len(_rates) > 0 else 0.0
+
+    def overhead(self, mode):
+        ''' Expected time from the start of a cycle (after the delay) to the start of the audio. '''
+        return (self.stage_estimate('capture') + self.stage_estimate('resize') + self.encode_estimate(mode) +
+            self.stage_estimate('channel_wait') + self.stage_estimate('tx_overhead'))
+
+    def busy_margin(self):
+        ''' Extra time (seconds) a transmission may take to start, beyond the estimate, if the channel is busy
+        until the listen-before-talk timeout. The duty cycle hold comes before the channel wait, so this cannot
+        overlap it. '''
+        if self.max_channel_wait is None:
+            return 0.0
+        return max(0.0, self.max_channel_wait - self.stage_estimate('channel_wait'))
+
+    def window_used(self, start, end):
+        ''' Time spent transmitting between start and end. '''
+        return sum([max(0.0, min(_t + _air, end) - max(_t, start)) for (_t, _air, _mode) in self.transmissions])
+
+    def window_start(self, earliest, duration):
+        ''' Earliest time (no earlier than earliest) at which a transmission of duration seconds can start
+        without exceeding the duty cycle over the window which ends when it does. '''
+        _budget = self.duty_cycle*self.window - duration
+
+        def _allowed(t):
+            return self.window_used(t + duration - self.window, t) <= _budget + 1e-6
+
+        if _allowed(earliest) or (_budget < 0):
+            return earliest
+
+        # Past transmissions only age out of the window as time goes on, so bisect.
+        (_low, _high) = (earliest, earliest + self.window)
+        while _high - _low > 0.1:
+            _mid = (_low + _high)/2.0
+            if _allowed(_mid):
+                _high = _mid
+            else:
+                _low = _mid
+        return _high
+
+    def predict(self, mode, now):
+        ''' Predict the delay needed to stay within the duty cycle, and the resulting transmit start time, for a mode. '''
+        _airtime = self.mode_airtime(mode)
+        _overhead = self.overhead(mode)
+        # Credit accumulates during the delay and the pipeline stages.
+        _tx_start = now + max(self.min_delay + _overhead, (_airtime - self.credit_at(now))/self.duty_cycle)
+        _tx_start = self.window_start(_tx_start, _airtime)
+        # A mode is only sustainable if its steady-state period fits within the interval, even with a busy channel.
+        _period = max(_overhead + _airtime + self.min_delay, _airtime/self.duty_cycle) + self.busy_margin()
+        return {'delay': _tx_start - now - _overhead, 'tx_start': _tx_start, 'period': _period, 'airtime': _airtime}
+
+    def transmit_delay(self, mode=None):
+        ''' Time (seconds) to hold off before keying up to transmit an image in mode (default: the current mode),
+        so as not to exceed the duty cycle. Should be checked just before each transmission. '''
+        if mode is None:
+            mode = self.mode()
+        # Only the audio is charged, and it starts after the transmit overhead.
+        _start = self.time_ptr() + self.stage_estimate('tx_overhead')
+        return self.window_start(_start, self.mode_airtime(mode)) - _start
+
+    def plan(self):
+        ''' Choose the mode and delay for the next cycle. Returns (mode, delay). '''
+        _now = self.time_ptr()
+        _deadline = (self.last_tx_start + self.interval) if self.last_tx_start != None else None
+
+        _choice = None
+        # Step down as far as needed, but only step up one mode at a time.
+        for _level in range(max(0, self.level - 1), len(self.modes)):
+            _mode = self.modes[_level]
+            _prediction = self.predict(_mode, _now)
+            # Keep enough slack for a busy channel, and (to step up) for step_up_margin.
+            _margin = max(self.busy_margin(), self.step_up_margin*self.interval if _level < self.level else 0.0)
+
+            if _prediction['period'] > self.interval:
+                continue
+            if (_deadline != None) and (_prediction['tx_start'] + _margin > _deadline):
+                continue
+
+            _choice = (_level, _prediction)
+            break
+
+        if _choice is None:
+            # Nothing meets the cadence - use the fastest mode, but stay within the duty cycle.
+            _choice = (len(self.modes) - 1, self.predict(self.modes[-1], _now))
+
+        (_level, _prediction) = _choice
+        _delay = _prediction['delay']
+        if _deadline != None:
+            # Start early enough to keep the interval if the channel is busy. Any credit not yet available is
+            # made up by a hold (see transmit_delay()), and by a longer delay before the next image.
+            _latest = _deadline - _now - self.overhead(self.modes[_level]) - self.busy_margin()
+            _delay = max(self.min_delay, min(_delay, _latest))
+        if _level != self.level:
+            self.debug_message("Switching from %s to %s." % (self.modes[self.level], self.modes[_level]))
+        self.level = _level
+        self.set_credit_capacity(self.mode_airtime(self.modes[_level]), _now)
+
+        return (self.modes[_level], _delay)
+
+    def record_cycle(self, mode, timings, tx_start=None):
+        ''' Record the stage timings of a completed cycle.
+
+        timings is a dictionary containing some or all of 'capture', 'resize', 'encode', 'channel_wait',
+        'tx_overhead' and 'airtime' durations, in seconds. Only 'airtime' (the duration of the audio) is charged
+        against the duty cycle. 'tx_overhead' is the time between the end of the channel wait and the start of the
+        audio (waking the radio, finishing a retune, and the PTT delay), which only counts towards the cadence.
+        tx_start is the time the audio started (defaults to now minus the airtime).
+        '''
+        for _stage in self.timings:
+            if _stage in timings:
+                self.timings[_stage].append(timings[_stage])
+        if 'encode' in timings:
+            self.encode_times.setdefault(mode, deque(maxlen=self.history)).append(timings['encode'])
+
+        if 'airtime' in timings:
+            _airtime = timings['airtime']
+            self.airtimes.setdefault(mode, deque(maxlen=self.history)).append(_airtime)
+            if tx_start is None:
+                tx_start = self.time_ptr() - _airtime
+
+            # Spend the airtime credit.
+            self.credit = self.credit_at(tx_start) - _airtime
+            self.credit_time = tx_start
+            self.last_tx_start = tx_start
+            self.transmissions.append((tx_start, _airtime, mode))
+
+        if self.log_file != None:
+            _record = dict(timings)
+            _record['mode'] = mode
+            _record['time'] = time.time()
+            with open(self.log_file, 'a') as _f:
+                _f.write(json.dumps(_record) + "\n")
+
+    def duty_cycle_used(self, now=None):
+        ''' Fraction of the last window (or of the time since the first transmission, if shorter) spent transmitting. '''
+        if now is None:
+            now = self.time_ptr()
+        if len(self.transmissions) == 0:
+            return 0.0
+        _start = max(now - self.window, self.transmissions[0][0])
+        return self.window_used(_start, now)/max(now - _start, 1e-6)
+
+    def stats(self):
+        _gaps = [_b[0] - _a[0] for (_a, _b) in zip(list(self.transmissions)[:-1], list(self.transmissions)[1:])]
+        _counts = {}
+        for (_t, _air, _mode) in self.transmissions:
+            _counts[_mode] = _counts.get(_mode, 0) + 1
+        return {
+            'mode': self.mode(),
+            'images': len(self.transmissions),
+            'mode_counts': _counts,
+            'max_gap': max(_gaps) if len(_gaps) > 0 else None,
+            'duty_cycle': self.duty_cycle_used(),
+            'credit': self.credit_at(self.time_ptr())
+        }
+
+
+def synthetic_records(num_cycles=100, mode='pd120', ptt_delay=2.0, channel_timeout=60.0, seed=0):
+    ''' Generate cycle timings resembling a Pi Zero running pisstv, with a busy channel during
+    cycles 20-35 (often until the listen-before-talk timeout, channel_timeout), and CPU contention
+    (slow encodes) during cycles 50-65. '''
+    _random = random.Random(seed)
+    _records = []
+    for i in range(num_cycles):
+        _record = {
+            'mode': mode,
+            'capture': 4.0 + _random.uniform(0, 1.0),
+            'resize': 2.0 + _random.uniform(0, 0.5),
+            'encode': airtime(mode)*0.15*_random.uniform(0.9, 1.1),
+            'channel_wait': _random.uniform(0, 2.0),
+            'tx_overhead': ptt_delay,
+            'airtime': airtime(mode)
+        }
+        if 20 <= i < 35:
+            _record['channel_wait'] = min(_random.uniform(30, 240), channel_timeout)
+        if 50 <= i < 65:
+            _record['encode'] *= 4.0
+        _records.append(_record)
+    return _records
+
+
+def load_records(filename):
+    ''' Load cycle timings recorded by an AirtimeScheduler log_file. '''
+    with open(filename, 'r') as _f:
+        return [json.loads(_line) for _line in _f if len(_line.strip()) > 0]
+
+
+def replay(records, verbose=True, **kwargs):
+    ''' Replay recorded cycle timings against an AirtimeScheduler, using a virtual clock.
+
+    Where the scheduler picks a different mode to the one recorded, the encode time is scaled by
+    airtime, and any difference between the recorded and nominal airtime is added to the nominal airtime
+    of the new mode.
+    Keyword arguments are passed to AirtimeScheduler. Returns the scheduler statistics, along
+    with the cadence (interval) violations, and the peak duty cycle over the scheduler window.
+    '''
+    _clock = [0.0]
+    _scheduler = AirtimeScheduler(time_ptr=lambda: _clock[0], debug_ptr=lambda x: None, **kwargs)
+
+    _duties = []
+    for (i, _record) in enumerate(records):
+        (_mode, _delay) = _scheduler.plan()
+
+        _scale = airtime(_mode)/airtime(_record['mode'])
+        _timings = {
+            'capture': _record.get('capture', 0.0),
+            'resize': _record.get('resize', 0.0),
+            'encode': _record.get('encode', 0.0)*_scale,
+            'channel_wait': _record.get('channel_wait', 0.0),
+            'tx_overhead': _record.get('tx_overhead', 0.0),
+            'airtime': airtime(_mode) + (_record['airtime'] - airtime(_record['mode']))
+        }
+
+        _clock[0] += _delay + _timings['capture'] + _timings['resize'] + _timings['encode'] + _timings['channel_wait']
+        _hold = _scheduler.transmit_delay(_mode)
+        _clock[0] += _hold + _timings['tx_overhead']
+        _tx_start = _clock[0]
+        _clock[0] += _timings['airtime']
+        _scheduler.record_cycle(_mode, _timings, tx_start=_tx_start)
+
+        if _clock[0] >= _scheduler.window:
+            _duties.append(_scheduler.duty_cycle_used())
+
+        if verbose:
+            print("%3d: t=%7.0fs %-6s delay %6.1fs, hold %5.1fs, channel wait %6.1fs, encode %5.1fs, duty %.3f, credit %6.1fs" % (
+                i, _tx_start, _mode, _delay, _hold, _timings['channel_wait'], _timings['encode'],
+                _scheduler.duty_cycle_used(), _scheduler.credit_at(_clock[0])))
+
+    _stats = _scheduler.stats()
+    _transmissions = list(_scheduler.transmissions)
+    _stats['violations'] = len([1 for (_a, _b) in zip(_transmissions[:-1], _transmissions[1:]) if _b[0] - _a[0] > _scheduler.interval])
+    _stats['peak_duty_cycle'] = max(_duties) if len(_duties) > 0 else _scheduler.duty_cycle_used()
+
+    return _stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--replay", type=str, default=None, help="Replay cycle timings recorded by a scheduler log_file, instead of synthetic timings.")
+    parser.add_argument("--interval", type=float, default=600.0, help="Maximum time between images (seconds).")
+    parser.add_argument("--duty", type=float, default=0.25, help="Maximum duty cycle (0-1).")
+    parser.add_argument("--modes", type=str, default="pd120,m1,pd90,s2,r36", help="Comma-separated list of modes to choose from.")
+    parser.add_argument("--cycles", type=int, default=100, help="Number of synthetic cycles.")
+    parser.add_argument("--channel-timeout", type=float, default=60.0, help="Listen-before-talk timeout (seconds).")
+    parser.add_argument("--quiet", action="store_true", default=False, help="Only print the summary.")
+    args = parser.parse_args()
+
+    if args.replay != None:
+        _records = load_records(args.replay)
+    else:
+        _records = synthetic_records(args.cycles, channel_timeout=args.channel_timeout)
+
+    _stats = replay(_records, verbose=not args.quiet, modes=args.modes.split(','), interval=args.interval, duty_cycle=args.duty,
+        max_channel_wait=args.channel_timeout)
+
+    print("%d images: %s" % (_stats['images'], ", ".join(["%s x%d" % (_mode, _count) for (_mode, _count) in sorted(_stats['mode_counts'].items())])))
+    print("Max gap between images: %.1f s (target %.1f s), %d gaps over target." % (_stats['max_gap'], args.interval, _stats['violations']))
+    print("Duty cycle over the last hour: %.3f, peak: %.3f (target %.3f)" % (_stats['duty_cycle'], _stats['peak_duty_cycle'], args.duty))
@@ -0,0 +1,677 @@
+#!/usr/bin/env python
+'''
+Prioritised transmit queue, with time-based ident.
+
+Audio (SSTV images, telemetry bursts) is queued with a priority, and sent by a worker thread.
+Everything waiting in the queue when the transmitter is keyed goes out in the same PTT session,
+highest priority first. Idents are merged into sessions, so they never need a PTT cycle of their own
+and no longer drift with mode and delay. Following the usual rule of identifying at the start of a
+transmission and at least every 10 minutes (ident_interval) during it:
+  * A session that starts more than ident_interval after the last ident (or before any ident has
+    been sent) begins with an ident.
+  * A session that would end ident_interval or more after the last ident ends with an ident.
+  * A session longer than ident_interval has both.
+
+All audio is played through a single long-running aplay process, fed raw samples on stdin.
+The ident audio (loaded from a WAV file, or synthesised CW) is held in memory, so identing never
+touches the disk or spawns a process.
+
+Audio should be generated at the output device's native sample rate (see device_sample_rate()), so
+ALSA's plug layer does not have to resample it on the CPU during playback.
+
+Released under GNU GPL version 3 or later
+'''
+
+import argparse
+import array
+import heapq
+import math
+import os
+import random
+import re
+import resource
+import subprocess
+import tempfile
+import sys
+import time
+import warnings
+import wave
+from threading import Thread, Event, Lock, Condition
+
+try:
+    with warnings.catch_warnings():
+        # audioop is deprecated in newer Python versions, but is still the simplest way to convert audio on the Pi.
+        warnings.simplefilter("ignore", DeprecationWarning)
+        import audioop
+except ImportError:
+    audioop = None
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from dra818 import *
+
+# Transmit priorities. Lower values are sent first. (Idents are not queued - they are placed by the session.)
+PRIORITY_IMAGE = 1
+PRIORITY_TELEMETRY = 2
+
+# Morse code, for synthesised CW idents.
+MORSE = {
+    'A': '.-', 'B': '-...', 'C': '-.-.', 'D': '-..', 'E': '.', 'F': '..-.', 'G': '--.', 'H': '....',
+    'I': '..', 'J': '.---', 'K': '-.-', 'L': '.-..', 'M': '--', 'N': '-.', 'O': '---', 'P': '.--.',
+    'Q': '--.-', 'R': '.-.', 'S': '...', 'T': '-', 'U': '..-', 'V': '...-', 'W': '.--', 'X': '-..-',
+    'Y': '-.--', 'Z': '--..', '0': '-----', '1': '.----', '2': '..---', '3': '...--', '4': '....-',
+    '5': '.....', '6': '-....', '7': '--...', '8': '---..', '9': '----.', '/': '-..-.'
+}
+
+
+# Native sample rates found by device_sample_rate(), indexed by device.
+_device_rates = {}
+
+# Sample rate used if a device's rates cannot be queried (e.g. it is busy). Nearly every sound device
+# supports 48 kHz natively, and a plug device will accept it either way.
+FALLBACK_SAMPLE_RATE = 48000
+
+
+def hardware_device(device):
+    ''' The ALSA device to query for the rates of a device name (e.g. plughw:1,0 -> hw:1,0).
+    None is aplay's default device. Other names (including 'default', which need not be card 0) are queried
+    as they are: a hw or dmix device reports the rate it runs at, and a plug device accepts any rate. '''
+    if device is None:
+        return 'default'
+    if device.startswith('plughw:'):
+        return device[4:]
+    return device
+
+
+def parse_hw_rates(output):
+    ''' Parse the RATE line of aplay --dump-hw-params output. Returns (min, max) rate, or None. '''
+    _match = re.search(r'^RATE:\s*\[?\s*(\d+)(?:\s+(\d+))?', output, re.MULTILINE)
+    if _match is None:
+        return None
+    _min = int(_match.group(1))
+    _max = int(_match.group(2)) if _match.group(2) != None else _min
+    return (_min, _max)
+
+
+def device_sample_rate(device=None, default=22050, timeout=2.0, debug_ptr=None):
+    ''' Query the native sample rate of an ALSA output device (as given to aplay -D, None = the default device),
+    using aplay --dump-hw-params on the hardware device behind it. If the hardware supports a range of rates
+    including default, default is used.
+    If the device cannot be queried (e.g. it is busy, or aplay is not available), FALLBACK_SAMPLE_RATE is
+    returned, and the failure is reported to debug_ptr (or stdout). Successful results are cached per device. '''
+    if device in _device_rates:
+        return _device_rates[device]
+
+    _output = ""
+    try:
+        # aplay dumps the parameters and then starts playing, so stop it as soon as they have been read.
+        _process = subprocess.Popen(['aplay', '-D', hardware_device(device), '--dump-hw-params', '-t', 'raw', '-f', 'S16_LE', '/dev/zero'],
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+        _deadline = time.monotonic() + timeout
+        while time.monotonic() < _deadline:
+            _line = _process.stderr.readline()
+            if _line == "":
+                break
+            _output += _line
+            if _line.startswith('RATE:'):
+                break
+        _process.kill()
+        _process.wait()
+    except OSError as e:
+        _output = str(e)
+
+    _rates = parse_hw_rates(_output)
+    if _rates is None:
+        # Don't cache this, so the device is queried again next time.
+        _message = "Could not read the sample rates of %s (%s) - using %d Hz." % (hardware_device(device),
+            _output.strip().split('\n')[-1] if _output.strip() != "" else "no output", FALLBACK_SAMPLE_RATE)
+        if debug_ptr != None:
+            debug_ptr(_message)
+        else:
+            print(_message)
+        return FALLBACK_SAMPLE_RATE
+
+    _rate = min(max(default, _rates[0]), _rates[1])
+    _device_rates[device] = _rate
+    return _rate
+
+
+def unpack_samples(data, sample_width, channels):
+    ''' Unpack raw little-endian PCM audio into a list of 16-bit mono samples (channels are averaged). '''
+    if sample_width == 1:
+        # 8-bit WAV audio is unsigned.
+        _samples = [(_byte - 128) << 8 for _byte in bytearray(data)]
+    elif sample_width == 2:
+        _array = array.array('h', data[:len(data) - len(data) % 2])
+        if sys.byteorder == 'big':
+            _array.byteswap()
+        _samples = _array.tolist()
+    elif sample_width in (3, 4):
+        _samples = [int.from_bytes(data[i:i + sample_width], 'little', signed=True) >> (8*(sample_width - 2))
+            for i in range(0, len(data) - sample_width + 1, sample_width)]
+    else:
+        raise ValueError("Unsupported sample width: %d bytes." % sample_width)
+
+    if channels > 1:
+        _samples = [sum(_samples[i:i + channels])//channels for i in range(0, len(_samples) - channels + 1, channels)]
+    return _samples
+
+
+def resample(samples, sample_rate, target_rate):
+    ''' Resample a list of samples from sample_rate to target_rate, by linear interpolation.
+    Returns raw 16-bit samples. Uses numpy if it is available. '''
+    _count = int(len(samples)*target_rate/sample_rate)
+    if np != None:
+        _positions = np.arange(_count)*(float(sample_rate)/target_rate)
+        _output = np.interp(_positions, np.arange(len(samples)), np.asarray(samples, dtype=np.float64))
+        return np.clip(np.round(_output), -32768, 32767).astype('<i2').tobytes()
+
+    _output = array.array('h', [0]*_count)
+    _last = len(samples) - 1
+    for i in range(_count):
+        _position = i*float(sample_rate)/target_rate
+        _index = int(_position)
+        _next = samples[min(_index + 1, _last)]
+        _output[i] = max(-32768, min(32767, int(round(samples[_index] + (_next - samples[_index])*(_position - _index)))))
+    if sys.byteorder == 'big':
+        _output.byteswap()
+    return _output.tobytes()
+
+
+def convert_audio(data, sample_width, channels, sample_rate, target_rate):
+    ''' Convert raw audio to 16-bit mono at target_rate.
+    Uses audioop if it is available (it was removed in Python 3.13), otherwise resample(). '''
+    if audioop is None:
+        if (sample_width, channels, sample_rate) == (2, 1, target_rate):
+            return data
+        return resample(unpack_samples(data, sample_width, channels), sample_rate, target_rate)
+
+    if sample_width != 2:
+        data = audioop.lin2lin(data, sample_width, 2)
+    if channels == 2:
+        data = audioop.tomono(data, 2, 0.5, 0.5)
+    if sample_rate != target_rate:
+        (data, _state) = audioop.ratecv(data, 2, 1, sample_rate, target_rate, None)
+    return data
+
+
+def load_wav(filename, sample_rate=22050):
+    ''' Load a WAV file into memory, as raw 16-bit mono samples at sample_rate. '''
+    _wav = wave.open(filename, 'rb')
+    _data = _wav.readframes(_wav.getnframes())
+    _data = convert_audio(_data, _wav.getsampwidth(), _wav.getnchannels(), _wav.getframerate(), sample_rate)
+    _wav.close()
+    return _data
+
+
+def cw_ident(callsign, sample_rate=22050, wpm=20, frequency=800, amplitude=16000):
+    ''' Synthesise a CW ident as raw 16-bit mono samples.
+    Each element is built from a pre-computed dit or dah tone (with raised-cosine edges to avoid key clicks). '''
+    _dit = 1.2/wpm
+    _ramp = min(0.005, _dit/4)
+
+    def _tone(duration):
+        _n = int(duration*sample_rate)
+        _ramp_n = int(_ramp*sample_rate)
+        _samples = array.array('h', [0]*_n)
+        for i in range(_n):
+            _envelope = 1.0
+            if i < _ramp_n:
+                _envelope = 0.5 - 0.5*math.cos(math.pi*i/_ramp_n)
+            elif i >= _n - _ramp_n:
+                _envelope = 0.5 - 0.5*math.cos(math.pi*(_n - i)/_ramp_n)
+            _samples[i] = int(amplitude*_envelope*math.sin(2*math.pi*frequency*i/sample_rate))
+        return _samples.tobytes()
+
+    def _silence(units):
+        return bytes(2*int(units*_dit*sample_rate))
+
+    _elements = {'.': _tone(_dit), '-': _tone(3*_dit)}
+
+    _data = [_silence(3)]
+    for _word in callsign.upper().split():
+        for _char in _word:
+            for _element in MORSE.get(_char, ''):
+                _data.append(_elements[_element])
+                _data.append(_silence(1))
+            # Characters are separated by 3 dits (including the one after the last element).
+            _data.append(_silence(2))
+        _data.append(_silence(4))
+    return b''.join(_data)
+
+
+class AudioStream(object):
+    ''' A single long-running aplay process, fed raw 16-bit mono audio on stdin.
+
+    When no audio is being written, aplay simply underruns, and restarts when more arrives.
+    The time at which written audio finishes playing is tracked, so callers can wait for it.
+
+    aplay holds back the last partial period it has read, and won't restart playback after an
+    underrun until its buffer is full, so the end of any audio written is only played once more
+    audio follows it. Write tail() after the last audio of a transmission to push it all out.
+    '''
+
+    def __init__(self,
+                sample_rate=22050,
+                device=None,
+                latency=0.1,
+                buffer_time=0.1,
+                period_time=0.025,
+                simulate=False,
+                debug_ptr=None):
+        ''' Initialise an AudioStream. The aplay process is started on the first write.
+
+        Keyword Arguments:
+        sample_rate: Sample rate of the stream (Hz). If None, the native rate of device is used (see device_sample_rate()).
+        device: ALSA device to play on. None = the default device.
+        latency: Estimated delay (seconds) from writing audio to it being played, after an underrun.
+        buffer_time: aplay's buffer length (seconds).
+        period_time: aplay's period length (seconds).
+        simulate: If True, don't start aplay - just track the audio timing.
+        debug_ptr: Reference to a function which can handle debug messages.
+        '''
+        self.device = device
+        self.latency = latency
+        self.buffer_time = buffer_time
+        self.period_time = period_time
+        self.simulate = simulate
+        self.debug_ptr = debug_ptr
+        if sample_rate is None:
+            # Query the same device that aplay will be started on.
+            sample_rate = device_sample_rate(device, debug_ptr=self.debug_message)
+        self.sample_rate = sample_rate
+
+        self.process = None
+        self.lock = Lock()
+        # Time (time.monotonic()) at which all written audio will have been played.
+        self.end_time = 0.0
+        self.restarts = 0
+
+    def debug_message(self, message):
+        ''' Write a debug message, either to the debug_ptr function, or to stdout. '''
+        message = "Audio Stream: " + message
+        if self.debug_ptr != None:
+            self.debug_ptr(message)
+        else:
+            print(message)
+
+    def start(self):
+        if self.simulate or ((self.process != None) and (self.process.poll() is None)):
+            return
+
+        _command = ['aplay', '-q', '-t', 'raw', '-f', 'S16_LE', '-c', '1', '-r', str(self.sample_rate),
+            '--buffer-time=%d' % int(self.buffer_time*1e6), '--period-time=%d' % int(self.period_time*1e6)]
+        if self.device != None:
+            _command += ['-D', self.device]
+        _command.append('-')
+
+        if self.process != None:
+            self.restarts += 1
+        self.process = subprocess.Popen(_command, stdin=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+    def duration(self, data):
+        ''' Duration (seconds) of some raw audio. '''
+        return len(data)/(2.0*self.sample_rate)
+
+    def tail(self):
+        ''' Silence long enough to flush everything written before it through aplay's buffer. '''
+        return bytes(2*int((self.buffer_time + self.period_time)*self.sample_rate))
+
+    def write(self, data):
+        ''' Queue raw audio for playback. This blocks while the pipe to aplay is full. Returns True on success. '''
+        with self.lock:
+            self.start()
+
+            _now = time.monotonic()
+            if self.end_time < _now:
+                # The stream has run dry, so playback restarts now.
+                self.end_time = _now + self.latency
+            self.end_time += self.duration(data)
+
+            if self.simulate:
+                return True
+
+            try:
+                self.process.stdin.write(data)
+                self.process.stdin.flush()
+                return True
+            except (BrokenPipeError, OSError) as e:
+                self.debug_message("aplay exited (%s), restarting." % str(e))
+                self.process = None
+                self.end_time = 0.0
+                return False
+
+    def wait(self):
+        ''' Wait until all written audio has been played. '''
+        _delay = self.end_time - time.monotonic()
+        if _delay > 0:
+            time.sleep(_delay)
+
+    def close(self):
+        if self.process != None:
+            try:
+                self.process.stdin.close()
+            except (BrokenPipeError, OSError):
+                pass
+            self.process.wait()
+            self.process = None
+
+
+class TransmitItem(object):
+    ''' A queued transmission. Use wait() to block until it has been sent. '''
+
+    def __init__(self, data, priority, label, sequence):
+        self.data = data
+        self.priority = priority
+        self.label = label
+        self.sequence = sequence
+        self.done = Event()
+        self.success = False
+
+    def __lt__(self, other):
+        return (self.priority, self.sequence) < (other.priority, other.sequence)
+
+    def wait(self, timeout=None):
+        ''' Wait for the item to be sent. Returns True if it was sent successfully. '''
+        self.done.wait(timeout)
+        return self.success
+
+
+class TransmitQueue(object):
+    ''' Prioritised transmit queue, which merges idents into PTT sessions as they fall due. '''
+
+    def __init__(self,
+                stream=None,
+                ident_audio=None,
+                ident_interval=600.0,
+                ptt_ptr=None,
+                mark_ptr=None,
+                ptt_delay=0.5,
+                gap=0.5,
+                debug_ptr=None):
+        ''' Initialise a TransmitQueue. Call start() to start the transmit thread.
+
+        Keyword Arguments:
+        stream: The AudioStream to play audio through. Defaults to a new AudioStream at 22050 Hz.
+        ident_audio: Ident audio, as raw 16-bit mono samples at the stream sample rate (see load_wav() and cw_ident()).
+                     If None, no idents are sent.
+        ident_interval: Maximum time (seconds) between idents, while transmitting. A session starting more than
+                        this long after the last ident (or before the first) begins with an ident.
+        ptt_ptr: Function used to key the transmitter (accepts True/False). Defaults to dra818_ptt.
+        mark_ptr: Function used to record audio start/end events. Defaults to gpio_mark.
+        ptt_delay: Delay (seconds) between keying the transmitter and starting the audio.
+        gap: Silence (seconds) between items in the same session.
+        debug_ptr: Reference to a function which can handle debug messages.
+        '''
+        self.stream = stream if stream != None else AudioStream()
+        self.ident_audio = ident_audio
+        self.ident_interval = ident_interval
+        self.ptt_ptr = ptt_ptr if ptt_ptr != None else dra818_ptt
+        self.mark_ptr = mark_ptr if mark_ptr != None else gpio_mark
+        self.ptt_delay = ptt_delay
+        self.gap = gap
+        self.debug_ptr = debug_ptr
+
+        self.queue = []
+        self.sequence = 0
+        self.condition = Condition()
+        self.running = False
+        self.tx_thread = None
+
+        # Time (time.monotonic()) of the last ident - the start of a session for a start ident, or its end for an end ident.
+        self.last_ident = None
+
+        # Statistics
+        self.sessions = 0
+        self.items_sent = 0
+        self.idents = 0
+        self.start_idents = 0
+        # Longest time from an ident to the end of a transmission.
+        self.max_ident_age = 0.0
+
+    def debug_message(self, message):
+        ''' Write a debug message, either to the debug_ptr function, or to stdout. '''
+        message = "TX Queue: " + message
+        if self.debug_ptr != None:
+            self.debug_ptr(message)
+        else:
+            print(message)
+
+    def start(self):
+        self.running = True
+        self.tx_thread = Thread(target=self.tx_loop)
+        self.tx_thread.daemon = True
+        self.tx_thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        if self.tx_thread != None:
+            self.tx_thread.join()
+        self.stream.close()
+
+    def put(self, data, priority=PRIORITY_IMAGE, label='audio'):
+        ''' Queue raw 16-bit mono audio (at the stream sample rate) for transmission. Returns a TransmitItem. '''
+        with self.condition:
+            _item = TransmitItem(data, priority, label, self.sequence)
+            self.sequence += 1
+            heapq.heappush(self.queue, _item)
+            self.condition.notify()
+        return _item
+
+    def put_wav(self, filename, priority=PRIORITY_IMAGE, label=None):
+        ''' Queue a WAV file for transmission. Returns a TransmitItem. '''
+        return self.put(load_wav(filename, self.stream.sample_rate), priority=priority, label=label if label != None else filename)
+
+    def ident_placement(self, session_time):
+        ''' Decide where idents are needed in a session lasting session_time seconds (without idents), starting now.
+        Returns a tuple of (ident at the start, ident at the end). '''
+        if self.ident_audio is None:
+            return (False, False)
+        _now = time.monotonic()
+        # Identify when starting to transmit, unless there has been an ident within the interval.
+        _start = (self.last_ident is None) or ((_now - self.last_ident) > self.ident_interval)
+        if _start:
+            # The start ident covers the session, unless the session itself runs past the interval.
+            _end = (session_time + self.gap + self.stream.duration(self.ident_audio)) >= self.ident_interval
+        else:
+            _end = (_now + session_time - self.last_ident) >= self.ident_interval
+            # A session longer than the ident interval needs an ident at the start as well.
+            _start = _end and (session_time > self.ident_interval)
+        return (_start, _end)
+
+    def tx_loop(self):
+        while True:
+            with self.condition:
+                while self.running and len(self.queue) == 0:
+                    self.condition.wait()
+                if not self.running:
+                    break
+                # Send everything that is waiting in one session, highest priority first.
+                _items = [heapq.heappop(self.queue) for i in range(len(self.queue))]
+
+            try:
+                self.transmit_session(_items)
+            except Exception as e:
+                self.debug_message("Transmit failed - %s" % str(e))
+                try:
+                    self.ptt_ptr(False)
+                except Exception:
+                    pass
+                for _item in _items:
+                    _item.done.set()
+
+        # Don't leave anyone waiting.
+        for _item in self.queue:
+            _item.done.set()
+
+    def transmit_session(self, items):
+        ''' Key up, and send a list of items (plus any idents that are due), in one PTT session. '''
+        _gap = bytes(2*int(self.gap*self.stream.sample_rate))
+        _parts = []
+        for _item in items:
+            if len(_parts) > 0:
+                _parts.append(_gap)
+            _parts.append(_item.data)
+
+        _session_time = self.ptt_delay + self.stream.latency + sum([self.stream.duration(_part) for _part in _parts + [self.stream.tail()]])
+        (_ident_start, _ident_end) = self.ident_placement(_session_time)
+        if _ident_start:
+            _parts = [self.ident_audio, _gap] + _parts
+        if _ident_end:
+            _parts = _parts + [_gap, self.ident_audio]
+        # Keep the transmitter keyed until the end of the audio has actually been played.
+        _parts.append(self.stream.tail())
+
+        self.debug_message("Transmitting %s%s%s." % ("ident + " if _ident_start else "", ", ".join([_item.label for _item in items]), " + ident" if _ident_end else ""))
+
+        self.ptt_ptr(True)
+        time.sleep(self.ptt_delay)
+        if _ident_start:
+            self.last_ident = time.monotonic()
+
+        self.mark_ptr('audio_start')
+        _success = True
+        for _part in _parts:
+            _success = self.stream.write(_part) and _success
+        self.stream.wait()
+        self.mark_ptr('audio_end')
+
+        self.ptt_ptr(False)
+
+        _now = time.monotonic()
+        if _ident_end:
+            self.last_ident = _now
+        elif self.last_ident != None:
+            self.max_ident_age = max(self.max_ident_age, _now - self.last_ident)
+        self.idents += int(_ident_start) + int(_ident_end)
+        if _ident_start:
+            self.start_idents += 1
+
+        self.sessions += 1
+        self.items_sent += len(items)
+        for _item in items:
+            _item.success = _success
+            _item.done.set()
+
+    def stats(self):
+        return {
+            'sessions': self.sessions,
+            'items': self.items_sent,
+            'idents': self.idents,
+            'start_idents': self.start_idents,
+            'max_ident_age': self.max_ident_age,
+            'stream_restarts': self.stream.restarts
+        }
+
+
+def benchmark_playback(device='plughw:0,0', mode='pd120', seconds=20.0, rates=None):
+    ''' Measure the CPU time aplay uses to play SSTV audio through device (which should be a plug device),
+    with the audio synthesised at 22050 Hz (so ALSA resamples it), and at the device's native rate.
+    The encode CPU time at each rate is also reported. '''
+    from sstv_encoder import FixedPointSSTVEncoder, test_card, write_wav
+
+    _native = device_sample_rate(device)
+    if rates is None:
+        # If the device runs at 22050 Hz natively, show the cost of resampling 48 kHz audio instead.
+        rates = [22050, _native] if _native != 22050 else [22050, 48000]
+    print("%s: native rate %d Hz. Playing %.0f s of %s at each rate." % (device, _native, seconds, mode))
+
+    _dir = tempfile.mkdtemp()
+    for _rate in rates:
+        _encoder = FixedPointSSTVEncoder(mode=mode, sample_rate=_rate)
+        _image = test_card(_encoder.mode['resolution'])
+        _start = time.process_time()
+        _samples = _encoder.encode(_image)
+        _encode_cpu = time.process_time() - _start
+
+        _wav = os.path.join(_dir, "%d.wav" % _rate)
+        write_wav(_samples[:int(seconds*_rate)], _wav, _rate)
+
+        _before = resource.getrusage(resource.RUSAGE_CHILDREN)
+        _wall = time.monotonic()
+        try:
+            _result = subprocess.call(['aplay', '-q', '-D', device, _wav])
+        except OSError as e:
+            print("Could not run aplay - %s" % str(e))
+            break
+        _wall = time.monotonic() - _wall
+        _after = resource.getrusage(resource.RUSAGE_CHILDREN)
+        _play_cpu = (_after.ru_utime + _after.ru_stime) - (_before.ru_utime + _before.ru_stime)
+
+        print("%d Hz%s: encode %.3f s CPU, playback %.3f s CPU over %.1f s (%.2f%% of a core)%s" % (
+            _rate, "" if _rate == _native else " (resampled)", _encode_cpu, _play_cpu, _wall,
+            100.0*_play_cpu/max(_wall, 1e-6), "" if _result == 0 else ", aplay failed"))
+
+    os.system("rm -rf %s" % _dir)
+
+
+def benchmark_ident(duration=30.0, ident_interval=6.0, airtime=1.5, delay=(0.5, 3.0), seed=0):
+    ''' Simulate a session of images at random intervals (with the timescale compressed), sent through
+    a TransmitQueue with a simulated audio stream and GPIO. Reports PTT cycles and the ident interval,
+    against the previous approach of a separate ident PTT cycle after every 4th image. '''
+    _random = random.Random(seed)
+    _gpio = SimulatedGPIO()
+    set_gpio_backend(_gpio)
+    dra818_setup_io()
+
+    _rate = 8000
+    _stream = AudioStream(sample_rate=_rate, simulate=True)
+    _ident = bytes(2*int(0.3*_rate))
+    _queue = TransmitQueue(stream=_stream, ident_audio=_ident, ident_interval=ident_interval,
+        ptt_ptr=dra818_ptt, mark_ptr=gpio_mark, ptt_delay=0.05, gap=0.05, debug_ptr=lambda x: None)
+    _queue.start()
+
+    _start = time.monotonic()
+    _images = 0
+    while time.monotonic() - _start < duration:
+        _queue.put(bytes(2*int(airtime*_rate)), label='image %d' % _images).wait()
+        _images += 1
+        # Occasionally queue a telemetry burst alongside the next image.
+        if _random.random() < 0.3:
+            _queue.put(bytes(2*int(0.2*_rate)), priority=PRIORITY_TELEMETRY, label='telemetry')
+        time.sleep(_random.uniform(*delay))
+    _queue.stop()
+
+    _stats = _queue.stats()
+    _timing = _gpio.ptt_timing()
+    print("%d images in %.0f s: %d PTT sessions, %d idents (%d at the start of a session), transmitting at most %.2f s after an ident (interval %.1f s)." % (
+        _images, duration, len(_timing['sessions']), _stats['idents'], _stats['start_idents'], _stats['max_ident_age'], ident_interval))
+    print("Ident every 4th image in its own PTT session would have used %d PTT sessions, with the ident interval varying with the image delay." % (
+        _images + (_images + 3)//4))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--benchmark", action="store_true", default=False, help="Run a simulated transmit session, then exit.")
+    parser.add_argument("--cw", type=str, default=None, help="Synthesise a CW ident for this callsign, and play it.")
+    parser.add_argument("--wav", type=str, default=None, help="Load and play an ident WAV file through the audio stream.")
+    parser.add_argument("--device", type=str, default=None, help="ALSA output device.")
+    parser.add_argument("--rate", action="store_true", default=False, help="Print the native sample rate of the output device, then exit.")
+    parser.add_argument("--playback-benchmark", action="store_true", default=False, help="Measure playback CPU use with and without resampling, then exit.")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark_ident()
+        sys.exit(0)
+
+    if args.rate:
+        print("%s: %d Hz" % (args.device, device_sample_rate(args.device)))
+        sys.exit(0)
+
+    if args.playback_benchmark:
+        benchmark_playback(device=args.device if args.device != None else 'plughw:0,0')
+        sys.exit(0)
+
+    _stream = AudioStream(sample_rate=None, device=args.device)
+    if args.cw != None:
+        _stream.write(cw_ident(args.cw, _stream.sample_rate))
+    if args.wav != None:
+        _stream.write(load_wav(args.wav, _stream.sample_rate))
+    _stream.write(_stream.tail())
+    _stream.wait()
+    _stream.close()
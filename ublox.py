@@ -11,8 +11,9 @@ Added UBloxGPS abstraction layer class for use with Wenet TX system.
 
 import struct
 import datetime
-from threading import Thread
-import time, os, json, calendar, math, traceback, socket, argparse
+from collections import deque
+from threading import Thread, Lock
+import time, os, sys, json, calendar, math, traceback, socket, argparse, select, mmap, zlib
 
 # protocol constants
 PREAMBLE1 = 0xb5
@@ -179,6 +180,18 @@ RESET_HW_GRACEFUL   = 4
 RESET_GPS_STOP      = 8
 RESET_GPS_START     = 9
 
+# Shared memory solution block layout (see UBloxSharedState).
+# Header: generation counter (uint32), CRC32 of the body (uint32).
+SHM_HEADER_FORMAT = '<II'
+# Body: latitude, longitude, altitude, ground_speed, ascent_rate, heading, iTOW, UTC timestamp (unix seconds),
+#       fix arrival time (time.monotonic()), week, gpsFix, numSV, leapS, dynamic_model.
+SHM_BODY_FORMAT = '<dddddddddHBBbB'
+SHM_BODY_OFFSET = struct.calcsize(SHM_HEADER_FORMAT)
+SHM_SIZE = SHM_BODY_OFFSET + struct.calcsize(SHM_BODY_FORMAT)
+
+# Mean earth radius (metres), used when extrapolating positions along a velocity vector.
+EARTH_RADIUS = 6371008.8
+
 class UBloxError(Exception):
     '''Ublox error class'''
     def __init__(self, msg):
@@ -536,6 +549,16 @@ msg_types = {
 }
 
 
+def build_message(msg_class, msg_id, payload):
+    '''build a UBloxMessage with class, id and payload'''
+    msg = UBloxMessage()
+    msg._buf = struct.pack('<BBBBH', PREAMBLE1, PREAMBLE2, msg_class, msg_id, len(payload))
+    msg._buf += payload
+    (ck_a, ck_b) = msg.checksum(msg._buf[2:])
+    msg._buf += struct.pack('<BB', ck_a, ck_b)
+    return msg
+
+
 class UBloxMessage:
     '''UBlox message class - holds a UBX binary message'''
     def __init__(self):
@@ -544,6 +567,11 @@ class UBloxMessage:
         self._recs = []
         self._unpacked = False
         self.debug_level = 0
+        # Estimated time.time() and time.monotonic() arrival times of the first byte of the message.
+        self._rx_time = None
+        self._rx_monotonic = None
+        # True if the times above are late by an unknown amount, as the message had queued up before it was read.
+        self._rx_queued = False
 
     def __str__(self):
         '''format a message as a string'''
@@ -679,7 +707,8 @@ class UBloxMessage:
 class UBlox:
     '''main UBlox control class.
 
-    port can be a file (for reading only) or a serial device
+    port can be a file (for reading only), a serial device, or a socket
+    given as tcp:host:port or unix:/path/to/socket
     '''
     def __init__(self, port, baudrate=115200, timeout=0):
 
@@ -688,6 +717,14 @@ class UBlox:
         self.use_sendrecv = False
         self.read_only = False
         self.debug_level = 0
+        # True if the device is a UART, so bytes arrive at the baud rate (see receive_message()).
+        self.uart = False
+        # (time.time(), time.monotonic()) arrival of the start of the current burst of messages, or None if
+        # it was not seen, and the number of bytes read since. Messages read within burst_window seconds of the
+        # start of a burst, which were already waiting when read, are timed from the start of the burst.
+        self.burst_rx = None
+        self.burst_bytes = 0
+        self.burst_window = 0.1
 
         if self.serial_device.startswith("tcp:"):
             import socket
@@ -698,6 +735,12 @@ class UBlox:
             self.dev.setblocking(1)
             self.dev.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)            
             self.use_sendrecv = True
+        elif self.serial_device.startswith("unix:"):
+            import socket
+            self.dev = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.dev.connect(self.serial_device[5:])
+            self.dev.setblocking(1)
+            self.use_sendrecv = True
         elif os.path.isfile(self.serial_device):
             self.read_only = True
             self.dev = open(self.serial_device, mode='rb')
@@ -705,6 +748,10 @@ class UBlox:
             import serial
             self.dev = serial.Serial(self.serial_device, baudrate=self.baudrate,
                                      dsrdtr=False, rtscts=False, xonxoff=False, timeout=timeout)
+            # On a USB link (CDC-ACM, or a USB-serial adapter) data arrives in USB packets, not at the baud rate,
+            # and a pseudo-terminal has no baud rate at all.
+            _path = os.path.realpath(self.serial_device)
+            self.uart = not (os.path.basename(_path).startswith(('ttyACM', 'ttyUSB')) or _path.startswith('/dev/pts/'))
         self.logfile = None
         self.log = None
         self.preferred_dynamic_model = None
@@ -716,6 +763,17 @@ class UBlox:
         self.dev.close()
         self.dev = None
 
+    def byte_time(self):
+        '''return the time taken to transfer one byte (8N1 framing) at the configured baud rate'''
+        return 10.0/self.baudrate
+
+    def pending_bytes(self):
+        '''return the number of received bytes waiting to be read, or 0 if this is not known'''
+        try:
+            return self.dev.in_waiting
+        except AttributeError:
+            return 0
+
     def set_debug(self, debug_level):
         '''set debug level'''
         self.debug_level = debug_level
@@ -839,13 +897,42 @@ class UBlox:
         msg = UBloxMessage()
         while True:
             n = msg.needed_bytes()
+            # If the start of the message is already waiting, it arrived before this read.
+            _queued = (len(msg._buf) == 0) and (self.pending_bytes() > 0)
             b = self.read(n)
             if not b:
                 if ignore_eof:
                     time.sleep(0.01)
                     continue
                 return None
+            _rx_time = time.time()
+            _rx_monotonic = time.monotonic()
+            _was_empty = len(msg._buf) == 0
             msg.add(b)
+            if _was_empty and len(msg._buf) > 0:
+                # This read contained the start of the message. The read returned when the last byte arrived.
+                # On a UART, back-date the timestamp by the transfer time of the message bytes in this chunk.
+                # Over USB, the bytes arrive together, so there is nothing to correct for.
+                _transfer_time = (len(msg._buf) - 1)*self.byte_time() if self.uart else 0.0
+                if not _queued:
+                    # The start of a burst of messages, which we saw arrive.
+                    self.burst_rx = (_rx_time - _transfer_time, _rx_monotonic - _transfer_time)
+                    self.burst_bytes = 0
+                    msg._rx_time = self.burst_rx[0]
+                    msg._rx_monotonic = self.burst_rx[1]
+                elif (self.burst_rx != None) and (_rx_monotonic - self.burst_rx[1] < self.burst_window):
+                    # The uBlox sends each solution's messages back to back, so a message queued behind the
+                    # start of a burst arrived straight after the bytes before it.
+                    _offset = self.burst_bytes*self.byte_time() if self.uart else 0.0
+                    msg._rx_time = self.burst_rx[0] + _offset
+                    msg._rx_monotonic = self.burst_rx[1] + _offset
+                else:
+                    # We were too late to see the start of the burst arrive, so its time is unknown.
+                    self.burst_rx = None
+                    msg._rx_time = _rx_time - _transfer_time
+                    msg._rx_monotonic = _rx_monotonic - _transfer_time
+                    msg._rx_queued = True
+            self.burst_bytes += len(b)
             if self.log is not None:
                 self.log.write(b)
                 self.log.flush()
@@ -876,12 +963,7 @@ class UBlox:
 
     def send_message(self, msg_class, msg_id, payload):
         '''send a ublox message with class, id and payload'''
-        msg = UBloxMessage()
-        msg._buf = struct.pack('<BBBBH', 0xb5, 0x62, msg_class, msg_id, len(payload))
-        msg._buf += payload
-        (ck_a, ck_b) = msg.checksum(msg._buf[2:])
-        msg._buf += struct.pack('<BB', ck_a, ck_b)
-        self.send(msg)
+        self.send(build_message(msg_class, msg_id, payload))
 
     def configure_solution_rate(self, rate_ms=200, nav_rate=1, timeref=0):
         '''configure the solution rate in milliseconds'''
@@ -956,11 +1038,16 @@ class UBloxGPS(object):
 
     def __init__(self,port='/dev/ublox', baudrate=115200, timeout=2,
             callback=None,
+            raw_callback=None,
             update_rate_ms=500,
             dynamic_model=DYNAMIC_MODEL_AIRBORNE1G,
             debug_ptr = None,
             log_file = None,
-            ntpd_update = False):
+            ntpd_update = False,
+            ntpd_offset = 0.0,
+            fix_history = 20,
+            max_extrapolation = 5.0,
+            shm_path = None):
 
         """ Initialise a UBloxGPS Abstraction layer object.
         
@@ -973,6 +1060,9 @@ class UBloxGPS(object):
                   state dictionary upon receipt of a GPS fix from the uBlox.
                   NOTE: The callback will be called in a separate thread.
 
+        raw_callback: reference to a callback function that will be passed the raw bytes of every
+                  valid UBX frame received. This is called from the RX thread, so must return quickly.
+
         update_rate_ms: Requested GPX fix rate. uBlox chip is capable of max 10Hz (100ms) updates.
         dynamic_model: Dynamic model to use. See above for list of possible models.
 
@@ -986,11 +1076,25 @@ class UBloxGPS(object):
         ntpd_update:  If set to true, use ntpdshm to push time information into NTPD via the Shared Memory Interface.
                       This uses shared memory 'unit 2', and so the following lines need to be added to /etc/ntp.conf:
                         server 127.127.28.2 minpoll 4 maxpoll 4
-                        fudge 127.127.28.2 time1 0.09 refid PYTH stratum 2
-                      Adjust the '0.09' in the fudge line to compensate for processing delays (which are hopefully constant).
-                      This GPS time sync should be good to maybe +/- 50 mS or so.
+                        fudge 127.127.28.2 time1 0.0 refid PYTH stratum 2
+                      The receive timestamp passed to NTPD is the time the read containing the first byte of the
+                      NAV_TIMEGPS message returned (on a UART, back-dated by the serial transfer time of the bytes
+                      in that read), rather than the time it was parsed, so parse and thread-scheduling delays are
+                      removed. Messages queued behind the start of the same burst are timed from the start of
+                      the burst. If the whole burst had queued up in the driver before it was read (i.e. the RX
+                      thread was late), the arrival time is unknown, so no sample is sent to NTPD.
+                      The remaining (constant) uBlox output latency is reported by time_sync_stats(), and can be
+                      compensated either with the fudge time1 value, or with ntpd_offset.
                       This requires the ntpdshm python library: https://pypi.python.org/pypi/ntpdshm/0.2.1
+        ntpd_offset:  Fixed latency (seconds) subtracted from the NTPD receive timestamps.
+
+        fix_history:  Number of recent GPS solutions to retain (with their time.monotonic() arrival times)
+                      for use by position_at() and fix_age().
+        max_extrapolation: position_at() returns None for times further than this (seconds) from any buffered fix,
+                      rather than dead-reckoning a position through a GPS outage.
 
+        shm_path:     If set, publish every GPS solution into a shared memory block at this path (e.g. /dev/shm/ublox),
+                      which other processes can read using UBloxSharedState(shm_path).read()
 
         """
 
@@ -1002,8 +1106,26 @@ class UBloxGPS(object):
         self.update_rate_ms = update_rate_ms
         self.debug_ptr = debug_ptr
         self.callback = callback
+        self.raw_callback = raw_callback
         self.ntpd_shm = None
-
+        self.ntpd_offset = ntpd_offset
+
+        # Recent time-sync measurements, as (receive latency, parse delay) tuples, in seconds.
+        self.time_sync_history = deque(maxlen=64)
+        # Number of time-sync measurements discarded, because the message had queued up before it was read.
+        self.time_sync_skipped = 0
+
+        # Ring buffer of recent solutions, and the solution currently being assembled.
+        # Appends and whole-buffer copies of a deque are atomic, so the RX thread and
+        # position_at() callers don't need any further locking.
+        self.fix_history = deque(maxlen=fix_history)
+        self.max_extrapolation = max_extrapolation
+        self.current_epoch = {}
+
+        if shm_path != None:
+            self.shared_state = UBloxSharedState(shm_path, create=True)
+        else:
+            self.shared_state = None
 
         # Open log file, if one has been given.
         if log_file != None:
@@ -1116,6 +1238,127 @@ class UBloxGPS(object):
         timestamp = epoch + elapsed - datetime.timedelta(seconds=leapseconds)
         return (timestamp.isoformat(), timestamp)
 
+    def time_sync_stats(self):
+        """ Return statistics on the recent whole-second NAV_TIMEGPS receive timestamps.
+
+        'latency' is the (corrected) receive timestamp minus the GPS time, which is the uBlox output
+        latency plus any local clock offset. 'jitter' is the standard deviation of the latency,
+        and 'parse_delay' is the mean time from the first byte arriving until the message was handled.
+        'skipped' is the number of measurements discarded because the message had queued up before it was read.
+        Returns None if no measurements are available.
+        """
+        _history = list(self.time_sync_history)
+
+        if len(_history) == 0:
+            return None
+
+        _latencies = [x[0] for x in _history]
+        _mean = sum(_latencies)/len(_latencies)
+        _jitter = math.sqrt(sum([(x - _mean)**2 for x in _latencies])/len(_latencies))
+
+        return {
+            'count': len(_latencies),
+            'latency': _mean,
+            'latency_min': min(_latencies),
+            'latency_max': max(_latencies),
+            'jitter': _jitter,
+            'parse_delay': sum([x[1] for x in _history])/len(_history),
+            'skipped': self.time_sync_skipped
+        }
+
+    def add_fix(self, epoch):
+        """ Add a completed solution to the fix history.
+        Epochs which are missing a position or velocity (i.e. we started receiving mid-epoch),
+        or which are not a 2D/3D fix, are discarded.
+        """
+        for _field in ('monotonic', 'latitude', 'longitude', 'altitude', 'velN', 'velE', 'velD', 'gpsFix'):
+            if _field not in epoch:
+                return False
+
+        if epoch['gpsFix'] not in (2, 3, 4):
+            return False
+
+        self.fix_history.append(epoch.copy())
+        return True
+
+    def fix_age(self, t=None):
+        """ Return the age (seconds) of the latest fix, relative to time.monotonic() time t (default now).
+        Returns None if no fix has been received yet.
+        """
+        if t is None:
+            t = time.monotonic()
+
+        try:
+            return t - self.fix_history[-1]['monotonic']
+        except IndexError:
+            return None
+
+    def offset_fix(self, fix, dt):
+        """ Move a fix along its velocity vector by dt seconds. """
+        _lat = fix['latitude'] + math.degrees(fix['velN']*dt/EARTH_RADIUS)
+        _cos_lat = max(math.cos(math.radians(fix['latitude'])), 1.0e-6)
+        _lon = fix['longitude'] + math.degrees(fix['velE']*dt/(EARTH_RADIUS*_cos_lat))
+        _alt = fix['altitude'] - fix['velD']*dt
+        return (_lat, _lon, _alt)
+
+    def position_at(self, t=None):
+        """ Estimate our position at time.monotonic() time t (default now).
+
+        If t lies between two buffered fixes, the position is linearly interpolated between them.
+        Otherwise, the position is extrapolated from the nearest fix using the NAV_VELNED velocity.
+
+        Returns a dictionary with the fields 'latitude', 'longitude', 'altitude', 'datetime',
+        'fix_age' (seconds between t and the nearest fix) and 'extrapolated', or None
+        if there are no fixes available, or t is more than max_extrapolation seconds from the nearest fix.
+        """
+        if t is None:
+            t = time.monotonic()
+
+        fixes = list(self.fix_history)
+
+        if len(fixes) == 0:
+            return None
+
+        if t <= fixes[0]['monotonic']:
+            _nearest = fixes[0]
+        elif t >= fixes[-1]['monotonic']:
+            _nearest = fixes[-1]
+        else:
+            # Find the pair of fixes bracketing t.
+            for i in range(1, len(fixes)):
+                if fixes[i]['monotonic'] >= t:
+                    break
+            _before = fixes[i-1]
+            _after = fixes[i]
+            _span = _after['monotonic'] - _before['monotonic']
+            _frac = (t - _before['monotonic'])/_span if _span > 0 else 0.0
+            _fix_age = min(t - _before['monotonic'], _after['monotonic'] - t)
+            if _fix_age > self.max_extrapolation:
+                return None
+
+            return {
+                'latitude': _before['latitude'] + _frac*(_after['latitude'] - _before['latitude']),
+                'longitude': _before['longitude'] + _frac*(_after['longitude'] - _before['longitude']),
+                'altitude': _before['altitude'] + _frac*(_after['altitude'] - _before['altitude']),
+                'datetime': _before['datetime'] + datetime.timedelta(seconds=_frac*_span),
+                'fix_age': _fix_age,
+                'extrapolated': False
+            }
+
+        _dt = t - _nearest['monotonic']
+        if abs(_dt) > self.max_extrapolation:
+            return None
+        (_lat, _lon, _alt) = self.offset_fix(_nearest, _dt)
+
+        return {
+            'latitude': _lat,
+            'longitude': _lon,
+            'altitude': _alt,
+            'datetime': _nearest['datetime'] + datetime.timedelta(seconds=_dt),
+            'fix_age': abs(_dt),
+            'extrapolated': _dt != 0.0
+        }
+
     rx_running = True
     rx_counter = 0
     def rx_loop(self):
@@ -1136,6 +1379,8 @@ class UBloxGPS(object):
         while self.rx_running:
             try:
                 msg = self.gps.receive_message()
+                if self.raw_callback != None:
+                    self.raw_callback(msg._buf)
                 msg_name = msg.name()
                 #print(msg_name)
             except Exception as e:
@@ -1160,18 +1405,29 @@ class UBloxGPS(object):
                 msg.unpack()
                 self.write_state('numSV', msg.numSV)
                 self.write_state('gpsFix', msg.gpsFix)
+                self.current_epoch['numSV'] = msg.numSV
+                self.current_epoch['gpsFix'] = msg.gpsFix
 
             elif msg.name() == "NAV_POSLLH":
+                # Stamp the position with its arrival time before spending any time unpacking it.
+                self.current_epoch['monotonic'] = time.monotonic()
                 msg.unpack()
                 self.write_state('latitude', msg.Latitude*1.0e-7)
                 self.write_state('longitude', msg.Longitude*1.0e-7)
                 self.write_state('altitude', msg.height*1.0e-3)
+                self.current_epoch['latitude'] = msg.Latitude*1.0e-7
+                self.current_epoch['longitude'] = msg.Longitude*1.0e-7
+                self.current_epoch['altitude'] = msg.height*1.0e-3
 
             elif msg.name() == "NAV_VELNED":
                 msg.unpack()
                 self.write_state('ground_speed', msg.gSpeed*0.036) # Convert to kph
                 self.write_state('heading', msg.heading*1.0e-5)
                 self.write_state('ascent_rate', -1.0*msg.velD/100.0)
+                # Keep the NED velocity vector (m/s) for interpolation.
+                self.current_epoch['velN'] = msg.velN/100.0
+                self.current_epoch['velE'] = msg.velE/100.0
+                self.current_epoch['velD'] = msg.velD/100.0
 
             elif msg.name() == "NAV_TIMEGPS":
                 msg.unpack()
@@ -1182,10 +1438,29 @@ class UBloxGPS(object):
                 self.write_state('timestamp', time_isotime)
                 self.write_state('datetime', time_datetime)
 
+                # Close off this epoch, and add it to the fix history.
+                self.current_epoch['datetime'] = time_datetime
+                self.add_fix(self.current_epoch)
+
+                if self.shared_state != None:
+                    self.shared_state.write(self.read_state(), self.current_epoch.get('monotonic', 0.0))
+
+                self.current_epoch = {}
+
                 # Update the NTPD Interface, if it exists, and ONLY if we are on a whole-second boundary.
-                if self.ntpd_shm != None and ((msg.iTOW*1.0e-3 - math.floor(msg.iTOW*1.0e-3)) == 0.0):
+                # Messages which were already queued when read have late timestamps, so are not used.
+                if (msg.iTOW % 1000 == 0) and (msg._rx_time != None) and msg._rx_queued:
+                    self.time_sync_skipped += 1
+                elif (msg.iTOW % 1000 == 0) and (msg._rx_time != None):
                     utc_timestamp = calendar.timegm(time_datetime.utctimetuple())
-                    self.ntpd_shm.update(utc_timestamp)
+                    receive_timestamp = msg._rx_time - self.ntpd_offset
+
+                    if self.ntpd_shm != None:
+                        self.ntpd_shm.update(utc_timestamp, receive_timestamp)
+
+                    self.time_sync_history.append((
+                        receive_timestamp - utc_timestamp,
+                        time.monotonic() - msg._rx_monotonic))
 
                 # We now have a 'complete' GPS solution, and can pass it onto a callback,
                 # if we were given one when we were initialised.
@@ -1221,24 +1496,649 @@ class UBloxGPS(object):
         self.gps.close()
         if self.log_file != None:
             self.log_file.close()
+        if self.shared_state != None:
+            self.shared_state.close()
+
+class UBloxServerClient(object):
+    """ A client connected to a UBloxServer, with a bounded transmit buffer. """
+
+    def __init__(self, sock, name, max_buffer):
+        self.sock = sock
+        self.name = name
+        self.max_buffer = max_buffer
+
+        # Queue of whole frames waiting to be sent, and the remainder of the frame currently being sent.
+        self.queue = deque()
+        self.queued_bytes = 0
+        self.pending = b""
+
+        self.sent_frames = 0
+        self.dropped_frames = 0
+
+    def enqueue(self, data):
+        """ Add a frame to the transmit queue. If the queue is full, the oldest whole frames are dropped.
+        Must be called with the server lock held. """
+        if len(data) > self.max_buffer:
+            self.dropped_frames += 1
+            return
+
+        while self.queued_bytes + len(data) > self.max_buffer:
+            self.queued_bytes -= len(self.queue.popleft())
+            self.dropped_frames += 1
+
+        self.queue.append(data)
+        self.queued_bytes += len(data)
+
+    def has_data(self):
+        return len(self.pending) > 0 or len(self.queue) > 0
+
+
+class UBloxServer(object):
+    """ Share a single uBlox receiver between multiple local processes.
+
+    The server owns the GPS (via a UBloxGPS object), which parses the incoming data once.
+    Every raw UBX frame is forwarded to clients of the 'raw' listeners, so any number of processes
+    can use UBlox('tcp:127.0.0.1:port') or UBlox('unix:/path') as if they had the receiver to themselves.
+    Clients of the 'json' listeners receive each decoded GPS solution as a line of JSON.
+
+    Each client has its own bounded buffer. A slow client only causes its own oldest frames
+    to be dropped, and never blocks the GPS RX thread. Data sent by clients (e.g. configuration
+    commands) is discarded, so only the server configures the receiver.
+    """
+
+    def __init__(self,
+            raw_listen = ['tcp:127.0.0.1:5555'],
+            json_listen = [],
+            max_client_buffer = 65536,
+            debug_ptr = None):
+        """ Initialise a UBloxServer, and start the server thread.
+
+        Keyword Arguments:
+        raw_listen: List of addresses (tcp:host:port or unix:/path/to/socket) on which to serve raw UBX frames.
+        json_listen: List of addresses on which to serve decoded solutions as JSON lines.
+        max_client_buffer: Maximum number of bytes queued for each client before frames are dropped.
+        debug_ptr: Reference to a function which can handle debug messages.
+        """
+        self.max_client_buffer = max_client_buffer
+        self.debug_ptr = debug_ptr
+
+        self.listeners = {}
+        self.unix_paths = []
+        self.clients = []
+        self.lock = Lock()
+
+        for _address in raw_listen:
+            self.listeners[self.open_listener(_address)] = 'raw'
+        for _address in json_listen:
+            self.listeners[self.open_listener(_address)] = 'json'
+
+        # Pipe used to wake the server thread when new data is queued.
+        (self.wake_read, self.wake_write) = os.pipe()
+        os.set_blocking(self.wake_read, False)
+        os.set_blocking(self.wake_write, False)
+        self.wake_pending = False
+
+        self.published_frames = 0
+        self.published_solutions = 0
+
+        self.server_running = True
+        self.server_thread = Thread(target=self.server_loop)
+        self.server_thread.daemon = True
+        self.server_thread.start()
+
+    def debug_message(self, message):
+        """ Write a debug message, either to the debug_ptr function, or to stdout. """
+        message = "GPS Server Debug: " + message
+        if self.debug_ptr != None:
+            self.debug_ptr(message)
+        else:
+            print(message)
+
+    def open_listener(self, address):
+        """ Open a listening socket, given an address of the form tcp:host:port or unix:/path/to/socket """
+        if address.startswith("tcp:"):
+            a = address.split(':')
+            _sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            _sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            _sock.bind((a[1], int(a[2])))
+        elif address.startswith("unix:"):
+            _path = address[5:]
+            if os.path.exists(_path):
+                os.unlink(_path)
+            _sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            _sock.bind(_path)
+            self.unix_paths.append(_path)
+        else:
+            raise UBloxError("Unknown server address %s" % address)
+
+        _sock.listen(16)
+        _sock.setblocking(False)
+        return _sock
+
+    def attach(self, gps):
+        """ Attach to a UBloxGPS object, and start forwarding its frames and solutions to clients. """
+        gps.raw_callback = self.publish_raw
+
+        _callback = gps.callback
+        def _solution_callback(state):
+            self.publish_solution(state)
+            if _callback != None:
+                _callback(state)
+
+        gps.callback = _solution_callback
+
+    def publish(self, data, stream):
+        """ Queue data for all clients of a stream ('raw' or 'json'), and wake the server thread. """
+        with self.lock:
+            for _client in self.clients:
+                if _client.stream == stream:
+                    _client.enqueue(data)
+
+            if self.wake_pending:
+                return
+            self.wake_pending = True
+
+        try:
+            os.write(self.wake_write, b"x")
+        except OSError:
+            pass
+
+    def publish_raw(self, frame):
+        """ Forward a raw UBX frame to all 'raw' clients. """
+        self.published_frames += 1
+        self.publish(bytes(frame), 'raw')
+
+    def publish_solution(self, state):
+        """ Forward a decoded GPS solution (a UBloxGPS state dictionary) to all 'json' clients. """
+        self.published_solutions += 1
+        _state = state.copy()
+        _state['datetime'] = _state['timestamp']
+        self.publish((json.dumps(_state) + '\n').encode('ascii'), 'json')
+
+    def accept_client(self, listener):
+        """ Accept a new connection on a listening socket. """
+        try:
+            (_sock, _addr) = listener.accept()
+        except OSError:
+            return
+        _sock.setblocking(False)
+
+        _client = UBloxServerClient(_sock, str(_addr), self.max_client_buffer)
+        _client.stream = self.listeners[listener]
+
+        with self.lock:
+            self.clients.append(_client)
+
+        self.debug_message("New %s client (%d clients connected)" % (_client.stream, len(self.clients)))
+
+    def drop_client(self, client):
+        """ Disconnect a client. """
+        with self.lock:
+            if client in self.clients:
+                self.clients.remove(client)
+
+        try:
+            client.sock.close()
+        except OSError:
+            pass
+
+        self.debug_message("Client disconnected (%d sent, %d dropped frames)" % (client.sent_frames, client.dropped_frames))
+
+    def service_client(self, client):
+        """ Send as much queued data to a client as its socket will accept. """
+        while True:
+            if len(client.pending) == 0:
+                with self.lock:
+                    if len(client.queue) == 0:
+                        return
+                    client.pending = client.queue.popleft()
+                    client.queued_bytes -= len(client.pending)
+
+            try:
+                _sent = client.sock.send(client.pending)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                self.drop_client(client)
+                return
+
+            client.pending = client.pending[_sent:]
+            if len(client.pending) == 0:
+                client.sent_frames += 1
+            else:
+                # Socket buffer is full.
+                return
+
+    def server_loop(self):
+        """ Server thread. Accepts connections, and sends queued data to clients. """
+        while self.server_running:
+            with self.lock:
+                _clients = list(self.clients)
+
+            _readable = [self.wake_read] + list(self.listeners.keys()) + [c.sock for c in _clients]
+            _writable = [c.sock for c in _clients if c.has_data()]
+
+            try:
+                (_r, _w, _x) = select.select(_readable, _writable, [], 0.5)
+            except (OSError, ValueError):
+                # A client socket was closed underneath us.
+                continue
+
+            if self.wake_read in _r:
+                with self.lock:
+                    self.wake_pending = False
+                try:
+                    os.read(self.wake_read, 4096)
+                except OSError:
+                    pass
+
+            for _listener in self.listeners:
+                if _listener in _r:
+                    self.accept_client(_listener)
+
+            for _client in _clients:
+                if _client.sock in _r:
+                    # Discard anything sent by the client, but detect disconnections.
+                    try:
+                        if len(_client.sock.recv(4096)) == 0:
+                            self.drop_client(_client)
+                            continue
+                    except (BlockingIOError, InterruptedError):
+                        pass
+                    except OSError:
+                        self.drop_client(_client)
+                        continue
+
+                if _client.has_data():
+                    self.service_client(_client)
+
+    def stats(self):
+        """ Return per-client statistics. """
+        with self.lock:
+            return [{'name': c.name, 'stream': c.stream, 'sent': c.sent_frames,
+                'dropped': c.dropped_frames, 'queued_bytes': c.queued_bytes} for c in self.clients]
+
+    def close(self):
+        """ Stop the server, and disconnect all clients. """
+        self.server_running = False
+        self.server_thread.join()
+
+        for _client in list(self.clients):
+            self.drop_client(_client)
+
+        for _listener in self.listeners:
+            _listener.close()
+
+        for _path in self.unix_paths:
+            try:
+                os.unlink(_path)
+            except OSError:
+                pass
+
+        os.close(self.wake_read)
+        os.close(self.wake_write)
+
+
+def benchmark_server(client_counts=(1, 2, 4, 8, 16), num_frames=10000, frame_rate=2000, slow_client=True):
+    """ Measure UBloxServer fan-out performance with a simulated source.
+
+    For each number of clients, publish num_frames frames from a UBloxSimulator at frame_rate frames/second
+    (far above the ~60 frames/second a 10 Hz uBlox produces), and report the cost of each publish call
+    (i.e. the time spent in the GPS RX thread), and the frames received by the clients.
+    If slow_client is set, one additional client reads only a few bytes every 100ms,
+    to show that it does not hold up the others.
+    """
+    import tempfile
+    from ublox_sim import UBloxSimulator
+
+    _sim = UBloxSimulator(seed=1)
+    _frames = []
+    while len(_frames) < num_frames:
+        _frames.extend([x[1] for x in _sim.next_epoch()])
+    _frames = _frames[:num_frames]
+    _total_bytes = float(sum([len(x) for x in _frames]))
+    _tempdir = tempfile.mkdtemp()
+
+    for _count in client_counts:
+        _address = "unix:%s/ublox_bench_%d.sock" % (_tempdir, _count)
+        _server = UBloxServer(raw_listen=[_address], debug_ptr=lambda x: None)
+        _received = [0]*_count
+        _running = [True]
+
+        def _reader(index, delay=0.0, read_size=65536):
+            _gps = UBlox(_address)
+            _gps.dev.settimeout(0.5)
+            while _running[0]:
+                try:
+                    _data = _gps.dev.recv(read_size)
+                except socket.timeout:
+                    continue
+                if not _data:
+                    break
+                if index is not None:
+                    _received[index] += len(_data)
+                if delay > 0:
+                    time.sleep(delay)
+            _gps.close()
+
+        _threads = [Thread(target=_reader, args=(i,)) for i in range(_count)]
+        if slow_client:
+            _threads.append(Thread(target=_reader, args=(None, 0.1, 64)))
+        for _t in _threads:
+            _t.start()
+
+        # Wait for all clients to connect.
+        while len(_server.clients) < len(_threads):
+            time.sleep(0.01)
+
+        _start = time.perf_counter()
+        _publish_time = 0.0
+        _worst = 0.0
+        for i in range(num_frames):
+            _delay = _start + i/float(frame_rate) - time.perf_counter()
+            if _delay > 0:
+                time.sleep(_delay)
+            _t0 = time.perf_counter()
+            _server.publish_raw(_frames[i])
+            _t1 = time.perf_counter() - _t0
+            _publish_time += _t1
+            _worst = max(_worst, _t1)
+        _elapsed = time.perf_counter() - _start
+
+        # Give the clients a moment to drain their buffers.
+        time.sleep(1.0)
+        _stats = _server.stats()
+        _running[0] = False
+        for _t in _threads:
+            _t.join()
+        _server.close()
+
+        _frames_received = [x/_total_bytes*num_frames for x in _received]
+        _dropped = sum([x['dropped'] for x in _stats])
+        print("%2d clients: %6.0f frames/s published, publish cost %5.1f us mean / %7.1f us worst, min/mean received %5.1f%%/%5.1f%%, %d frames dropped in total" % (
+            _count,
+            num_frames/_elapsed,
+            _publish_time/num_frames*1.0e6,
+            _worst*1.0e6,
+            100.0*min(_frames_received)/num_frames,
+            100.0*sum(_frames_received)/len(_frames_received)/num_frames,
+            _dropped))
+
+    os.rmdir(_tempdir)
+
+
+class UBloxSharedState(object):
+    """ Fixed-layout shared memory block holding the latest GPS solution.
+
+    One process (normally UBloxGPS, via its shm_path argument) creates the block and writes to it,
+    and any number of other processes can read it. Updates are protected by a seqlock-style
+    generation counter: the writer makes the counter odd while it updates the block, and even when done.
+    A reader copies the whole block in one go (a single memcpy from the mmap), and only accepts the copy
+    if the counter was even and unchanged across the copy.
+
+    Python gives no memory ordering guarantees for accesses to an mmap, and on a weakly ordered CPU (such as
+    the Pi's ARM cores) a reader can see the new counter before the new body. So the writer also stores a
+    CRC32 of the body next to the counter, and a copy is only accepted if its body matches its CRC.
+
+    If the writer restarts, it may create a new file at the same path. Readers stat the path on each read,
+    and re-map the file if its inode or size has changed.
+
+    The block is a memory-mapped file, so it works on Python versions without multiprocessing.shared_memory.
+    Use a path on a tmpfs (e.g. /dev/shm) to keep it in RAM.
+    """
+
+    def __init__(self, path='/dev/shm/ublox', create=False):
+        """ Open (or, if create is True, create) a shared GPS solution block at the given path. """
+        self.path = path
+        self.create = create
+
+        if create:
+            _fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            os.ftruncate(_fd, SHM_SIZE)
+            self.shm = mmap.mmap(_fd, SHM_SIZE, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+            # Start with an empty block.
+            self.shm[:] = bytes(SHM_SIZE)
+            os.close(_fd)
+        else:
+            self.shm = None
+            self.file_id = None
+            self.remap()
+
+        self.generation = 0
+        self.crc = 0
+
+    def remap(self):
+        """ (Re-)map the block for reading, if the file at our path has changed (or we have not mapped it yet).
+        Returns False if the file does not exist, or is not a complete block. """
+        try:
+            _stat = os.stat(self.path)
+        except OSError:
+            return False
+        _file_id = (_stat.st_dev, _stat.st_ino, _stat.st_size)
+        if _file_id == self.file_id:
+            return True
+        if _stat.st_size < SHM_SIZE:
+            return False
+
+        _fd = os.open(self.path, os.O_RDONLY)
+        try:
+            _shm = mmap.mmap(_fd, SHM_SIZE, mmap.MAP_SHARED, mmap.PROT_READ)
+        finally:
+            # The mapping remains valid after the file descriptor is closed.
+            os.close(_fd)
+        if self.shm != None:
+            self.shm.close()
+        self.shm = _shm
+        self.file_id = _file_id
+        return True
+
+    def write(self, state, fix_monotonic=0.0):
+        """ Publish a UBloxGPS state dictionary, along with the time.monotonic() arrival time of the fix. """
+        _dt = state['datetime']
+        _timestamp = calendar.timegm(_dt.utctimetuple()) + _dt.microsecond*1.0e-6
+
+        _body = struct.pack(SHM_BODY_FORMAT,
+            state['latitude'],
+            state['longitude'],
+            state['altitude'],
+            state['ground_speed'],
+            state['ascent_rate'],
+            state['heading'],
+            state['iTOW'],
+            _timestamp,
+            fix_monotonic,
+            state['week'],
+            state['gpsFix'],
+            state['numSV'],
+            state['leapS'],
+            state['dynamic_model'])
+
+        # Odd generation - write in progress.
+        struct.pack_into(SHM_HEADER_FORMAT, self.shm, 0, self.generation + 1, self.crc)
+        self.shm[SHM_BODY_OFFSET:SHM_SIZE] = _body
+        # Even generation - write complete.
+        self.generation += 2
+        self.crc = zlib.crc32(_body)
+        struct.pack_into(SHM_HEADER_FORMAT, self.shm, 0, self.generation, self.crc)
+
+    def read_raw(self, retries=1000):
+        """ Return a consistent copy of the block as a (generation, body_tuple) tuple,
+        or None if nothing has been published yet, or no consistent copy could be made. """
+        if not self.remap():
+            return None
+
+        for i in range(retries):
+            (_generation, _crc) = struct.unpack_from(SHM_HEADER_FORMAT, self.shm, 0)
+            if _generation == 0:
+                return None
+            if _generation & 1:
+                # Writer is part-way through an update.
+                continue
+
+            _copy = self.shm[:SHM_SIZE]
+            (_copy_generation, _crc) = struct.unpack_from(SHM_HEADER_FORMAT, _copy, 0)
+
+            if (_copy_generation == _generation) and (struct.unpack_from(SHM_HEADER_FORMAT, self.shm, 0)[0] == _generation) \
+                    and (zlib.crc32(_copy[SHM_BODY_OFFSET:]) == _crc):
+                return (_generation, struct.unpack_from(SHM_BODY_FORMAT, _copy, SHM_BODY_OFFSET))
+
+        return None
+
+    def read(self, retries=1000):
+        """ Return the latest GPS solution as a dictionary (using the same fields as UBloxGPS.state),
+        or None if nothing has been published yet. """
+        _raw = self.read_raw(retries)
+
+        if _raw is None:
+            return None
+
+        (_generation, _body) = _raw
+        _datetime = datetime.datetime.utcfromtimestamp(_body[7])
+
+        return {
+            'latitude': _body[0],
+            'longitude': _body[1],
+            'altitude': _body[2],
+            'ground_speed': _body[3],
+            'ascent_rate': _body[4],
+            'heading': _body[5],
+            'iTOW': _body[6],
+            'timestamp': _datetime.isoformat(),
+            'datetime': _datetime,
+            'fix_monotonic': _body[8],
+            'week': _body[9],
+            'gpsFix': _body[10],
+            'numSV': _body[11],
+            'leapS': _body[12],
+            'dynamic_model': _body[13],
+            'generation': _generation//2
+        }
+
+    def close(self):
+        """ Unmap the block. The creator also removes the file. """
+        if self.shm != None:
+            self.shm.close()
+        if self.create:
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+
+def _shared_state_writer(path, duration, update_rate):
+    """ Writer process for benchmark_shared_state(). (Module level, so it can be started with any
+    multiprocessing start method.) """
+    _shm = UBloxSharedState(path, create=True)
+    _state = UBloxGPS.state.copy()
+    _start = time.monotonic()
+    i = 0
+    while time.monotonic() - _start < duration:
+        i += 1
+        _state['latitude'] = _state['longitude'] = _state['altitude'] = float(i)
+        _shm.write(_state, time.monotonic())
+        time.sleep(1.0/update_rate)
+    _shm.close()
+
+
+def benchmark_shared_state(duration=10.0, update_rate=10.0, path=None):
+    """ Measure UBloxSharedState read latency while another process writes solutions at update_rate Hz.
+
+    The writer sets latitude, longitude and altitude to the same value in every update, so any torn
+    (inconsistent) read is detected. Read latencies are reported as mean and percentiles.
+    """
+    import multiprocessing, tempfile
+
+    if path is None:
+        _dir = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+        path = os.path.join(_dir, 'ublox_bench_%d' % os.getpid())
+
+    _process = multiprocessing.Process(target=_shared_state_writer, args=(path, duration, update_rate))
+    _process.start()
+
+    # Wait for the writer to publish (or give up, if it has died).
+    while True:
+        if not _process.is_alive():
+            print("Writer process exited (code %s) before publishing." % str(_process.exitcode))
+            return
+        try:
+            _shm = UBloxSharedState(path)
+            if _shm.read() != None:
+                break
+            _shm.close()
+        except (OSError, ValueError):
+            pass
+        time.sleep(0.01)
+
+    _latencies = []
+    _torn = 0
+    _failed = 0
+    _generations = set()
+    _start = time.monotonic()
+    while time.monotonic() - _start < duration*0.9:
+        _t0 = time.perf_counter()
+        _state = _shm.read()
+        _latencies.append(time.perf_counter() - _t0)
+        if _state is None:
+            _failed += 1
+            continue
+        if _state['latitude'] != _state['longitude'] or _state['latitude'] != _state['altitude']:
+            _torn += 1
+        _generations.add(_state['generation'])
+
+    _process.join(timeout=duration + 5.0)
+    if _process.is_alive():
+        _process.terminate()
+    _shm.close()
+
+    _latencies.sort()
+    print("%d reads across %d updates at %.1f Hz, %d inconsistent reads, %d reads gave up retrying." % (len(_latencies), len(_generations), update_rate, _torn, _failed))
+    print("Read latency: mean %.2f us, p50 %.2f us, p99 %.2f us, max %.2f us" % (
+        sum(_latencies)/len(_latencies)*1.0e6,
+        _latencies[len(_latencies)//2]*1.0e6,
+        _latencies[int(len(_latencies)*0.99)]*1.0e6,
+        _latencies[-1]*1.0e6))
+
 
 if __name__ == "__main__":
     """ Basic test script for the above UBloxGPS class. 
     Sets up GPS and prints out basic position information.
+    Optionally, share the GPS with other processes using a UBloxServer.
     """
-    import sys
+    parser = argparse.ArgumentParser()
+    parser.add_argument("port", type=str, nargs='?', default='/dev/ublox', help="uBlox serial port.")
+    parser.add_argument("--server-raw", type=str, action='append', default=[], help="Serve raw UBX frames on this address (tcp:host:port or unix:/path). May be repeated.")
+    parser.add_argument("--server-json", type=str, action='append', default=[], help="Serve decoded solutions as JSON lines on this address. May be repeated.")
+    parser.add_argument("--shm", type=str, default=None, help="Publish solutions to a shared memory block at this path (e.g. /dev/shm/ublox).")
+    parser.add_argument("--benchmark-server", action="store_true", default=False, help="Run the fan-out server benchmark with a simulated source, then exit.")
+    parser.add_argument("--benchmark-shm", action="store_true", default=False, help="Run the shared memory read latency benchmark, then exit.")
+    args = parser.parse_args()
+
+    if args.benchmark_server:
+        benchmark_server()
+        sys.exit(0)
+
+    if args.benchmark_shm:
+        benchmark_shared_state()
+        sys.exit(0)
 
     def gps_test(state):
         print(state)
 
 
-    gps = UBloxGPS(port=sys.argv[1], callback=gps_test, update_rate_ms=500, dynamic_model=DYNAMIC_MODEL_AIRBORNE1G, ntpd_update=True)
+    gps = UBloxGPS(port=args.port, callback=gps_test, update_rate_ms=500, dynamic_model=DYNAMIC_MODEL_AIRBORNE1G, ntpd_update=True, shm_path=args.shm)
+
+    server = None
+    if len(args.server_raw) > 0 or len(args.server_json) > 0:
+        server = UBloxServer(raw_listen=args.server_raw, json_listen=args.server_json)
+        server.attach(gps)
 
     try:
         while True:
             time.sleep(1)
 
     except KeyboardInterrupt:
+        if server != None:
+            server.close()
         gps.close()
 
 
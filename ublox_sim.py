@@ -0,0 +1,519 @@
+#!/usr/bin/env python
+'''
+Simulated uBlox GPS receiver.
+
+Produces a realistic UBX output stream (a balloon ascending at a configurable rate),
+with optional injected noise and partial frames, and ACKs configuration messages.
+The simulator can be served over a pseudo-terminal (so UBloxGPS can open it like
+/dev/ttyACM0), or over TCP (for use with UBlox('tcp:host:port')).
+
+Also contains a benchmark suite for the parsers in ublox.py.
+
+Released under GNU GPL version 3 or later
+'''
+
+import struct
+import datetime
+import random
+from threading import Thread, Lock
+import time, os, sys, math, socket, select, argparse
+
+from ublox import *
+
+# Messages output every epoch by default. This matches the configuration set up by UBloxGPS.setup_ublox()
+DEFAULT_MESSAGES = ['NAV_SOL', 'NAV_STATUS', 'NAV_POSLLH', 'NAV_VELNED', 'NAV_TIMEGPS']
+
+# GPS - UTC offset
+DEFAULT_LEAP_SECONDS = 18
+
+GPS_EPOCH = datetime.datetime(1980, 1, 6)
+
+# WGS84 parameters, used to produce NAV_SOL ECEF positions.
+WGS84_A = 6378137.0
+WGS84_E2 = 6.69437999014e-3
+
+
+class UBloxSimulator(object):
+    """ Simulated uBlox GPS receiver """
+
+    def __init__(self,
+            update_rate_ms = 1000,
+            messages = DEFAULT_MESSAGES,
+            clock_rate = 5,
+            latitude = -34.9,
+            longitude = 138.6,
+            altitude = 100.0,
+            velocity = (2.0, 5.0, -5.0),
+            start_time = None,
+            noise_rate = 0.0,
+            partial_rate = 0.0,
+            num_sv = 9,
+            seed = None):
+        """ Initialise a UBloxSimulator.
+
+        Keyword Arguments:
+        update_rate_ms: Solution period in milliseconds. Updated if a CFG_RATE message is received.
+        messages: List of NAV messages to output each epoch, in order.
+        clock_rate: Output a NAV_CLOCK message every clock_rate epochs (0 to disable).
+        latitude, longitude, altitude: Starting position (degrees, degrees, metres).
+        velocity: (North, East, Down) velocity in m/s. The default is a balloon ascending at 5 m/s.
+        start_time: Starting UTC time as a datetime object. Defaults to now, rounded to a whole second.
+        noise_rate: Probability (per epoch) of injecting a burst of random bytes into the stream.
+        partial_rate: Probability (per epoch) of injecting a truncated frame into the stream.
+        num_sv: Number of satellites reported in use.
+        seed: Random seed, for reproducible noise.
+        """
+        self.update_rate_ms = update_rate_ms
+        self.messages = messages
+        self.clock_rate = clock_rate
+        self.latitude = latitude
+        self.longitude = longitude
+        self.altitude = altitude
+        self.velocity = velocity
+        self.noise_rate = noise_rate
+        self.partial_rate = partial_rate
+        self.num_sv = num_sv
+        self.leap_seconds = DEFAULT_LEAP_SECONDS
+        self.dynamic_model = DYNAMIC_MODEL_PORTABLE
+        self.random = random.Random(seed)
+
+        if start_time is None:
+            start_time = datetime.datetime.utcnow().replace(microsecond=0)
+
+        # Current GPS time, in milliseconds since the GPS epoch.
+        _gps_time = start_time - GPS_EPOCH + datetime.timedelta(seconds=self.leap_seconds)
+        self.gps_time_ms = int(_gps_time.total_seconds()*1000)
+
+        self.epoch_count = 0
+        self.input_buffer = b""
+
+        # time.monotonic() times at which each NAV_TIMEGPS was written out, indexed by iTOW (ms).
+        self.emit_times = {}
+
+        # Connections we are serving, as (write function, lock) tuples.
+        self.outputs = []
+        self.outputs_lock = Lock()
+        self.running = False
+        self.pty_name = None
+
+        self.acked = 0
+        self.noise_injected = 0
+        self.partials_injected = 0
+
+    def ecef(self):
+        """ Return our ECEF position (metres) """
+        _lat = math.radians(self.latitude)
+        _lon = math.radians(self.longitude)
+        _n = WGS84_A/math.sqrt(1 - WGS84_E2*math.sin(_lat)**2)
+        _x = (_n + self.altitude)*math.cos(_lat)*math.cos(_lon)
+        _y = (_n + self.altitude)*math.cos(_lat)*math.sin(_lon)
+        _z = (_n*(1 - WGS84_E2) + self.altitude)*math.sin(_lat)
+        return (_x, _y, _z)
+
+    def build_nav(self, name, iTOW, week):
+        """ Build a NAV message for the current epoch """
+        (_vn, _ve, _vd) = self.velocity
+
+        if name == 'NAV_SOL':
+            (_x, _y, _z) = self.ecef()
+            _payload = struct.pack('<IihBBiiiIiiiIHBBI', iTOW, 0, week, 3, 0x0D,
+                int(_x*100), int(_y*100), int(_z*100), 500, 0, 0, int(-_vd*100), 50, 150, 0, self.num_sv, 0)
+            return build_message(CLASS_NAV, MSG_NAV_SOL, _payload)
+        elif name == 'NAV_STATUS':
+            return build_message(CLASS_NAV, MSG_NAV_STATUS, struct.pack('<IBBBBII', iTOW, 3, 0x0D, 0, 0, 30000, iTOW))
+        elif name == 'NAV_POSLLH':
+            _payload = struct.pack('<IiiiiII', iTOW, int(round(self.longitude*1.0e7)), int(round(self.latitude*1.0e7)),
+                int(self.altitude*1000), int(self.altitude*1000), 2000, 3000)
+            return build_message(CLASS_NAV, MSG_NAV_POSLLH, _payload)
+        elif name == 'NAV_VELNED':
+            _gspeed = math.sqrt(_vn**2 + _ve**2)
+            _speed = math.sqrt(_vn**2 + _ve**2 + _vd**2)
+            _heading = math.degrees(math.atan2(_ve, _vn)) % 360.0
+            _payload = struct.pack('<IiiiIIiII', iTOW, int(_vn*100), int(_ve*100), int(_vd*100),
+                int(_speed*100), int(_gspeed*100), int(_heading*1.0e5), 50, 100000)
+            return build_message(CLASS_NAV, MSG_NAV_VELNED, _payload)
+        elif name == 'NAV_TIMEGPS':
+            return build_message(CLASS_NAV, MSG_NAV_TIMEGPS, struct.pack('<IihbBI', iTOW, 0, week, self.leap_seconds, 0x07, 20))
+        elif name == 'NAV_CLOCK':
+            return build_message(CLASS_NAV, MSG_NAV_CLOCK, struct.pack('<IiiII', iTOW, 1000, 50, 20, 500))
+        else:
+            raise UBloxError("Simulator does not support %s" % name)
+
+    def next_epoch(self):
+        """ Advance the simulation by one epoch, and return a list of (message name, frame bytes) tuples. """
+        _dt = self.update_rate_ms/1000.0
+        self.gps_time_ms += self.update_rate_ms
+        self.epoch_count += 1
+
+        # Move along our velocity vector.
+        (_vn, _ve, _vd) = self.velocity
+        self.latitude += math.degrees(_vn*_dt/EARTH_RADIUS)
+        self.longitude += math.degrees(_ve*_dt/(EARTH_RADIUS*math.cos(math.radians(self.latitude))))
+        self.altitude -= _vd*_dt
+
+        _week = self.gps_time_ms//(7*86400*1000)
+        _iTOW = self.gps_time_ms % (7*86400*1000)
+
+        _frames = []
+        for _name in self.messages:
+            _frames.append((_name, self.build_nav(_name, _iTOW, _week)._buf))
+
+        if self.clock_rate > 0 and self.epoch_count % self.clock_rate == 0:
+            _frames.append(('NAV_CLOCK', self.build_nav('NAV_CLOCK', _iTOW, _week)._buf))
+
+        return _frames
+
+    def corrupt(self, frames):
+        """ Inject noise and partial frames into a list of (message name, frame bytes) tuples. """
+        if self.noise_rate > 0 and self.random.random() < self.noise_rate:
+            _noise = bytes([self.random.randrange(256) for i in range(self.random.randrange(1, 33))])
+            frames.insert(self.random.randrange(len(frames) + 1), ('NOISE', _noise))
+            self.noise_injected += 1
+
+        if self.partial_rate > 0 and self.random.random() < self.partial_rate:
+            _frame = frames[self.random.randrange(len(frames))][1]
+            frames.insert(self.random.randrange(len(frames) + 1), ('PARTIAL', _frame[:self.random.randrange(1, len(_frame))]))
+            self.partials_injected += 1
+
+        return frames
+
+    def generate(self, num_epochs):
+        """ Generate num_epochs worth of (possibly corrupted) output as a single bytes object. """
+        _data = []
+        for i in range(num_epochs):
+            for (_name, _frame) in self.corrupt(self.next_epoch()):
+                _data.append(_frame)
+        return b"".join(_data)
+
+    def handle_input(self, data):
+        """ Process bytes sent to the simulated receiver, and return any response bytes.
+        CFG messages are ACKed, and polls of CFG_NAV5 and CFG_PRT are answered.
+        NMEA sentences and any other non-UBX data are ignored. """
+        self.input_buffer += data
+        _response = b""
+
+        while True:
+            _start = self.input_buffer.find(bytes([PREAMBLE1, PREAMBLE2]))
+            if _start < 0:
+                # Keep a trailing partial preamble.
+                self.input_buffer = self.input_buffer[-1:]
+                break
+            self.input_buffer = self.input_buffer[_start:]
+            if len(self.input_buffer) < 8:
+                break
+
+            (_length,) = struct.unpack('<H', self.input_buffer[4:6])
+            if len(self.input_buffer) < _length + 8:
+                break
+
+            _msg = UBloxMessage()
+            _msg._buf = self.input_buffer[:_length + 8]
+            if not _msg.valid():
+                self.input_buffer = self.input_buffer[1:]
+                continue
+            self.input_buffer = self.input_buffer[_length + 8:]
+
+            _response += self.handle_message(_msg._buf[2], _msg._buf[3], _msg._buf[6:-2])
+
+        return _response
+
+    def handle_message(self, msg_class, msg_id, payload):
+        """ Respond to a single UBX message """
+        if msg_class != CLASS_CFG:
+            return b""
+
+        _response = b""
+
+        if msg_id == MSG_CFG_NAV5:
+            if len(payload) <= 1:
+                # Poll
+                _nav5 = struct.pack('<HBBiIbBHHHHBBIII', 0xFFFF, self.dynamic_model, 3, 0, 10000, 5, 0, 250, 250, 100, 350, 0, 60, 0, 0, 0)
+                _response += build_message(CLASS_CFG, MSG_CFG_NAV5, _nav5)._buf
+            else:
+                self.dynamic_model = payload[2]
+        elif msg_id == MSG_CFG_PRT and len(payload) <= 1:
+            _port = payload[0] if len(payload) == 1 else PORT_USB
+            _prt = struct.pack('<BBHIIHHHH', _port, 0, 0, 2240, 115200, 1, 1, 0, 0)
+            _response += build_message(CLASS_CFG, MSG_CFG_PRT, _prt)._buf
+        elif msg_id == MSG_CFG_RATE and len(payload) >= 2:
+            (_rate,) = struct.unpack('<H', payload[:2])
+            if _rate > 0:
+                self.update_rate_ms = _rate
+
+        self.acked += 1
+        _response += build_message(CLASS_ACK, MSG_ACK_ACK, struct.pack('<BB', msg_class, msg_id))._buf
+        return _response
+
+    def add_output(self, write_function):
+        """ Add a connection to send the output stream to. Returns the (write function, lock) tuple. """
+        _output = (write_function, Lock())
+        with self.outputs_lock:
+            self.outputs.append(_output)
+        return _output
+
+    def remove_output(self, output):
+        with self.outputs_lock:
+            if output in self.outputs:
+                self.outputs.remove(output)
+
+    def send(self, output, data):
+        """ Write data to an output. Returns False if the connection has failed. """
+        (_write, _lock) = output
+        try:
+            with _lock:
+                _write(data)
+            return True
+        except OSError:
+            self.remove_output(output)
+            return False
+
+    def input_loop(self, output, read_function):
+        """ Read commands from a connection, and send back any responses. """
+        while self.running:
+            try:
+                _data = read_function()
+            except OSError:
+                break
+            if _data is None:
+                continue
+            if len(_data) == 0:
+                break
+            _response = self.handle_input(_data)
+            if len(_response) > 0:
+                self.send(output, _response)
+
+        self.remove_output(output)
+
+    def epoch_loop(self):
+        """ Output one epoch per update period to all connections. """
+        _next = time.monotonic()
+        while self.running:
+            _next += self.update_rate_ms/1000.0
+            _delay = _next - time.monotonic()
+            if _delay > 0:
+                time.sleep(_delay)
+
+            _frames = self.corrupt(self.next_epoch())
+
+            with self.outputs_lock:
+                _outputs = list(self.outputs)
+
+            for (_name, _frame) in _frames:
+                for _output in _outputs:
+                    self.send(_output, _frame)
+                if _name == 'NAV_TIMEGPS':
+                    self.emit_times[self.gps_time_ms % (7*86400*1000)] = time.monotonic()
+
+    def start(self):
+        """ Start generating output """
+        if self.running:
+            return
+        self.running = True
+        self.epoch_thread = Thread(target=self.epoch_loop)
+        self.epoch_thread.daemon = True
+        self.epoch_thread.start()
+
+    def serve_pty(self):
+        """ Serve the simulated receiver over a pseudo-terminal. Returns the device path (e.g. /dev/pts/3),
+        which can be passed to UBlox or UBloxGPS as the port. """
+        import tty
+        (_master, _slave) = os.openpty()
+        tty.setraw(_slave)
+        # Keep the slave end open, so the master does not see EOF whenever a client closes the device.
+        self.pty_fds = (_master, _slave)
+        self.pty_name = os.ttyname(_slave)
+
+        _output = self.add_output(lambda data: os.write(_master, data))
+
+        def _read():
+            (_r, _w, _x) = select.select([_master], [], [], 0.5)
+            if len(_r) == 0:
+                return None
+            return os.read(_master, 4096)
+
+        self.start()
+        _thread = Thread(target=self.input_loop, args=(_output, _read))
+        _thread.daemon = True
+        _thread.start()
+
+        return self.pty_name
+
+    def serve_tcp(self, host='127.0.0.1', port=5556):
+        """ Serve the simulated receiver over TCP, to any number of clients. """
+        self.listen_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listen_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listen_sock.bind((host, port))
+        self.listen_sock.listen(8)
+        self.listen_sock.settimeout(0.5)
+
+        def _accept_loop():
+            while self.running:
+                try:
+                    (_sock, _addr) = self.listen_sock.accept()
+                except socket.timeout:
+                    continue
+                except OSError:
+                    break
+                _sock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
+                _sock.settimeout(0.5)
+                _output = self.add_output(_sock.sendall)
+
+                def _read(sock=_sock):
+                    try:
+                        return sock.recv(4096)
+                    except socket.timeout:
+                        return None
+
+                _thread = Thread(target=self.input_loop, args=(_output, _read))
+                _thread.daemon = True
+                _thread.start()
+
+        self.start()
+        _thread = Thread(target=_accept_loop)
+        _thread.daemon = True
+        _thread.start()
+
+    def close(self):
+        """ Stop the simulator """
+        self.running = False
+        time.sleep(0.6)
+        if self.pty_name != None:
+            for _fd in self.pty_fds:
+                os.close(_fd)
+        if hasattr(self, 'listen_sock'):
+            self.listen_sock.close()
+
+
+def benchmark_receive_message(num_epochs=5000, noise_rate=0.02, partial_rate=0.01):
+    """ Benchmark UBlox.receive_message on a simulated stream (read from a file, so the
+    parser is the only limit). Reports frames/s, CPU time per fix, and memory allocation per fix. """
+    import tempfile, tracemalloc
+
+    _sim = UBloxSimulator(noise_rate=noise_rate, partial_rate=partial_rate, seed=1)
+    _data = _sim.generate(num_epochs)
+
+    (_fd, _filename) = tempfile.mkstemp(suffix='.ubx')
+    os.write(_fd, _data)
+    os.close(_fd)
+
+    def _parse():
+        _gps = UBlox(_filename)
+        _frames = 0
+        _fixes = 0
+        while True:
+            _msg = _gps.receive_message_noerror()
+            if _msg is None:
+                break
+            _frames += 1
+            if _msg.msg_type() == (CLASS_NAV, MSG_NAV_TIMEGPS):
+                _fixes += 1
+        _gps.close()
+        return (_frames, _fixes)
+
+    _wall = time.perf_counter()
+    _cpu = time.process_time()
+    (_frames, _fixes) = _parse()
+    _cpu = time.process_time() - _cpu
+    _wall = time.perf_counter() - _wall
+
+    # Second pass with allocation tracing, which is much slower.
+    tracemalloc.start()
+    _blocks = sys.getallocatedblocks()
+    _parse()
+    _blocks = sys.getallocatedblocks() - _blocks
+    (_current, _peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    os.unlink(_filename)
+
+    print("UBlox.receive_message: %d bytes, %d frames, %d fixes (%d noise bursts, %d partial frames injected)" % (
+        len(_data), _frames, _fixes, _sim.noise_injected, _sim.partials_injected))
+    print("  %.0f frames/s, %.1f us CPU/frame, %.1f us CPU/fix" % (
+        _frames/_wall, _cpu/_frames*1.0e6, _cpu/max(_fixes, 1)*1.0e6))
+    print("  peak traced memory %.1f KiB, %.2f blocks retained/fix" % (
+        _peak/1024.0, _blocks/float(max(_fixes, 1))))
+
+
+def benchmark_rx_loop(duration=10.0, update_rate_ms=50, noise_rate=0.02, partial_rate=0.01):
+    """ Benchmark UBloxGPS.rx_loop against a simulated receiver served over a pseudo-terminal.
+    Reports frames/s, CPU time per fix used by the RX thread, and callback latency
+    (from the NAV_TIMEGPS frame being written, to the callback function being called). """
+    _sim = UBloxSimulator(update_rate_ms=update_rate_ms, noise_rate=noise_rate, partial_rate=partial_rate, seed=2)
+    _port = _sim.serve_pty()
+
+    _latencies = []
+    _frames = [0]
+
+    def _callback(state):
+        _now = time.monotonic()
+        _emitted = _sim.emit_times.get(int(round(state['iTOW']*1000)), None)
+        if _emitted != None:
+            _latencies.append(_now - _emitted)
+
+    def _raw_callback(frame):
+        _frames[0] += 1
+
+    _gps = UBloxGPS(port=_port, callback=_callback, raw_callback=_raw_callback,
+        update_rate_ms=update_rate_ms, debug_ptr=lambda x: None)
+
+    # Let the configuration settle, then start measuring.
+    time.sleep(1.0)
+    del _latencies[:]
+    _frames[0] = 0
+    _clock = time.pthread_getcpuclockid(_gps.rx_thread.ident)
+    _cpu = time.clock_gettime(_clock)
+    _start = time.monotonic()
+
+    time.sleep(duration)
+
+    _cpu = time.clock_gettime(_clock) - _cpu
+    _elapsed = time.monotonic() - _start
+    _fixes = len(_latencies)
+    _frame_count = _frames[0]
+
+    _gps.rx_running = False
+    _gps.rx_thread.join(10)
+    _gps.gps.close()
+    _sim.close()
+
+    _latencies.sort()
+    print("UBloxGPS.rx_loop: %d ms update rate, %d frames, %d fixes in %.1f s" % (update_rate_ms, _frame_count, _fixes, _elapsed))
+    if _fixes > 0:
+        print("  %.0f frames/s, %.1f us RX thread CPU/fix" % (_frame_count/_elapsed, _cpu/_fixes*1.0e6))
+        print("  callback latency: mean %.2f ms, p50 %.2f ms, p99 %.2f ms, max %.2f ms" % (
+            sum(_latencies)/_fixes*1.0e3,
+            _latencies[_fixes//2]*1.0e3,
+            _latencies[int(_fixes*0.99)]*1.0e3,
+            _latencies[-1]*1.0e3))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("mode", choices=['serve', 'bench'], help="Serve a simulated receiver, or run the parser benchmarks.")
+    parser.add_argument("--pty", action="store_true", default=False, help="Serve over a pseudo-terminal.")
+    parser.add_argument("--tcp", type=str, default=None, help="Serve over TCP on this host:port.")
+    parser.add_argument("--rate", type=int, default=1000, help="Solution period (ms).")
+    parser.add_argument("--noise", type=float, default=0.0, help="Probability of injecting noise per epoch.")
+    parser.add_argument("--partial", type=float, default=0.0, help="Probability of injecting a partial frame per epoch.")
+    parser.add_argument("--duration", type=float, default=10.0, help="rx_loop benchmark duration (s).")
+    args = parser.parse_args()
+
+    if args.mode == 'bench':
+        benchmark_receive_message(noise_rate=args.noise, partial_rate=args.partial)
+        benchmark_rx_loop(duration=args.duration, update_rate_ms=min(args.rate, 100), noise_rate=args.noise, partial_rate=args.partial)
+        sys.exit(0)
+
+    sim = UBloxSimulator(update_rate_ms=args.rate, noise_rate=args.noise, partial_rate=args.partial)
+
+    if args.pty:
+        print("Serving simulated uBlox on %s" % sim.serve_pty())
+    if args.tcp != None:
+        (_host, _port) = args.tcp.split(':')
+        sim.serve_tcp(_host, int(_port))
+        print("Serving simulated uBlox on tcp:%s" % args.tcp)
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        sim.close()